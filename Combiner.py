@@ -1,188 +1,642 @@
+import os
 import cv2
 import numpy as np
 import utilities as util
 import geometry as gm
-import copy
+import features as fs
+import canvas as cv
+import registration as reg
+import pairs as pr
+import adjustment as adj
+import dataset as ds
+import matching as mt
+import manifest as mf
+import profiling as pf
 
 class Combiner:
-	def __init__(self,imageList_,dataMatrix_):
+	def __init__(self,imageList_,dataMatrix_,fileNames_=None,*,
+			workers_=1,registrationSize_=1000,refine_=False,refineSize_=None,matcher_="bruteforce",minInliers_=None,
+			headings_=None,fieldOfView_=73.7,gpsAccuracy_=2.0,
+			detector_="orb",keypointBudget_=None,gridSize_=8,featureCache_=None,
+			canvas_=None,outputScale_=1.0,gsd_=None,blending_="overwrite",interpolation_=cv2.INTER_LINEAR,seamThreshold_=18,
+			manifest_=None,checkpointEvery_=1,snapshotEvery_=0,snapshotPath_="results/intermediateResult.png",
+			showMatches_=False,matchesDirectory_=None,profiler_=None):
 		'''
-		:param imageList_: List of all images in dataset.
+		:param imageList_: All images in dataset, a dataset.ImageDataset (decoded on demand) or a list of images.
 		:param dataMatrix_: Matrix with all pose data in dataset.
+		:param fileNames_: Optional list of image file names. Needed to key the on-disk feature cache.
+		:param workers_: Number of worker processes used by the registration stage.
+		:param registrationSize_: Long side in pixels of the images used for registration. None registers at native resolution.
+		:param refine_: Refine all transforms by least squares over consecutive pairs and GPS neighbours. Reduces drift.
+		:param refineSize_: Optional long side of an intermediate pyramid level at which pair transforms are refined.
+		:param matcher_: Feature matcher backend, see matching.createMatcher(). "bruteforce", "flann", or "prior" to only match
+			keypoints near the position predicted from the GPS positions. A matcher object is used as is.
+		:param minInliers_: Optional number of RANSAC inliers after which a pair transform is accepted, see
+			registration.estimateTransformEarly(). None estimates every transform from all matches.
+		:param headings_: Optional camera heading of every image in degrees, NaN where unknown, see utilities.importHeadings().
+			Used by the "prior" matcher, see northRotations().
+		:param fieldOfView_: Horizontal field of view of the camera in degrees. Image footprints are estimated from it and
+			the altitude, see pairs.footprintSizes().
+		:param gpsAccuracy_: Horizontal accuracy of the GPS positions in meters. Sets the search window of the "prior" matcher
+			unless the matcher object has one, see priorWindow().
+		:param detector_: Feature detector, "orb", "akaze" or "sift".
+		:param keypointBudget_: Optional number of keypoints per image. They are spread over a grid of gridSize_ cells
+			along the long side (see features.bucketKeypoints()), which bounds the matching cost of every pair.
+		:param gridSize_: Number of bucketing cells along the long side of the image.
+		:param featureCache_: Optional directory where keypoints and descriptors are stored between runs.
+		:param canvas_: Optional canvas.Canvas or canvas.TiledCanvas to paint the result into. Use a TiledCanvas for large surveys.
+		:param outputScale_: Resolution of the mosaic relative to the native images. 1.0 keeps the native GSD.
+		:param gsd_: Optional ground sample distance of the result in meters per pixel. Images are then placed into a fixed
+			north-up world grid from their ENU positions instead of the frame of the first image, so results
+			of different runs line up. outputScale_ is ignored, see georeferencedFrame().
+		:param blending_: Blending of overlapping images in the default canvas, see compositing.composite(). "overwrite",
+			"feather" or "multiband". A canvas passed as canvas_ keeps its own setting.
+		:param interpolation_: OpenCV interpolation flag used when images are warped, e.g. cv2.INTER_LINEAR or cv2.INTER_CUBIC.
+		:param seamThreshold_: Gray level at or below which pixels along the border of a blended image are treated as a black seam and repaired. None disables seam repair.
+		:param manifest_: Optional manifest.JobManifest. createMosaic() then resumes the job stored in it and only registers
+			and composites the images (e.g. newly appended ones) that are not finished yet. Without canvas_, the result is
+			painted into a TiledCanvas in the job directory, whose checkpoints only flush the tiles. A Canvas passed as
+			canvas_ writes its whole buffer at every checkpoint.
+		:param checkpointEvery_: With a manifest, save the job state every N composited images.
+		:param snapshotEvery_: Write the intermediate result every N combined images. 0 disables snapshots.
+		:param snapshotPath_: Path of the intermediate result image.
+		:param showMatches_: Show the matches of every consecutive pair in a window and wait for a key press. Only for interactive use.
+		:param matchesDirectory_: Optional directory where the matches of every consecutive pair are drawn into PNG files.
+			Match drawings are not computed at all unless one of these two options is set.
+		:param profiler_: Optional profiling.Profiler that receives the timing of every stage, the canvas size after every
+			image and the match and inlier counts of every pair.
 		:return:
 		'''
-		self.imageList = []
+		#native images. Nothing is decoded up front, corrected images are computed when needed and only a few are cached.
+		self.sourceImages = imageList_ if isinstance(imageList_, ds.ImageList) else ds.ImageList(imageList_)
+		self.imageCount = len(self.sourceImages)
 		self.dataMatrix = dataMatrix_
-		detector = cv2.ORB()
-		for i in range(0,len(imageList_)):
-			image = imageList_[i][::2,::2,:] #downsample the image to speed things up. 4000x3000 is huge!
-			# image = imageList_[i] #downsample the image to speed things up. 4000x3000 is huge!
-			M = gm.computeUnRotMatrix(self.dataMatrix[i,:])
-			#Perform a perspective transformation based on pose information.
-			#Ideally, this will mnake each image look as if it's viewed from the top.
-			#We assume the ground plane is perfectly flat.
-			correctedImage = gm.warpPerspectiveWithPadding(image,M)
-			self.imageList.append(correctedImage) #store only corrected images to use in combination
-		# self.resultImage = self.imageList[0]
-		cv2.imwrite("results/intermediateResult.png",self.imageList[0])
-	def createMosaic(self):
-		for i in range(1,len(self.imageList)):
-			self.combine(i)
+		self.fileNames = fileNames_
+		self.detectorParams = fs.detectorParameters(detector_, keypointBudget_, gridSize_)
+		self.minInliers = minInliers_
+		self.features = fs.FeatureStore(self.detectorParams, featureCache_, registrationSize_)
+		self.snapshotEvery = snapshotEvery_
+		self.snapshotPath = snapshotPath_
+		self.workers = workers_
+		self.refine = refine_
+		self.minRefineInliers = 10 #pairs with fewer RANSAC inliers are left out of the refinement
+		self.registrationSize = registrationSize_
+		self.outputScale = outputScale_
+		self.gsd = gsd_
+		self.fieldOfView = fieldOfView_
+		self.gpsAccuracy = gpsAccuracy_
+		self.frame = None #maps the frame of the first corrected image into the result canvas, see outputFrame()
+		self.refineSize = refineSize_
+		self.seamThreshold = seamThreshold_
+		self.interpolation = interpolation_
+		self.matcher = mt.createMatcher(matcher_) if isinstance(matcher_, str) else matcher_
+		self.correctedImages = ds.LRUCache(4)
+		#unRotations[i] removes the perspective distortion of image i, computed for all poses at once
+		self.unRotations = gm.unRotMatrices(self.dataMatrix[:,:6])
+		self.headingRotations = self.northRotations(headings_)
+		#correctionMatrices[i] maps native pixels of image i into corrected image i at registration scale
+		self.correctionMatrices = list(self.corrections(self.registrationSize)[0])
+		if isinstance(self.matcher, mt.PriorMatcher) and self.matcher.window is None:
+			self.matcher.window = self.priorWindow()
+		#pairTransforms[(i,j)] maps corrected image j into corrected image i. Filled by the registration stage.
+		self.pairTransforms = {}
+		self.pairMatches = {} #(index1, index2) -> (matches, inliers) of every registered pair
+		self.pairPoints = {} #(index1, index2) -> (points1, points2) inlier locations in corrected images, used by refinement
+		#transforms[i] maps corrected image i into the frame of the first corrected image.
+		#They are chained from the pair transforms, so every image is warped exactly once, straight into its place.
+		self.transforms = [np.eye(3)] + [None]*(self.imageCount-1)
+		if canvas_ is not None:
+			self.resultCanvas = canvas_
+		elif manifest_ is not None: #checkpoints of a dense canvas would write the whole mosaic after every image
+			self.resultCanvas = cv.TiledCanvas(os.path.join(manifest_.directory, "tiles"), blending=blending_)
+		else:
+			self.resultCanvas = cv.Canvas(blending=blending_)
+		self.manifest = manifest_
+		self.checkpointEvery = checkpointEvery_
+		self.composited = set() #indices of the images that are painted into the result canvas
+		self.profiler = profiler_
+		self.showMatches = showMatches_
+		self.matchesDirectory = matchesDirectory_
+		if self.matchesDirectory is not None and not os.path.isdir(self.matchesDirectory):
+			os.makedirs(self.matchesDirectory)
+
+	@property
+	def resultImage(self):
+		return self.resultCanvas.image()
+
+	@staticmethod
+	def imageScale(width, height, longSide):
+		'''
+		:param width: Width of the native image
+		:param height: Height of the native image
+		:param longSide: Desired size of the long side in pixels, or None for native resolution
+		:return: Scale factor, never above 1
+		'''
+		if longSide is None:
+			return 1.0
+		return min(1.0, float(longSide)/max(width, height))
+
+	def correction(self, index, longSide):
+		'''
+		Pose correction of an image, computed from its header only.
+		:param index: index of the image
+		:param longSide: Long side in pixels of the corrected image, or None for native resolution
+		:return: nativeToCorrected, downsampling, size (see geometry.correctionMatrix()) and the scale of the corrected image
+		'''
+		width, height = self.sourceImages.imageSize(index)
+		scale = self.imageScale(width, height, longSide)
+		C, S, size = gm.correctionMatrix(width, height, self.unRotations[index], scale)
+		return C, S, size, scale
+
+	def imageSizes(self):
+		'''
+		:return: Nx2 ndArray of (width, height) of every native image, read from the image headers
+		'''
+		return np.array([self.sourceImages.imageSize(i) for i in range(0, self.imageCount)], dtype=np.float64).reshape(-1, 2)
+
+	def corrections(self, longSide):
+		'''
+		correction() for all images at once.
+		:param longSide: Long side in pixels of the corrected images, or None for native resolution
+		:return: Nx3x3 nativeToCorrected and downsampling ndArrays, Nx2 sizes and N scales, see geometry.correctionMatrices()
+		'''
+		sizes = self.imageSizes()
+		scales = np.ones(self.imageCount) if longSide is None else np.minimum(1.0, float(longSide)/sizes.max(axis=1))
+		C, S, correctedSizes = gm.correctionMatrices(sizes, self.unRotations, scales)
+		return C, S, correctedSizes, scales
+
+	def correctedImage(self, index, longSide=None):
+		'''
+		:param index: index of the image
+		:param longSide: Long side in pixels before correction. Defaults to self.registrationSize.
+		:return: Downsampled image with its perspective distortion removed.
+			Perform a perspective transformation based on pose information.
+			Ideally, this will mnake each image look as if it's viewed from the top.
+			We assume the ground plane is perfectly flat.
+		'''
+		if longSide is None:
+			longSide = self.registrationSize
+		def compute():
+			C, S, size, scale = self.correction(index, longSide)
+			with pf.stage(self.profiler, "decode", index=index, scale=scale):
+				image = self.sourceImages.loadScaled(index, scale) #reduced decoding where possible
+			with pf.stage(self.profiler, "correct", index=index):
+				return gm.warpIntoRegion(image, gm.composeTransforms(np.linalg.inv(S), C), [0, 0, size[0], size[1]], self.interpolation)
+		return self.correctedImages.get((index, longSide), compute)
+
+	def imageFeatures(self, index):
+		'''
+		:param index: index of the image
+		:return: keypoint array and descriptors of the corrected image, computed at most once per image
+		'''
+		name = None if self.fileNames is None else self.fileNames[index]
+		return self.features.get(index, self.correctedImage, name, self.dataMatrix[index,:])
+
+	def northRotations(self, headings):
+		'''
+		:param headings: Camera heading of every image in degrees, NaN where unknown. If None, the yaw column of the pose data
+			is taken as the heading, unless it is all zero as written by getImagedata.to_poses().
+		:return: Nx2x2 ndArray, entry i rotates offsets in a north up corrected image into corrected image i. NaN where
+			the heading is unknown.
+		'''
+		if headings is None:
+			headings = self.dataMatrix[:,3] if np.any(self.dataMatrix[:,3] != 0) else np.full(self.imageCount, np.nan)
+		headings = np.array(headings, dtype=np.float64).reshape(-1)
+		northPoses = np.array(self.dataMatrix[:,:6], dtype=np.float64)
+		northPoses[:,3] = np.nan_to_num(headings)
+		#corrected images are rotated by the yaw of the pose data, the heading would make them north up
+		rotations = np.matmul(self.unRotations[:,:2,:2], np.linalg.inv(gm.unRotMatrices(northPoses)[:,:2,:2]))
+		rotations[np.isnan(headings)] = np.nan
+		return rotations
+
+	def expectedRotations(self):
+		'''
+		:return: Nx2 ndArray of the rotation [a, b] (see adjustment.similarityToMatrix()) of every corrected image in the
+			frame of the first one, following from the camera headings. NaN where a heading is unknown.
+		'''
+		known = ~np.isnan(self.headingRotations).any(axis=(1, 2))
+		rotations = np.full((self.imageCount, 2), np.nan)
+		if known[0]:
+			linear = np.matmul(self.headingRotations[0], np.linalg.inv(self.headingRotations[known]))
+			rotations[known] = np.column_stack(((linear[:,0,0] + linear[:,1,1])/2, (linear[:,1,0] - linear[:,0,1])/2))
+		return rotations
+
+	def priorWindow(self):
+		'''
+		Search window of the "prior" matcher at the GSD and size of the corrected images, see matching.gpsWindow().
+		:return: Window in pixels of the corrected images at registration scale
+		'''
+		sizes = self.imageSizes()
+		scales = self.corrections(self.registrationSize)[3]
+		longSides = sizes.max(axis=1)*scales
+		metersPerPixel = np.median(pr.footprintSizes(self.dataMatrix, self.fieldOfView)/(sizes[:,0]*scales))
+		if not metersPerPixel > 0: #no altitudes, the positions only roughly tell where the images are
+			return 0.25*np.median(longSides)
+		steps = np.linalg.norm(np.diff(self.dataMatrix[:,:2], axis=0), axis=1)
+		offset = np.median(steps)/metersPerPixel if len(steps) else 0.0
+		return mt.gpsWindow(self.gpsAccuracy, metersPerPixel, np.median(longSides), offset)
+
+	def priorOffset(self, pair):
+		'''
+		:param pair: (index1, index2)
+		:return: Centers of both corrected images and the offset of the camera positions in north up pixels of corrected
+			image index1, converted with the footprint estimated from altitude
+		'''
+		index1, index2 = pair
+		centers = []
+		for i in pair:
+			width, height = self.sourceImages.imageSize(i)
+			centers.append(fs.transformPoints([[width/2.0, height/2.0]], self.correctionMatrices[i])[0])
+		width = self.sourceImages.imageSize(index1)[0]
+		footprint = pr.footprintSizes(self.dataMatrix[[index1],:], self.fieldOfView)[0]
+		pixelsPerUnit = self.correction(index1, self.registrationSize)[3]*width/footprint if footprint > 0 else 0.0
+		offset = (self.dataMatrix[index2,:2] - self.dataMatrix[index1,:2])*[1,-1]*pixelsPerUnit #image y points south
+		return centers[0], centers[1], offset
+
+	def priorTransform(self, pair):
+		'''
+		Predicts a pair transform from the GPS positions and camera headings alone. The offset of the camera positions is
+		rotated into corrected image index1, and corrected image index2 is rotated by the difference of the headings.
+		:param pair: (index1, index2)
+		:return: 3x3 ndArray, approximately mapping corrected image index2 into corrected image index1. None if the
+			heading of either image is unknown, see priorRadius().
+		'''
+		rotation1, rotation2 = self.headingRotations[pair[0]], self.headingRotations[pair[1]]
+		if np.isnan(rotation1).any() or np.isnan(rotation2).any():
+			return None
+		center1, center2, offset = self.priorOffset(pair)
+		linear = np.dot(rotation1, np.linalg.inv(rotation2))
+		translation = center1 + np.dot(rotation1, offset) - np.dot(linear, center2)
+		return np.array(([linear[0,0],linear[0,1],translation[0]],[linear[1,0],linear[1,1],translation[1]],[0,0,1]))
+
+	def priorRadius(self, pair):
+		'''
+		Prior for pairs whose headings are unknown. Only the distance of the camera positions is then known, which does
+		not depend on how the images are rotated, see registration.radiusTest().
+		:param pair: (index1, index2)
+		:return: (center of corrected image index1, center of corrected image index2, distance of the centers in pixels)
+		'''
+		center1, center2, offset = self.priorOffset(pair)
+		return center1, center2, np.linalg.norm(offset)
+
+	def pairPriors(self, pairs):
+		'''
+		:param pairs: List of (index1, index2)
+		:return: Lists of the priorTransform() and, where it is None, the priorRadius() of every pair. Both are None
+			unless the "prior" matcher is used.
+		'''
+		if not isinstance(self.matcher, mt.PriorMatcher):
+			return [None]*len(pairs), [None]*len(pairs)
+		initialTransforms = [self.priorTransform(pair) for pair in pairs]
+		radii = [self.priorRadius(pair) if initial is None else None for pair, initial in zip(pairs, initialTransforms)]
+		return initialTransforms, radii
+
+	def storePair(self, pair, result, features=None, toRegistration1=None, toRegistration2=None):
+		'''
+		Keeps the registration result of one pair.
+		:param pair: (index1, index2)
+		:param result: (H, matches, inliers) from registration.registerPair()
+		:param features: Optional features.FeatureStore the result was computed with if it is not at registration scale.
+		:param toRegistration1: With features, 3x3 ndArray mapping the frame the result was computed in into corrected
+			image index1 at registration scale. toRegistration2 does the same for image index2.
+		:return:
+		'''
+		index1, index2 = pair
+		H, matches, inliers = result[:3]
+		if features is None:
+			features1 = self.imageFeatures(index1)[0]
+			features2 = self.imageFeatures(index2)[0]
+			self.pairMatches[pair] = (matches, inliers)
+		else:
+			if H is None:
+				return #keep the coarse result
+			features1 = features.features[index1][0]
+			features2 = features.features[index2][0]
+		points1, points2 = reg.inlierPoints(features1, features2, matches, inliers)
+		if features is not None:
+			H = np.dot(toRegistration1, np.dot(H, np.linalg.inv(toRegistration2)))
+			points1 = fs.transformPoints(points1, toRegistration1)
+			points2 = fs.transformPoints(points2, toRegistration2)
+		self.pairTransforms[pair] = H
+		self.pairPoints[pair] = (points1, points2)
+
+	def register(self):
+		'''
+		Registration stage. Detects features on all images, then registers image pairs, both on a process pool.
+		Pairs only need their two corrected images, so nothing here depends on the result canvas.
+		Consecutive pairs are always registered. With refinement enabled, pairs of GPS neighbours are registered as well.
+		Otherwise only the GPS neighbours of images whose consecutive pairs failed are, so computeTransforms() can still
+		place them.
+		:return: List of relative transforms. Entry i maps corrected image i into corrected image i-1.
+		'''
+		pairs = pr.consecutivePairs(self.imageCount)
+		if self.refine:
+			pairs = sorted(set(pairs) | set(pr.candidatePairs(self.dataMatrix, fieldOfView=self.fieldOfView)))
+		self.registerPairList(pairs)
+		unplaced = set(i for pair in pairs if self.pairTransforms.get(pair) is None for i in pair)
+		if unplaced and not self.refine:
+			self.registerPairList([pair for pair in pr.candidatePairs(self.dataMatrix, fieldOfView=self.fieldOfView) if unplaced.intersection(pair)])
+		return self.relativeTransforms()
+
+	def registerPairList(self, pairs):
+		'''
+		Detects the features of the images of the given pairs and registers the pairs that are not registered yet.
+		:param pairs: List of (index1, index2)
+		:return:
+		'''
+		pairs = [pair for pair in pairs if pair not in self.pairMatches]
+		if not pairs:
+			return
+		needed = sorted(set(i for pair in pairs for i in pair)) #images of finished pairs are not even loaded
+		#decoding and correcting the images are nested stages, detection is recorded per image by the process running it
+		with pf.stage(self.profiler, "features", images=len(needed)):
+			timings = self.features.computeAll(self.correctedImage, self.imageCount, self.fileNames, self.dataMatrix, self.workers, needed,
+			                                   self.profiler is not None)
+		self.recordDetections(self.features, timings)
+		featureList = dict((i, self.imageFeatures(i)) for i in needed)
+		initialTransforms, radii = self.pairPriors(pairs)
+		window = self.matcher.window if isinstance(self.matcher, mt.PriorMatcher) else None
+		with pf.stage(self.profiler, "register", pairs=len(pairs)):
+			results = reg.registerPairs(featureList, pairs, self.workers, initialTransforms, window, self.matcher, self.profiler is not None,
+			                            self.minInliers, radii)
+		for pair, result in zip(pairs, results):
+			self.storePair(pair, result)
+			if self.profiler is not None:
+				self.profiler.record("pair", index1=pair[0], index2=pair[1], matches=len(result[1]), inliers=int(np.sum(result[2])),
+				                     registered=result[0] is not None, match=result[3]["match"], ransac=result[3]["ransac"], registerCpu=result[3]["cpu"])
+		if self.refineSize is not None:
+			with pf.stage(self.profiler, "refinePairs"):
+				self.refinePairs([pair for pair in pairs if self.pairTransforms[pair] is not None])
+		if self.manifest is not None and len(pairs) > 0:
+			for pair in pairs:
+				matches, inliers = self.pairMatches[pair]
+				self.manifest.pairs[(self.imageName(pair[0]), self.imageName(pair[1]))] = (self.pairTransforms[pair], matches, inliers) + self.pairPoints[pair]
+			self.manifest.savePairs()
+
+	def recordDetections(self, featureStore, timings, **values):
+		'''
+		Adds a "detect" record per image to the profiler, with the wall and CPU time measured where it was detected.
+		:param featureStore: features.FeatureStore holding the detected features
+		:param timings: Dictionary of index -> timings from features.FeatureStore.computeAll()
+		:param values: Extra columns of the records
+		:return:
+		'''
+		if self.profiler is None:
+			return
+		for i in sorted(timings):
+			self.profiler.record("detect", index=i, keypoints=len(featureStore.features[i][0]), **dict(timings[i], **values))
+
+	def refinePairs(self, pairs):
+		'''
+		Refines pair transforms at the intermediate pyramid level self.refineSize. Features are detected again at that
+		level and matched only near the position predicted by the coarse transform.
+		:param pairs: List of (index1, index2) pairs with a coarse transform
+		:return:
+		'''
+		refineFeatures = fs.FeatureStore(self.detectorParams, self.features.cacheDirectory, self.refineSize)
+		loadImage = lambda index: self.correctedImage(index, self.refineSize)
+		needed = sorted(set(i for pair in pairs for i in pair))
+		timings = refineFeatures.computeAll(loadImage, self.imageCount, self.fileNames, self.dataMatrix, self.workers, needed, self.profiler is not None)
+		self.recordDetections(refineFeatures, timings, level=self.refineSize)
+		featureList = dict((i, refineFeatures.features[i]) for i in needed)
+		#maps corrected image at refine level into corrected image at registration scale
+		toRegistration = [np.dot(self.correctionMatrices[i], np.linalg.inv(self.correction(i, self.refineSize)[0])) for i in range(0, self.imageCount)]
+		initialTransforms = [np.dot(np.linalg.inv(toRegistration[i1]), np.dot(self.pairTransforms[(i1, i2)], toRegistration[i2])) for i1, i2 in pairs]
+		window = 4.0/np.sqrt(abs(np.linalg.det(toRegistration[0][:2,:2]))) #a few registration pixels
+		results = reg.registerPairs(featureList, pairs, self.workers, initialTransforms, window, mt.PriorMatcher(window, self.matcher.ratio),
+		                            minInliers=self.minInliers)
+		for (index1, index2), result in zip(pairs, results):
+			self.storePair((index1, index2), result, refineFeatures, toRegistration[index1], toRegistration[index2])
+
+	def relativeTransforms(self):
+		'''
+		:return: List of relative transforms. Entry i maps corrected image i into corrected image i-1, None if unknown.
+		'''
+		return [np.eye(3)] + [self.pairTransforms.get((i-1, i)) for i in range(1, self.imageCount)]
+
+	def computeTransforms(self):
+		'''
+		Computes the transform of every image into the result frame by composing the pairwise transforms along a spanning
+		tree over all registered pairs, see geometry.spanningTransforms().
+		With refinement enabled, they are then adjusted by least squares over all registered pairs.
+		:return: List of 3x3 ndArrays. Entry i maps corrected image i into the frame of the first corrected image.
+		'''
+		#images already painted into the canvas keep their transform
+		known = [self.transforms[i] if i == 0 or i in self.composited else None for i in range(0, self.imageCount)]
+		inlierCounts = dict((pair, int(np.sum(inliers))) for pair, (matches, inliers) in self.pairMatches.items())
+		self.transforms = gm.spanningTransforms(known, self.pairTransforms, inlierCounts)
+		for i in range(1, self.imageCount):
+			if self.transforms[i] is None:
+				raise RuntimeError("Could not register image "+str(i)+" against any image connected to image 0")
+		if self.refine:
+			pairPoints = {}
+			for pair, (points1, points2) in self.pairPoints.items():
+				if len(points1) >= self.minRefineInliers: #fewer inliers: unreliable pair, most likely no real overlap
+					pairPoints[pair] = (points1, points2)
+			self.transforms = adj.refineTransforms(self.transforms, pairPoints, [0] + sorted(self.composited), rotations=self.expectedRotations())
+		return self.transforms
+
+	def outputTransform(self, index):
+		'''
+		:param index: index of the image
+		:return: 3x3 ndArray mapping native pixels of the image into the result canvas at self.outputScale.
+			Unrotation, downsampling, the global transform and the output frame are folded into one matrix.
+		'''
+		return gm.composeTransforms(self.correctionMatrices[index], self.transforms[index], self.outputFrame())
+
+	def outputFrame(self):
+		'''
+		:return: 3x3 ndArray mapping the frame of the first corrected image at registration scale into the result canvas.
+			A plain scale by self.outputScale, or the world grid of georeferencedFrame() if a GSD is set.
+		'''
+		if self.frame is None:
+			registrationScale = self.correction(0, self.registrationSize)[1][0,0]
+			if self.gsd is None:
+				self.frame = gm.scaleMatrix(self.outputScale/registrationScale)
+			else:
+				self.frame = self.georeferencedFrame()
+				self.outputScale = np.sqrt(abs(np.linalg.det(self.frame[:2,:2])))*registrationScale #effective resolution, images are decoded at it
+		return self.frame
+
+	def georeferencedFrame(self):
+		'''
+		Places the mosaic into a world grid at self.gsd. Grid cell (x, y) covers east x*gsd to (x+1)*gsd and north -y*gsd
+		to -(y+1)*gsd in the ENU frame of the poses, so canvas coordinates are grid cells and the result is
+		georeferenced (see geotiff.writeGeoTiff()). Corrected images are only north up if the poses carry the camera
+		heading, so a similarity including rotation is fitted between the image centers in the mosaic and their ENU
+		positions. Least median of squares keeps single bad GPS fixes from moving the grid. If the positions are too
+		close together to fix a rotation, the scale follows from the altitudes like the footprints in priorOffset(), the
+		rotation from the heading of the first image if it is known, and the offset from the median of the centers.
+		:return: 3x3 ndArray mapping the frame of the first corrected image at registration scale into the world grid
+		'''
+		indices = [i for i in range(0, self.imageCount) if self.transforms[i] is not None]
+		sizes = self.imageSizes()[indices]
+		C, S, correctedSizes, scales = self.corrections(self.registrationSize)
+		transforms = np.array([self.transforms[i]/self.transforms[i][2,2] for i in indices]).reshape(-1, 3, 3)
+		toMosaic = np.matmul(transforms, C[indices])
+		centers = np.einsum("nij,nj->ni", toMosaic, np.column_stack((sizes/2.0, np.ones(len(indices)))))
+		centers = centers[:, :2]/centers[:, 2:]
+		targets = self.dataMatrix[indices,:2]*[1,-1]/self.gsd #image y points south
+		footprints = pr.footprintSizes(self.dataMatrix[indices,:], self.fieldOfView)
+		#the GPS baseline has to be longer than a footprint, or its noise decides the rotation
+		if len(indices) > 1 and np.linalg.norm(targets - targets.mean(axis=0), axis=1).max() > np.median(footprints)/self.gsd:
+			similarity = cv2.estimateAffinePartial2D(np.float64(centers), np.float64(targets), method=cv2.LMEDS)[0]
+			if similarity is not None:
+				return np.vstack((similarity, [0,0,1]))
+		#meters per pixel of every image in the mosaic frame: its footprint over its width, undone by its relative scale
+		relativeScales = np.sqrt(np.abs(np.linalg.det(transforms[:, :2, :2])))
+		scale = np.median(footprints/(sizes[:,0]*scales[indices])/relativeScales)/self.gsd
+		rotation = self.headingRotations[0]
+		linear = scale*(np.eye(2) if np.isnan(rotation).any() else np.linalg.inv(rotation))
+		offset = np.median(targets - np.einsum("ij,nj->ni", linear, centers), axis=0)
+		return np.array(([linear[0,0],linear[0,1],offset[0]],[linear[1,0],linear[1,1],offset[1]],[0,0,1]))
+
+	def outputTransforms(self):
+		'''
+		outputTransform() of every image as one stack. Images without a transform yet are left out.
+		:return: (indices, Kx3x3 ndArray) of the images whose transform is known
+		'''
+		indices = [i for i in range(0, self.imageCount) if self.transforms[i] is not None]
+		stack = np.matmul(self.outputFrame(), np.matmul(np.array([self.transforms[i] for i in indices]).reshape(-1, 3, 3),
+		                                      np.array([self.correctionMatrices[i] for i in indices]).reshape(-1, 3, 3)))
+		return indices, stack
+
+	def mosaicBounds(self):
+		'''
+		Projects the footprints of all images into the result canvas at once, before any pixels are warped.
+		:return: [xMin, yMin, xMax, yMax] extent of the mosaic in canvas coordinates, None if no transform is known
+		'''
+		indices, stack = self.outputTransforms()
+		if not indices:
+			return None
+		return gm.cornerBounds(gm.projectFootprints(self.imageSizes()[indices], stack))
+
+	def imageName(self, index):
+		'''
+		:return: Name identifying the image in the job manifest, its file name if known
+		'''
+		return str(index) if self.fileNames is None else self.fileNames[index]
+
+	def restoreJob(self):
+		'''
+		Loads the state of an earlier run from the manifest: registered pairs, the transforms of the composited images
+		and the canvas they were painted into. Images that are not in the manifest yet are treated as new.
+		:return:
+		'''
+		self.manifest.load()
+		#the mosaic frame is the first image at registration scale, so these must not change within a job
+		self.manifest.checkSettings({"reference": self.imageName(0), "registrationSize": self.registrationSize,
+		                             "outputScale": self.outputScale, "refineSize": self.refineSize, "gsd": self.gsd,
+		                             "detector": self.detectorParams})
+		indices = dict((self.imageName(i), i) for i in range(0, self.imageCount))
+		for (name1, name2), (H, matches, inliers, points1, points2) in self.manifest.pairs.items():
+			if name1 in indices and name2 in indices:
+				pair = (indices[name1], indices[name2])
+				self.pairTransforms[pair] = H
+				self.pairMatches[pair] = (matches, inliers)
+				self.pairPoints[pair] = (points1, points2)
+		for name, i in indices.items():
+			if self.manifest.status(name) == mf.COMPOSITED and self.manifest.transform(name) is not None:
+				self.transforms[i] = self.manifest.transform(name)
+				self.composited.add(i)
+		if self.manifest.canvas is not None and self.composited:
+			self.resultCanvas.restoreState(self.manifest.canvas, self.manifest.directory)
+		if self.manifest.frame is not None and self.composited: #appended images must land in the same grid
+			self.frame = np.array(self.manifest.frame)
+			if self.gsd is not None:
+				self.outputScale = np.sqrt(abs(np.linalg.det(self.frame[:2,:2])))*self.correction(0, self.registrationSize)[1][0,0]
+
+	def checkpoint(self):
+		'''
+		Saves the status and transform of every image and the canvas state into the manifest.
+		:return:
+		'''
+		for i in range(0, self.imageCount):
+			status = mf.COMPOSITED if i in self.composited else (mf.PENDING if self.transforms[i] is None else mf.REGISTERED)
+			self.manifest.setImage(self.imageName(i), status, self.transforms[i])
+		self.manifest.canvas = self.resultCanvas.saveState(self.manifest.directory)
+		self.manifest.frame = None if self.frame is None else self.frame.tolist()
+		self.manifest.save()
+
+	def createMosaic(self, result=True):
+		'''
+		:param result: Return the mosaic as one image. Pass False if it is written from the canvas tile by tile instead,
+			e.g. with geotiff.writeGeoTiff(), so the full mosaic never has to fit into memory.
+		:return: Result ndArray image, or None
+		'''
+		if self.manifest is not None:
+			self.restoreJob()
+		self.register()
+		with pf.stage(self.profiler, "transforms"):
+			self.computeTransforms()
+		with pf.stage(self.profiler, "extent") as record:
+			bounds = self.mosaicBounds()
+			if bounds is not None:
+				self.resultCanvas.reserve(bounds) #allocated once at its final size instead of growing image by image
+				record["canvasWidth"], record["canvasHeight"] = bounds[2] - bounds[0], bounds[3] - bounds[1]
+		for i in range(0,self.imageCount):
+			if i in self.composited:
+				continue
+			with pf.stage(self.profiler, "combine", index=i) as record:
+				self.combine(i)
+				bounds = self.resultCanvas.bounds
+				record["canvasWidth"], record["canvasHeight"] = bounds[2] - bounds[0], bounds[3] - bounds[1]
+			self.composited.add(i)
 			print("Processing photo "+str(i))
-		return self.resultImage
+			if self.snapshotEvery > 0 and i > 0 and i % self.snapshotEvery == 0:
+				with pf.stage(self.profiler, "write", index=i):
+					self.resultCanvas.save(self.snapshotPath)
+			if self.manifest is not None and self.checkpointEvery > 0 and len(self.composited) % self.checkpointEvery == 0:
+				self.checkpoint()
+		if self.manifest is not None:
+			self.checkpoint()
+		return self.resultImage if result else None
 
 	def combine(self, index2):
-		self.resultImage = cv2.imread("results/intermediateResult.png")
-		'''
-		:param index2: index of self.imageList and self.kpList to combine with self.referenceImage and self.referenceKeypoints
-		:return: combination of reference image and image at index 2
-		'''
-
-		#Attempt to combine one pair of images at each step. Assume the order in which the images are given is the best order.
-		#This intorduces drift!
-		image1 = copy.copy(self.imageList[index2 - 1])
-		image2 = copy.copy(self.imageList[index2])
-
-		'''
-		Descriptor computation and matching.
-		Idea: Align the images by aligning features.
-		'''
-		# detector = cv2.SURF(500) #SURF showed best results
-		detector = cv2.ORB_create() #SURF showed best results
-
-		# detector.extended = True
-		gray1 = cv2.cvtColor(image1,cv2.COLOR_BGR2GRAY)
-		# gray1 = cv2.cvtColor(self.resultImage,cv2.COLOR_BGR2GRAY)
-		ret1, mask1 = cv2.threshold(gray1,1,255,cv2.THRESH_BINARY)
-		kp1, descriptors1 = detector.detectAndCompute(gray1,mask1) #kp = keypoints
-
-		gray2 = cv2.cvtColor(image2,cv2.COLOR_BGR2GRAY)
-		ret2, mask2 = cv2.threshold(gray2,1,255,cv2.THRESH_BINARY)
-		kp2, descriptors2 = detector.detectAndCompute(gray2,mask2)
-
-		#Visualize matching procedure.
-		# keypoints1Im = self.resultImage.copy()
-		# keypoints2Im = image2.copy()
-		# cv2.drawKeypoints(self.resultImage, kp1, keypoints1Im,color=(0,0,255))
-		# util.display("KEYPOINTS1",keypoints1Im)
-		# cv2.drawKeypoints(image2,kp2,keypoints2Im,color=(0,0,255))
-		# util.display("KEYPOINTS2",keypoints2Im)
-
-		matcher = cv2.BFMatcher() #use brute force matching
-		matches = matcher.knnMatch(descriptors2,descriptors1, k=2) #find pairs of nearest matches
-		#prune bad matches
-		good = []
-		for m,n in matches:
-			if m.distance < 0.55*n.distance:
-				good.append(m)
-		matches = copy.copy(good)
-
-		#Visualize matches
-		matchDrawing = util.drawMatches(gray2,kp2,gray1,kp1,matches)
-		util.display("matches",matchDrawing)
-
-		#NumPy syntax for extracting location data from match data structure in matrix form
-		src_pts = np.float32([ kp2[m.queryIdx].pt for m in matches ]).reshape(-1,1,2)
-		dst_pts = np.float32([ kp1[m.trainIdx].pt for m in matches ]).reshape(-1,1,2)
-
-		'''
-		Compute Affine Transform
-		Idea: Because we corrected for camera orientation, an affine transformation *should* be enough to align the images
-		'''
-		#Deprecated --stephen
-		# A = cv2.estimateRigidTransform(src_pts,dst_pts,fullAffine=False) #false because we only want 5 DOF. we removed 3 DOF when we unrotated
-		A, inliers = cv2.estimateAffinePartial2D(src_pts,dst_pts) #false because we only want 5 DOF. we removed 3 DOF when we unrotated
-		if type(A) == type(None) : #RANSAC sometimes fails in estimateRigidTransform(). If so, try full homography. OpenCV RANSAC implementation for homography is more robust.
-		# if A.size == 0: #RANSAC sometimes fails in estimateRigidTransform(). If so, try full homography. OpenCV RANSAC implementation for homography is more robust.
-			HomogResult = cv2.findHomography(src_pts,dst_pts,method=cv2.RANSAC)
-			H = HomogResult[0]
-
-		'''
-		Compute 4 Image Corners Locations
-		Idea: Same process as warpPerspectiveWithPadding() excewpt we have to consider the sizes of two images. Might be cleaner as a function.
-		'''
-		height1,width1 = image1.shape[:2]
-		height2,width2 = image2.shape[:2]
-		corners1 = np.float32(([0,0],[0,height1],[width1,height1],[width1,0]))
-		corners2 = np.float32(([0,0],[0,height2],[width2,height2],[width2,0]))
-		warpedCorners2 = np.zeros((4,2))
-		for i in range(0,4):
-			cornerX = corners2[i,0]
-			cornerY = corners2[i,1]
-			# if A != None: #check if we're working with affine transform or perspective transform
-			if type(A) == type(None) : #RANSAC sometimes fails in estimateRigidTransform(). If so, try full homography. OpenCV RANSAC implementation for homography is more robust.
-				warpedCorners2[i,0] = (H[0,0]*cornerX + H[0,1]*cornerY + H[0,2])/(H[2,0]*cornerX + H[2,1]*cornerY + H[2,2])
-				warpedCorners2[i,1] = (H[1,0]*cornerX + H[1,1]*cornerY + H[1,2])/(H[2,0]*cornerX + H[2,1]*cornerY + H[2,2])
-			else:
-				warpedCorners2[i][0] = A[0][0]*cornerX + A[0][1]*cornerY + A[0][2]
-				warpedCorners2[i][1] = A[1][0]*cornerX + A[1][1]*cornerY + A[1][2]
-		allCorners = np.concatenate((corners1, warpedCorners2), axis=0)
-		[xMin, yMin] = np.int32(allCorners.min(axis=0).ravel() - 0.5)
-		[xMax, yMax] = np.int32(allCorners.max(axis=0).ravel() + 0.5)
-
-		'''Compute Image Alignment and Keypoint Alignment'''
-		translation = np.float32(([1,0,-1*xMin],[0,1,-1*yMin],[0,0,1]))
-		warpedResImg = cv2.warpPerspective(self.resultImage, translation, (xMax-xMin, yMax-yMin))
-		# cv2.imwrite("results/warpedResImg.png",warpedResImg)
-		if type(A) == type(None) : #RANSAC sometimes fails in estimateRigidTransform(). If so, try full homography. OpenCV RANSAC implementation for homography is more robust.
-		# if A.size == 0:
-			fullTransformation = np.dot(translation,H) #again, images must be translated to be 100% visible in new canvas
-			warpedImage2 = cv2.warpPerspective(image2, fullTransformation, (xMax-xMin, yMax-yMin))
-		else:
-			warpedImageTemp = cv2.warpPerspective(image2, translation, (xMax-xMin, yMax-yMin))
-			warpedImage2 = cv2.warpAffine(warpedImageTemp, A, (xMax-xMin, yMax-yMin))
-		self.imageList[index2] = copy.copy(warpedImage2) #crucial: update old images for future feature extractions
-
-		# result = cv2.addWeighted(warpedResImg, 0, warpedImage2, 1, 0.0)
-		# util.display("tempResult", result)
-
-		# resGray = cv2.cvtColor(self.resultImage,cv2.COLOR_BGR2GRAY)
-		# warpedResGray = cv2.warpPerspective(resGray, translation, (xMax-xMin, yMax-yMin))
-
-		# warpedImage2Resize = cv2.resize(warpedImage2, (warpedImage2.shape[1]+1, warpedImage2.shape[0]+1), 0, 0, cv2.INTER_AREA)
-		warpedImg2Gray = cv2.cvtColor(warpedImage2, cv2.COLOR_BGR2GRAY)
-		# warpedImg2Gray = cv2.blur(warpedImg2Gray, (8,8))
-		# util.display("blur", warpedImg2Gray)
-
-		'''Compute Mask for Image Combination'''
-		# ret, mask1 = cv2.threshold(warpedResGray,1,255,cv2.THRESH_BINARY_INV)
-		ret, mask1 = cv2.threshold(warpedImg2Gray, 1, 255, cv2.THRESH_BINARY_INV)
-		mask3 = np.float32(mask1)/255
-
-		#apply mask
-		# tmpRow = warpedImage2Resize.shape[0]
-		# tmpCol = warpedImage2Resize.shape[1]
-		# warpedResImgcp = copy.copy(warpedResImg)
-		warpedResImg[:,:,0] = warpedResImg[:,:,0] * mask3
-		warpedResImg[:,:,1] = warpedResImg[:,:,1] * mask3
-		warpedResImg[:,:,2] = warpedResImg[:,:,2] * mask3
-		# warpedResImg[:tmpRow,:tmpCol,0] = warpedResImg[:tmpRow,:tmpCol,0] * mask3
-		# warpedResImg[:tmpRow,:tmpCol,1] = warpedResImg[:tmpRow,:tmpCol,1] * mask3
-		# warpedResImg[:tmpRow,:tmpCol,2] = warpedResImg[:tmpRow,:tmpCol,2] * mask3
-		# util.display("after mask", warpedResImg)
-
-		result = warpedResImg + warpedImage2
-
-		#Remove black line
-		# resultGray = cv2.cvtColor(result, cv2.COLOR_BGR2GRAY)
-		# ret, mask4 = cv2.threshold(resultGray, 25, 255, cv2.THRESH_BINARY_INV)
-		# util.display("resultGray", mask4)
-
-		# mask5 = np.float32(mask4)/255
-
-		# util.display("warpedResImgcp origin", warpedResImgcp)
-		# warpedResImgcp[:,:,0] = warpedResImgcp[:,:,0] * mask5
-		# warpedResImgcp[:,:,1] = warpedResImgcp[:,:,1] * mask5
-		# warpedResImgcp[:,:,2] = warpedResImgcp[:,:,2] * mask5
-		# util.display("warpedResImgcp", warpedResImgcp)
-
-		# util.display("result1",result)
-		# result = result + warpedResImgcp
-
-		#visualize and save result
-		self.resultImage = result
-		# util.display("result2",result)
-
-		cv2.imwrite("results/intermediateResult.png",result)
-		return result
+		'''
+		:param index2: index of the image to combine with the result canvas
+		:return: [xMin, yMin, xMax, yMax] region of the result canvas that was updated
+		'''
+		if self.transforms[index2] is None: #transforms were not computed by computeTransforms(), chain from the previous image
+			pair = (index2 - 1, index2)
+			if pair not in self.pairTransforms:
+				kpArray1, descriptors1 = self.imageFeatures(index2 - 1)
+				kpArray2, descriptors2 = self.imageFeatures(index2)
+				initial, radius = [prior[0] for prior in self.pairPriors([pair])]
+				window = self.matcher.window if isinstance(self.matcher, mt.PriorMatcher) else None
+				self.storePair(pair, reg.registerPair(kpArray1, descriptors1, kpArray2, descriptors2, initial, window, self.matcher,
+				                                      minInliers=self.minInliers, radius=radius))
+			if self.pairTransforms[pair] is None or self.transforms[index2 - 1] is None:
+				raise RuntimeError("Could not register image "+str(index2)+" against image "+str(index2 - 1))
+			self.transforms[index2] = np.dot(self.transforms[index2 - 1], self.pairTransforms[pair])
 
+		if index2 > 0 and (self.showMatches or self.matchesDirectory is not None):
+			#Visualize matches
+			matches, inliers = self.pairMatches[(index2 - 1, index2)]
+			gray1 = cv2.cvtColor(self.correctedImage(index2 - 1),cv2.COLOR_BGR2GRAY)
+			gray2 = cv2.cvtColor(self.correctedImage(index2),cv2.COLOR_BGR2GRAY)
+			kp1 = fs.arrayToKeypoints(self.imageFeatures(index2 - 1)[0])
+			kp2 = fs.arrayToKeypoints(self.imageFeatures(index2)[0])
+			matchDrawing = util.drawMatches(gray2,kp2,gray1,kp1,[cv2.DMatch(int(q),int(t),0) for q,t in matches])
+			if self.matchesDirectory is not None:
+				cv2.imwrite(os.path.join(self.matchesDirectory, "matches_%04d.png" % index2), matchDrawing)
+			if self.showMatches:
+				util.display("matches",matchDrawing)
+
+		'''
+		Compute Image Alignment
+		Idea: The canvas keeps the frame of the first image, so the image is warped once, straight into its final place.
+		Unrotation, the global transform, the output scale and the canvas offset are one matrix and only the destination
+		rectangle is resampled.
+		Growing the canvas only changes its offset and only the bounding box of the new image is blended.
+		The native image is decoded at reduced size and area-downsampled if the output resolution is lower.
+		Black seams left by the warped border are repaired inside the blended region only.
+		'''
+		transformation = self.outputTransform(index2)
+		if self.outputScale < 1.0:
+			width, height = self.sourceImages.imageSize(index2)
+			C, S, size = gm.correctionMatrix(width, height, np.eye(3), self.outputScale)
+			transformation = gm.composeTransforms(np.linalg.inv(S), transformation)
+		with pf.stage(self.profiler, "decode", index=index2, scale=min(self.outputScale, 1.0)):
+			image = self.sourceImages.loadScaled(index2, min(self.outputScale, 1.0))
+		return self.resultCanvas.paste(image, transformation, self.seamThreshold, self.interpolation, self.profiler)
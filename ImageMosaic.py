@@ -1,34 +1,161 @@
 '''
 Driver script. Execute this to perform the mosaic procedure.
+
+    python ImageMosaic.py metadata datasets/images --output datasets/imageData.txt
+    python ImageMosaic.py mosaic --data datasets/imageData.txt --images datasets/images/ --output results/finalResult.png
+    python ImageMosaic.py run datasets/images --output results/finalResult.png
+    python ImageMosaic.py run datasets/images --gsd 0.05 --output results/orthomosaic.tif
+
+"run" reads the image metadata and builds the mosaic in one process. Nothing is shown on screen unless --show or
+--show-matches is given, so the driver also runs unattended on machines without a display.
+An output ending in .tif is written as a tiled, compressed GeoTIFF with overviews, one row of tiles at a time.
+With --gsd it is georeferenced in a fixed world grid.
 '''
 
+import os
+import shutil
+import tempfile
+import argparse
 import utilities as util
 import Combiner
+import canvas
+import manifest
+import getImagedata
+import features
+import geotiff
+import profiling
 import cv2
 
-fileName = "datasets/imageData.txt"
-imageDirectory = "datasets/images/"
-allImages, dataMatrix = util.importData(fileName, imageDirectory)
-myCombiner = Combiner.Combiner(allImages, dataMatrix)
-result = myCombiner.createMosaic()
-util.display("RESULT", result)
-cv2.imwrite("results/finalResult.png", result)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
 
+def addMetadataArguments(parser):
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes, all cores by default")
+
+def addMosaicArguments(parser):
+    parser.add_argument("--output", default="results/finalResult.png", help="result image path, a .tif is written as a tiled GeoTIFF with overviews")
+    parser.add_argument("--scale", type=float, default=1.0, help="resolution of the mosaic relative to the input images")
+    parser.add_argument("--gsd", type=float, default=None, help="place the mosaic into a fixed north-up world grid with this many meters per pixel, fitted to the GPS positions. Overrides --scale")
+    parser.add_argument("--field-of-view", type=float, default=73.7, help="horizontal field of view of the camera in degrees, used to estimate image footprints from the altitude")
+    parser.add_argument("--registration-size", type=int, default=1000, help="long side in pixels of the images used for registration")
+    parser.add_argument("--refine-size", type=int, default=None, help="long side of an intermediate level at which pair transforms are refined")
+    parser.add_argument("--refine", action="store_true", help="least-squares refinement over consecutive pairs and GPS neighbours, reduces drift")
+    parser.add_argument("--matcher", default="bruteforce", choices=["bruteforce", "flann", "prior"], help="feature matcher backend")
+    parser.add_argument("--gps-accuracy", type=float, default=2.0, help="horizontal GPS accuracy in meters, sets the search window of the prior matcher")
+    parser.add_argument("--detector", default="orb", choices=features.availableDetectors(), help="feature detector, SIFT is slower but more accurate")
+    parser.add_argument("--keypoints", type=int, default=None, help="keypoint budget per image, spread evenly over the image, bounds the matching cost of every pair")
+    parser.add_argument("--grid", type=int, default=8, help="cells along the long side of the image over which the keypoint budget is spread")
+    parser.add_argument("--min-inliers", type=int, default=None, help="accept a pair transform as soon as it has this many RANSAC inliers among the best matches")
+    parser.add_argument("--blending", default="overwrite", choices=["overwrite", "feather", "multiband"], help="blending of overlapping images")
+    parser.add_argument("--feature-cache", default="results/features/", help="directory where features are reused between runs, '' disables it")
+    parser.add_argument("--tile-dir", default=None, help="paint the mosaic into tiles on disk in this directory, so memory stays bounded for large surveys. Tiles are always used with --job or a .tif output")
+    parser.add_argument("--job", default=None, help="job directory that makes the run resumable and adds appended images incrementally")
+    parser.add_argument("--snapshot-every", type=int, default=0, help="write an intermediate result every N images, 0 disables it")
+    parser.add_argument("--matches-dir", default=None, help="directory where the matches of every consecutive pair are drawn")
+    parser.add_argument("--show-matches", action="store_true", help="show the matches of every pair in a window and wait for a key")
+    parser.add_argument("--show", action="store_true", help="show the result in a window and wait for a key")
+    parser.add_argument("--profile", default=None, help="write per-stage timings, peak memory and match counts to PROFILE.json and PROFILE.csv. Stage CPU times "
+                        "exclude worker processes, detection and registration are timed per image and pair inside the workers")
+    parser.add_argument("--cprofile", default=None, help="write a cProfile dump of the mosaic run to this file")
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Orthomosaic generator.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    metadata = subparsers.add_parser("metadata", help="read image positions and orientations into a pose data file")
+    metadata.add_argument("images", nargs="?", default="datasets/images", help="directory with the images")
+    metadata.add_argument("--output", default="datasets/imageData.txt", help="pose data file, a .npz pose index is written next to it")
+    addMetadataArguments(metadata)
+    mosaic = subparsers.add_parser("mosaic", help="build the mosaic from a pose data file")
+    mosaic.add_argument("--data", default="datasets/imageData.txt", help="pose data file")
+    mosaic.add_argument("--images", default="datasets/images/", help="directory with the images")
+    addMetadataArguments(mosaic)
+    addMosaicArguments(mosaic)
+    run = subparsers.add_parser("run", help="read the image metadata, then build the mosaic")
+    run.add_argument("images", nargs="?", default="datasets/images", help="directory with the images")
+    run.add_argument("--data", default=None, help="pose data file to write, imageData.txt next to the image directory by default")
+    addMetadataArguments(run)
+    addMosaicArguments(run)
+    return parser.parse_args(argv)
+
+def ensureDirectory(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+def poseFile(data):
+    '''
+    :param data: Pose data file e.g. "datasets/imageData.txt"
+    :return: The binary pose index written next to it by the metadata step if it is up to date, so no text is parsed,
+        otherwise the file itself
+    '''
+    index = os.path.splitext(data)[0] + ".npz"
+    if data != index and os.path.isfile(index) and (not os.path.isfile(data) or os.path.getmtime(index) >= os.path.getmtime(data)):
+        return index
+    return data
+
+def createMosaic(args):
+    '''
+    :param args: Parsed "mosaic" or "run" arguments
+    :return: Result ndArray image, None if it was written as a GeoTIFF
+    '''
+    ensureDirectory(args.output)
+    allImages, dataMatrix = util.importData(poseFile(args.data), args.images)
+    fileNames = allImages.fileNames
+    tiff = os.path.splitext(args.output)[1].lower() in (".tif", ".tiff")
+    temporaryTiles = None
+    if args.tile_dir is not None:
+        tileDirectory = args.tile_dir
+    elif args.job is not None:
+        tileDirectory = os.path.join(args.job, "tiles")
+    elif tiff: #a GeoTIFF is streamed from the tiles, so the mosaic is never held in memory as a whole
+        tileDirectory = temporaryTiles = tempfile.mkdtemp(prefix="mosaicTiles", dir=os.path.dirname(args.output) or None)
+    else:
+        tileDirectory = None
+    jobCanvas = None if tileDirectory is None else canvas.TiledCanvas(tileDirectory, blending=args.blending)
+    jobManifest = None if args.job is None else manifest.JobManifest(args.job)
+    snapshotPath = os.path.join(os.path.dirname(args.output), "intermediateResult.png")
+    profiler = profiling.Profiler(args.cprofile) if args.profile or args.cprofile else None
+    if profiler is not None:
+        profiler.start()
+    try:
+        myCombiner = Combiner.Combiner(allImages, dataMatrix, fileNames, featureCache_=args.feature_cache or None,
+                                       snapshotEvery_=args.snapshot_every, snapshotPath_=snapshotPath, canvas_=jobCanvas, workers_=args.workers, refine_=args.refine, registrationSize_=args.registration_size,
+                                       outputScale_=args.scale, refineSize_=args.refine_size, matcher_=args.matcher, blending_=args.blending,
+                                       manifest_=jobManifest, showMatches_=args.show_matches, matchesDirectory_=args.matches_dir, profiler_=profiler,
+                                       gsd_=args.gsd, detector_=args.detector, keypointBudget_=args.keypoints, gridSize_=args.grid,
+                                       minInliers_=args.min_inliers, headings_=util.importHeadings(args.data, fileNames),
+                                       fieldOfView_=args.field_of_view, gpsAccuracy_=args.gps_accuracy)
+        result = myCombiner.createMosaic(result=not tiff)
+        with profiling.stage(profiler, "write"):
+            if tiff:
+                resultCanvas = myCombiner.resultCanvas
+                geotiff.writeGeoTiff(args.output, resultCanvas.readRegion, resultCanvas.bounds, args.gsd, util.importOrigin(args.data))
+            else:
+                cv2.imwrite(args.output, result)
+        if profiler is not None:
+            profiler.stop()
+            if args.profile:
+                profiler.write(args.profile)
+        if args.show:
+            util.display("RESULT", myCombiner.resultImage if result is None else result)
+    finally:
+        if temporaryTiles is not None:
+            shutil.rmtree(temporaryTiles)
+    return result
+
+def main(argv=None):
+    args = parseArguments(argv)
+    if args.command == "metadata":
+        ensureDirectory(args.output)
+        getImagedata.main(args.images, args.output, args.workers)
+    elif args.command == "mosaic":
+        createMosaic(args)
+    else:
+        if args.data is None:
+            args.data = os.path.join(os.path.dirname(os.path.normpath(args.images)), "imageData.txt")
+        ensureDirectory(args.data)
+        getImagedata.main(args.images, args.data, args.workers)
+        createMosaic(args)
+
+
+if __name__ == "__main__":  # worker processes import this module, so only the main process may run the pipeline
+    main()
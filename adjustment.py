@@ -0,0 +1,94 @@
+import numpy as np
+
+
+def similarityRows(points):
+    '''
+    Rows of the linear system for a similarity transform [[a,-b,tx],[b,a,ty]] applied to points, unknowns [a,b,tx,ty].
+    :param points: Kx2 ndArray of pixel locations
+    :return: 2Kx4 ndArray. Even rows give x, odd rows give y.
+    '''
+    x = points[:, 0]
+    y = points[:, 1]
+    ones = np.ones(len(points))
+    zeros = np.zeros(len(points))
+    rows = np.empty((2*len(points), 4))
+    rows[0::2] = np.column_stack((x, -y, ones, zeros))
+    rows[1::2] = np.column_stack((y, x, zeros, ones))
+    return rows
+
+def similarityToMatrix(parameters):
+    '''
+    :param parameters: [a,b,tx,ty]
+    :return: 3x3 ndArray [[a,-b,tx],[b,a,ty],[0,0,1]]
+    '''
+    a, b, tx, ty = parameters
+    return np.array(([a, -b, tx], [b, a, ty], [0, 0, 1]))
+
+def matrixToSimilarity(transformation):
+    '''
+    :param transformation: 3x3 ndArray. Perspective and shear terms are dropped.
+    :return: [a,b,tx,ty] of the closest similarity transform
+    '''
+    H = transformation/transformation[2, 2]
+    a = (H[0, 0] + H[1, 1])/2
+    b = (H[1, 0] - H[0, 1])/2
+    return np.array([a, b, H[0, 2], H[1, 2]])
+
+def refineTransforms(transforms, pairPoints, fixedIndex=0, priorWeight=1e-6, rotations=None):
+    '''
+    Bundle-style least-squares refinement of the global transforms over all pairwise match sets.
+    Every image gets a similarity transform into the frame of fixedIndex, chosen so that matched points land on top of
+    each other in the mosaic. The model is linear in [a,b,tx,ty], so the normal equations are solved directly.
+    :param transforms: List of initial 3x3 ndArrays mapping each image into the mosaic, e.g. chained pair transforms
+    :param pairPoints: Dictionary (index1, index2) -> (points1, points2) of inlier matches, Kx2 ndArrays in image coordinates
+    :param fixedIndex: Image whose transform is kept as it is. It defines the mosaic frame. A list of indices keeps
+        several images fixed, e.g. the ones that are already composited.
+    :param priorWeight: Relative weight pulling every image towards its initial transform, so images without matches stay put.
+    :param rotations: Optional Nx2 ndArray of the [a,b] rotation every image is expected to have in the mosaic, e.g. from
+        the camera headings, NaN where it is unknown.
+    :return: List of refined 3x3 ndArrays
+    '''
+    count = len(transforms)
+    normalMatrix = np.zeros((4*count, 4*count))
+    normalVector = np.zeros(4*count)
+    for (index1, index2), (points1, points2) in pairPoints.items():
+        if len(points1) == 0:
+            continue
+        #residual S2(points2) - S1(points1) with unknowns [S1, S2]
+        J = np.hstack((-1*similarityRows(np.float64(points1)), similarityRows(np.float64(points2))))
+        JtJ = np.dot(J.T, J)
+        blocks = np.r_[4*index1:4*index1+4, 4*index2:4*index2+4]
+        normalMatrix[np.ix_(blocks, blocks)] += JtJ
+    initial = np.concatenate([matrixToSimilarity(T) for T in transforms])
+    #the prior is relative to each unknown's own curvature, so it only matters where the matches say nothing
+    prior = priorWeight*np.maximum(np.diag(normalMatrix), 1.0)
+    normalMatrix += np.diag(prior)
+    normalVector += prior*initial
+    #keep the reference image fixed by replacing its equations
+    fixedImages = np.atleast_1d(fixedIndex)
+    fixed = np.concatenate([np.r_[4*i:4*i+4] for i in fixedImages])
+    normalMatrix[fixed, :] = 0
+    normalMatrix[fixed, fixed] = 1
+    normalVector[fixed] = initial[fixed]
+    #residuals are measured in mosaic pixels, so shrinking every free image towards the fixed ones lowers the cost
+    #without aligning anything better. The mean a and b of the free images, measured along and across their expected
+    #rotation, are held at the scale of the fixed images and at no rotation, which removes that mode. Corrected images
+    #share the scale of the mosaic on average. If their rotations are not known, only the scale is held, along the
+    #rotation of the initial transforms.
+    free = np.setdiff1d(np.arange(count), fixedImages)
+    if len(free) > 1:
+        known = rotations is not None and not np.isnan(np.float64(rotations)[free]).any()
+        directions = np.float64(rotations)[free] if known else initial.reshape(-1, 4)[free, :2]
+        directions = directions/np.maximum(np.linalg.norm(directions, axis=1), 1e-12)[:, np.newaxis]
+        constraints = np.zeros((2 if known else 1, 4*count))
+        constraints[0, 4*free] = directions[:, 0]/len(free)
+        constraints[0, 4*free+1] = directions[:, 1]/len(free)
+        if known:
+            constraints[1, 4*free] = -1*directions[:, 1]/len(free)
+            constraints[1, 4*free+1] = directions[:, 0]/len(free)
+        reference = [np.mean(np.linalg.norm(initial.reshape(-1, 4)[fixedImages, :2], axis=1)), 0.0][:len(constraints)]
+        scale = np.mean(np.diag(normalMatrix)[4*free])
+        normalMatrix = np.block([[normalMatrix, scale*constraints.T], [scale*constraints, np.zeros((len(constraints), len(constraints)))]])
+        normalVector = np.concatenate((normalVector, scale*np.array(reference)))
+    parameters = np.linalg.solve(normalMatrix, normalVector)
+    return [similarityToMatrix(parameters[4*i:4*i+4]) for i in range(0, count)]
@@ -0,0 +1,288 @@
+import os
+import glob
+import json
+import time
+import math as m
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+import matching as mt
+import registration as reg
+import geometry as gm
+import features as fs
+import profiling
+import utilities as util
+
+
+def loadFeatureSets(cacheDirectory):
+    '''
+    :param cacheDirectory: Feature cache directory of a previous run, see features.FeatureStore
+    :return: List of (name, keypoints, descriptors) of every recorded .npz file, sorted by name
+    '''
+    featureSets = []
+    for path in sorted(glob.glob(os.path.join(cacheDirectory, "*.npz"))):
+        with np.load(path) as cached:
+            featureSets.append((os.path.basename(path), cached["keypoints"], cached["descriptors"]))
+    return featureSets
+
+def benchmarkMatchers(featureSets, matchers, repeats=3):
+    '''
+    Matches every consecutive pair of recorded feature sets with every matcher backend. Matchers that use a position
+    prior get the transform found by brute force matching, i.e. a perfect prior.
+    :param featureSets: List of (name, keypoints, descriptors), see loadFeatureSets()
+    :param matchers: Dictionary of name -> matcher object
+    :param repeats: Every pair is matched this many times and the fastest run is kept
+    :return: Dictionary of name -> {"seconds", "matches", "inliers", "registered"} summed over all pairs
+    '''
+    priors = []
+    for (name1, kp1, d1), (name2, kp2, d2) in zip(featureSets[:-1], featureSets[1:]):
+        priors.append(reg.registerPair(kp1, d1, kp2, d2)[0])
+    results = {}
+    for matcherName, matcher in matchers.items():
+        total = {"seconds": 0.0, "matches": 0, "inliers": 0, "registered": 0}
+        for ((name1, kp1, d1), (name2, kp2, d2)), prior in zip(zip(featureSets[:-1], featureSets[1:]), priors):
+            initial = prior if isinstance(matcher, mt.PriorMatcher) else None
+            if isinstance(matcher, mt.PriorMatcher) and prior is None:
+                continue
+            best = float("inf")
+            for _ in range(0, repeats):
+                start = time.perf_counter()
+                matches = matcher.match(kp2, d2, kp1, d1, initial)
+                best = min(best, time.perf_counter() - start)
+            H, inliers = reg.estimateTransform(kp2[matches[:,0], :2], kp1[matches[:,1], :2])
+            total["seconds"] += best
+            total["matches"] += len(matches)
+            total["inliers"] += int(inliers.sum())
+            total["registered"] += H is not None
+        results[matcherName] = total
+    return results
+
+
+def syntheticOrthophoto(width, height, seed=1):
+    '''
+    :param width: Width in pixels
+    :param height: Height in pixels
+    :param seed: Random seed, the same seed always gives the same image
+    :return: BGR ndArray with texture at several scales, so features can be found everywhere
+    '''
+    rng = np.random.RandomState(seed)
+    image = cv2.resize(np.uint8(rng.randint(0, 256, (height//8 + 1, width//8 + 1, 3))), (width, height), interpolation=cv2.INTER_CUBIC)
+    for i in range(0, width*height//2400):
+        color = tuple(int(c) for c in rng.randint(0, 256, 3))
+        cv2.circle(image, (int(rng.randint(0, width)), int(rng.randint(0, height))), int(rng.randint(5, 60)), color, -1)
+    return image
+
+def flightGrid(frames):
+    '''
+    :return: (columns, rows) of a lawnmower pattern with at least the given number of frames, about as wide as long
+    '''
+    rows = max(1, int(round(m.sqrt(frames/2.0))))
+    return int(m.ceil(float(frames)/rows)), rows
+
+def syntheticFlight(directory, frames, frameSize=(640, 480), gsd=0.05, fieldOfView=73.7, tilt=3.0, seed=1, heading=0.0, zeroYaw=False):
+    '''
+    Cuts a synthetic orthophoto into overlapping frames along a lawnmower pattern. Every frame is seen through a known
+    tilted camera, i.e. it is distorted by the inverse of geometry.computeUnRotMatrix() of its pose, so the pipeline
+    has to undo real perspective. Writes images/, imageData.txt in the usual format and truth.npz. The orthophoto is
+    north up, pixel (u, v) lies at east u*gsd and north -v*gsd.
+    :param directory: Output directory
+    :param frames: Number of frames
+    :param frameSize: (width, height) of a frame in pixels
+    :param gsd: Ground sample distance of the orthophoto in pose units (meters) per pixel
+    :param fieldOfView: Horizontal field of view of the camera in degrees. Sets the altitude written to the poses.
+    :param tilt: Largest pitch and roll in degrees
+    :param seed: Random seed
+    :param heading: Degrees the camera is turned against the flight direction, so frames are not north up
+    :param zeroYaw: Write a yaw of 0 into the pose data like getImagedata.to_poses(). The true yaw is then only kept in
+        the metadata of the pose index imageData.npz, see utilities.importHeadings().
+    :return: Path of imageData.txt
+    '''
+    width, height = frameSize
+    columns, rows = flightGrid(frames)
+    stepX, stepY = int(0.3*width), int(0.55*height) #70% forward overlap, 45% side overlap
+    margin = max(width, height)
+    ortho = syntheticOrthophoto(2*margin + columns*stepX, 2*margin + rows*stepY, seed)
+    rng = np.random.RandomState(seed + 1)
+    altitude = width*gsd/(2*m.tan(fieldOfView*np.pi/360))
+    if not os.path.isdir(os.path.join(directory, "images")):
+        os.makedirs(os.path.join(directory, "images"))
+    lines, truth, poses, metadata = [], [], [], []
+    for k in range(0, columns*rows):
+        if k == frames:
+            break
+        row = k//columns
+        column = k % columns if row % 2 == 0 else columns - 1 - k % columns
+        centerX = margin + column*stepX + rng.uniform(-0.05, 0.05)*width
+        centerY = margin + row*stepY + rng.uniform(-0.05, 0.05)*height
+        yaw = heading + (0.0 if row % 2 == 0 else 180.0) #the camera turns around at the end of every leg
+        pose = np.array([centerX*gsd, -centerY*gsd, altitude, yaw + rng.uniform(-2, 2), rng.uniform(-tilt, tilt), rng.uniform(-tilt, tilt)])
+        M = gm.computeUnRotMatrix(pose)
+        center = gm.projectCorners(width, height, M).mean(axis=0) #approximately where the frame center lands
+        frameToOrtho = gm.composeTransforms(M, np.array(([1,0,centerX-center[0]],[0,1,centerY-center[1]],[0,0,1])))
+        frame = cv2.warpPerspective(ortho, np.linalg.inv(frameToOrtho), (width, height), flags=cv2.INTER_LINEAR)
+        name = "frame%04d.jpg" % k
+        cv2.imwrite(os.path.join(directory, "images", name), frame, [cv2.IMWRITE_JPEG_QUALITY, 92])
+        #metadata as read by getImagedata.read_metadata(), the position is already given in the local ENU frame
+        metadata.append([np.nan, np.nan, pose[2], pose[3], pose[4] - 90.0, pose[5]])
+        if zeroYaw:
+            pose[3] = 0.0
+        lines.append(",".join([name] + ["%f" % value for value in pose]))
+        poses.append(pose)
+        truth.append(frameToOrtho)
+    with open(os.path.join(directory, "imageData.txt"), "w") as file:
+        file.write("\n".join(lines) + "\n")
+    if zeroYaw:
+        np.savez(os.path.join(directory, "imageData.npz"), fileNames=np.array([line.split(",")[0] for line in lines]),
+                 dataMatrix=np.array(poses), metadata=np.array(metadata))
+    np.savez(os.path.join(directory, "truth.npz"), frameToOrtho=np.array(truth), frameSize=np.int64(frameSize), gsd=gsd)
+    return os.path.join(directory, "imageData.txt")
+
+def registrationErrors(combiner, frameToOrtho, frameSize):
+    '''
+    Compares the transforms found by a Combiner with the ground truth.
+    :param combiner: Combiner after computeTransforms()
+    :param frameToOrtho: Nx3x3 ndArray, true mapping of native frame pixels into the orthophoto
+    :param frameSize: (width, height) of the frames
+    :return: N ndArray, largest distance in output pixels between the estimated and the true corners of every frame
+    '''
+    width, height = frameSize
+    estimated = np.array([combiner.outputTransform(i) for i in range(0, combiner.imageCount)])
+    #the mosaic frame is the first frame after correction, at output scale
+    orthoToOutput = np.dot(estimated[0], np.linalg.inv(frameToOrtho[0]))
+    true = np.einsum("ij,njk->nik", orthoToOutput, frameToOrtho)
+    difference = gm.projectCorners(width, height, estimated) - gm.projectCorners(width, height, true)
+    return np.linalg.norm(difference, axis=2).max(axis=1)
+
+def worldErrors(combiner, frameToOrtho, frameSize, gsd):
+    '''
+    Compares the placement of every frame in the world grid of a georeferenced Combiner with the ground truth.
+    :param combiner: Combiner with a gsd_ after computeTransforms()
+    :param frameToOrtho: Nx3x3 ndArray, true mapping of native frame pixels into the orthophoto
+    :param frameSize: (width, height) of the frames
+    :param gsd: Ground sample distance of the orthophoto, see syntheticFlight()
+    :return: N ndArray, largest distance in output pixels between the estimated and the true corners of every frame
+    '''
+    width, height = frameSize
+    estimated = np.array([combiner.outputTransform(i) for i in range(0, combiner.imageCount)])
+    #orthophoto pixels and world grid cells are both north up, they only differ in resolution
+    true = np.einsum("ij,njk->nik", gm.scaleMatrix(gsd/combiner.gsd), frameToOrtho)
+    difference = gm.projectCorners(width, height, estimated) - gm.projectCorners(width, height, true)
+    return np.linalg.norm(difference, axis=2).max(axis=1)
+
+def benchmarkFlight(directory, options):
+    '''
+    Runs the whole pipeline on a synthetic flight. Module level so that it can run in a fresh process,
+    which makes its peak memory independent of earlier runs.
+    :param directory: Flight written by syntheticFlight()
+    :param options: Dictionary of Combiner keyword arguments e.g. {"workers_": 4}
+    :return: Dictionary of timings, throughput, peak memory and registration errors. With a "gsd_" option also the
+        errors of the frames in the world grid.
+    '''
+    import Combiner #imported here so that worker processes of the other benchmarks do not need it
+    profiler = profiling.Profiler()
+    profiler.start()
+    allImages, dataMatrix = util.importData(os.path.join(directory, "imageData.txt"), os.path.join(directory, "images"))
+    headings = util.importHeadings(os.path.join(directory, "imageData.txt"), allImages.fileNames)
+    combiner = Combiner.Combiner(allImages, dataMatrix, profiler_=profiler, headings_=headings, **options)
+    combiner.createMosaic()
+    profiler.stop()
+    with np.load(os.path.join(directory, "truth.npz")) as truth:
+        errors = registrationErrors(combiner, truth["frameToOrtho"], truth["frameSize"])
+        if combiner.gsd is not None:
+            worldError = worldErrors(combiner, truth["frameToOrtho"], truth["frameSize"], float(truth["gsd"])).max()
+    summary = profiler.summary()
+    wall = summary["total"]["wall"]
+    result = {"frames": len(allImages), "wall": wall, "framesPerSecond": len(allImages)/wall, "peakRss": profiling.peakRss(),
+            "canvas": list(combiner.resultImage.shape[:2]), "maxError": float(errors.max()), "meanError": float(errors.mean()),
+            "stages": dict((name, total["wall"]) for name, total in summary.items() if "wall" in total)}
+    for name, key in (("detect", "detect"), ("pair", "match"), ("pair", "ransac")): #measured in the worker processes
+        if name in summary:
+            result["stages"][key] = summary[name][key]
+    if combiner.gsd is not None:
+        result["worldError"] = float(worldError)
+    return result
+
+def benchmarkSynthetic(directory, sizes, options, frameSize=(640, 480), heading=0.0, zeroYaw=False):
+    '''
+    :param directory: Directory where the flights are generated. Existing flights are reused.
+    :param sizes: List of flight sizes in frames, e.g. [10, 100, 500]
+    :param options: Dictionary of Combiner keyword arguments
+    :param frameSize: (width, height) of the frames
+    :param heading: Camera heading of the flights, see syntheticFlight()
+    :param zeroYaw: Write the poses with a yaw of 0, see syntheticFlight()
+    :return: List of benchmarkFlight() results, one per size
+    '''
+    results = []
+    for frames in sizes:
+        name = "flight%d_%dx%d" % (frames, frameSize[0], frameSize[1])
+        if heading != 0:
+            name += "_heading%g" % heading
+        if zeroYaw:
+            name += "_yaw0"
+        flight = os.path.join(directory, name)
+        if not os.path.isfile(os.path.join(flight, "truth.npz")):
+            syntheticFlight(flight, frames, frameSize, heading=heading, zeroYaw=zeroYaw)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results.append(executor.submit(benchmarkFlight, flight, options).result())
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the mosaic pipeline.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    matchersParser = subparsers.add_parser("matchers", help="micro-benchmark of the feature matcher backends on recorded descriptor sets")
+    matchersParser.add_argument("cache", help="feature cache directory written by a previous run (Combiner featureCache_)")
+    matchersParser.add_argument("--window", type=float, default=None, help="search window of the prior matcher in pixels, by default the one "
+                                "the pipeline derives from --gps-accuracy and --meters-per-pixel")
+    matchersParser.add_argument("--gps-accuracy", type=float, default=2.0, help="horizontal GPS accuracy in meters")
+    matchersParser.add_argument("--meters-per-pixel", type=float, default=0.05, help="GSD of the recorded images, 0.05 for the synthetic flights")
+    matchersParser.add_argument("--repeats", type=int, default=3)
+    syntheticParser = subparsers.add_parser("synthetic", help="end to end benchmark on generated flights with known poses")
+    syntheticParser.add_argument("--directory", default="results/benchmarks", help="where flights are generated and reused")
+    syntheticParser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500], help="flight sizes in frames")
+    syntheticParser.add_argument("--frame-size", type=int, nargs=2, default=[640, 480], help="frame width and height")
+    syntheticParser.add_argument("--workers", type=int, default=os.cpu_count())
+    syntheticParser.add_argument("--refine", action="store_true")
+    syntheticParser.add_argument("--output-scale", type=float, default=0.5)
+    syntheticParser.add_argument("--detector", default="orb", choices=fs.availableDetectors())
+    syntheticParser.add_argument("--keypoints", type=int, default=None, help="keypoint budget per image")
+    syntheticParser.add_argument("--min-inliers", type=int, default=None, help="early exit of the transform estimation")
+    syntheticParser.add_argument("--matcher", default="bruteforce", choices=["bruteforce", "flann", "prior"])
+    syntheticParser.add_argument("--gsd", type=float, default=None, help="georeference the mosaics at this GSD and report the world errors")
+    syntheticParser.add_argument("--heading", type=float, default=0.0, help="camera heading of the flights in degrees")
+    syntheticParser.add_argument("--zero-yaw", action="store_true", help="write the poses with a yaw of 0 like getImagedata.to_poses()")
+    syntheticParser.add_argument("--max-error", type=float, default=None, help="fail if any frame is misplaced by more output pixels")
+    syntheticParser.add_argument("--report", default=None, help="also write the results to this JSON file")
+    args = parser.parse_args()
+    if args.command == "matchers":
+        featureSets = loadFeatureSets(args.cache)
+        window = args.window
+        if window is None:
+            longSide = max([np.ptp(keypoints[:, :2], axis=0).max() for name, keypoints, descriptors in featureSets if len(keypoints)] or [0])
+            transforms = [reg.registerPair(kp1, d1, kp2, d2)[0] for (name1, kp1, d1), (name2, kp2, d2) in zip(featureSets[:-1], featureSets[1:])]
+            offsets = [np.linalg.norm(H[:2, 2]) for H in transforms if H is not None]
+            window = mt.gpsWindow(args.gps_accuracy, args.meters_per_pixel, longSide, np.median(offsets) if offsets else 0.0)
+        matchers = {"bruteforce": mt.BruteForceMatcher(), "flann": mt.FlannMatcher(), "prior": mt.PriorMatcher(window)}
+        print("%d feature sets, %d pairs, prior window %.1f px" % (len(featureSets), max(0, len(featureSets) - 1), window))
+        for name, total in benchmarkMatchers(featureSets, matchers, args.repeats).items():
+            print("%-12s %8.2f ms/pair  %7d matches  %7d inliers  %4d registered" % (name, 1000*total["seconds"]/max(1, len(featureSets) - 1), total["matches"], total["inliers"], total["registered"]))
+    else:
+        options = {"workers_": args.workers, "refine_": args.refine, "outputScale_": args.output_scale, "detector_": args.detector,
+                   "keypointBudget_": args.keypoints, "minInliers_": args.min_inliers, "matcher_": args.matcher, "gsd_": args.gsd}
+        results = benchmarkSynthetic(args.directory, args.sizes, options, tuple(args.frame_size), args.heading, args.zero_yaw)
+        for result in results:
+            print("%5d frames  %8.1f s  %6.2f frames/s  %7.0f MB peak  canvas %dx%d  error max %.2f px mean %.2f px" % (
+                result["frames"], result["wall"], result["framesPerSecond"], (result["peakRss"] or 0)/2.0**20,
+                result["canvas"][1], result["canvas"][0], result["maxError"], result["meanError"]))
+            if "worldError" in result:
+                print("       world error max %.2f px" % result["worldError"])
+            print("       " + "  ".join("%s %.2fs" % (name, seconds) for name, seconds in sorted(result["stages"].items())))
+        if args.report:
+            with open(args.report, "w") as file:
+                json.dump(results, file, indent=1)
+        if args.max_error is not None and any(result["maxError"] > args.max_error for result in results):
+            raise SystemExit("Registration error above %.2f px" % args.max_error)
+        if args.max_error is not None and any(result.get("worldError", 0.0) > args.max_error for result in results):
+            raise SystemExit("World error above %.2f px" % args.max_error)
@@ -0,0 +1,324 @@
+import os
+import tempfile
+from collections import OrderedDict
+import cv2
+import numpy as np
+import compositing as cp
+import geometry as gm
+import profiling as pf
+
+
+def unionBounds(bounds1, bounds2):
+    '''
+    :return: [xMin, yMin, xMax, yMax] rectangle covering both rectangles. Either may be None.
+    '''
+    if bounds1 is None:
+        return list(bounds2)
+    if bounds2 is None:
+        return list(bounds1)
+    return [min(bounds1[0], bounds2[0]), min(bounds1[1], bounds2[1]), max(bounds1[2], bounds2[2]), max(bounds1[3], bounds2[3])]
+
+
+class Canvas:
+    def __init__(self, channels=3, spare=0.5, blending="overwrite"):
+        '''
+        Growing in-memory mosaic. Canvas coordinates are fixed (usually the frame of the first image) and may be negative.
+        The pixel buffer is reallocated with spare room when an image falls outside of it, so growing the mosaic only
+        changes the offset between canvas coordinates and buffer indices instead of warping the whole mosaic.
+        :param channels: Number of channels of the images pasted into the canvas.
+        :param spare: Extra room added on each side that grows, as a fraction of the required size.
+        :param blending: How new images are blended with the mosaic, see compositing.composite()
+        :return:
+        '''
+        self.channels = channels
+        self.spare = spare
+        self.blending = blending
+        self.buffer = None
+        self.origin = [0, 0] #canvas coordinates of buffer pixel (0,0)
+        self.bounds = None #[xMin, yMin, xMax, yMax] of the painted area in canvas coordinates
+
+    def ensure(self, xMin, yMin, xMax, yMax):
+        '''
+        Makes sure the buffer covers the given canvas rectangle, reallocating it with spare room if needed.
+        :return:
+        '''
+        if self.buffer is None:
+            self.buffer = np.zeros((yMax-yMin, xMax-xMin, self.channels), dtype=np.uint8)
+            self.origin = [xMin, yMin]
+            return
+        bufXMin, bufYMin = self.origin
+        bufXMax = bufXMin + self.buffer.shape[1]
+        bufYMax = bufYMin + self.buffer.shape[0]
+        if xMin >= bufXMin and yMin >= bufYMin and xMax <= bufXMax and yMax <= bufYMax:
+            return
+        padX = int(self.spare*(max(xMax, bufXMax) - min(xMin, bufXMin)))
+        padY = int(self.spare*(max(yMax, bufYMax) - min(yMin, bufYMin)))
+        newXMin = xMin - padX if xMin < bufXMin else bufXMin
+        newYMin = yMin - padY if yMin < bufYMin else bufYMin
+        newXMax = xMax + padX if xMax > bufXMax else bufXMax
+        newYMax = yMax + padY if yMax > bufYMax else bufYMax
+        newBuffer = np.zeros((newYMax-newYMin, newXMax-newXMin, self.channels), dtype=np.uint8)
+        newBuffer[bufYMin-newYMin:bufYMax-newYMin, bufXMin-newXMin:bufXMax-newXMin] = self.buffer
+        self.buffer = newBuffer
+        self.origin = [newXMin, newYMin]
+
+    def reserve(self, bounds):
+        '''
+        Allocates the buffer for the final extent of the mosaic up front, e.g. from Combiner.mosaicBounds(), so it is not
+        reallocated and copied while the mosaic grows.
+        :param bounds: [xMin, yMin, xMax, yMax] in canvas coordinates
+        :return:
+        '''
+        self.ensure(*bounds)
+
+    def view(self, xMin, yMin, xMax, yMax):
+        '''
+        :return: Writable ndArray view of the buffer covering the given canvas rectangle. The rectangle must be inside the buffer.
+        '''
+        x0 = xMin - self.origin[0]
+        y0 = yMin - self.origin[1]
+        return self.buffer[y0:y0+(yMax-yMin), x0:x0+(xMax-xMin)]
+
+    def paste(self, image, transformation, seamThreshold=None, interpolation=cv2.INTER_LINEAR, profiler=None):
+        '''
+        Warps an image into the canvas and blends it into its bounding box only.
+        :param image: ndArray image
+        :param transformation: 3x3 ndArray representing perspective transformation from the image into canvas coordinates
+        :param seamThreshold: If given, black seams along the border of the image are repaired (see compositing.composite())
+        :param interpolation: OpenCV interpolation flag used to warp the image
+        :param profiler: Optional profiling.Profiler timing the warp and compositing stages
+        :return: [xMin, yMin, xMax, yMax] bounding box of the updated region in canvas coordinates
+        '''
+        xMin, yMin, xMax, yMax = gm.cornerBounds(gm.projectCorners(image.shape[1], image.shape[0], transformation))
+        self.ensure(xMin, yMin, xMax, yMax)
+        with pf.stage(profiler, "warp"):
+            warpedImage = gm.warpIntoRegion(image, transformation, [xMin, yMin, xMax, yMax], interpolation)
+        with pf.stage(profiler, "composite"):
+            cp.composite(self.view(xMin, yMin, xMax, yMax), warpedImage, self.blending, seamThreshold)
+        self.bounds = unionBounds(self.bounds, [xMin, yMin, xMax, yMax])
+        return [xMin, yMin, xMax, yMax]
+
+    def readRegion(self, xMin, yMin, xMax, yMax):
+        '''
+        :return: Copy of the given canvas rectangle. Parts outside of the buffer read as black.
+        '''
+        region = np.zeros((yMax-yMin, xMax-xMin, self.channels), dtype=np.uint8)
+        if self.buffer is None:
+            return region
+        x0, y0 = max(xMin, self.origin[0]), max(yMin, self.origin[1])
+        x1, y1 = min(xMax, self.origin[0] + self.buffer.shape[1]), min(yMax, self.origin[1] + self.buffer.shape[0])
+        if x1 > x0 and y1 > y0:
+            region[y0-yMin:y1-yMin, x0-xMin:x1-xMin] = self.view(x0, y0, x1, y1)
+        return region
+
+    def image(self):
+        '''
+        :return: Copy of the painted area of the canvas as an ndArray image
+        '''
+        if self.bounds is None:
+            return np.zeros((0, 0, self.channels), dtype=np.uint8)
+        return self.view(*self.bounds).copy()
+
+    def saveState(self, directory):
+        '''
+        Persists the canvas so that an interrupted job can continue painting into it, see manifest.JobManifest.
+        :param directory: Directory the pixel buffer is written to, e.g. the job directory. The state stores the buffer
+            path relative to it, so the job can be resumed from another working directory or after it was moved.
+        :return: Dictionary describing the canvas, to be passed to restoreState()
+        '''
+        path = os.path.join(directory, "canvas.npy")
+        if self.buffer is not None:
+            np.save(path + ".tmp.npy", self.buffer)
+            os.replace(path + ".tmp.npy", path)
+        return {"type": "Canvas", "origin": list(self.origin), "bounds": self.bounds, "buffer": "canvas.npy" if self.buffer is not None else None}
+
+    def restoreState(self, state, directory):
+        '''
+        :param state: Dictionary from saveState()
+        :param directory: Directory that was passed to saveState(), where it is now
+        :return:
+        '''
+        self.buffer = None if state["buffer"] is None else np.load(os.path.join(directory, state["buffer"]))
+        self.origin = list(state["origin"])
+        self.bounds = state["bounds"]
+
+    def save(self, fileName):
+        '''
+        :param fileName: Output image path in string form e.g. "results/intermediateResult.png"
+        :return:
+        '''
+        cv2.imwrite(fileName, self.image())
+
+
+class TiledCanvas:
+    def __init__(self, directory=None, tileSize=512, channels=3, maxOpenTiles=64, blending="overwrite"):
+        '''
+        Out-of-core mosaic made of square tiles, each stored as a memory-mapped .npy file in a directory.
+        Tiles are only created when an image paints into them, and at most maxOpenTiles are mapped at a time,
+        so resident memory is bounded by the tile cache and the footprint of one image, not by the flight size.
+        Offers the same paste()/image()/save() interface as Canvas.
+        :param directory: Directory holding the tile files. A temporary directory is used if None.
+        :param tileSize: Width and height of a tile in pixels.
+        :param channels: Number of channels of the images pasted into the canvas.
+        :param maxOpenTiles: Number of tiles kept memory-mapped at once.
+        :param blending: How new images are blended with the mosaic, see compositing.composite()
+        :return:
+        '''
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="mosaicTiles")
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.tileSize = tileSize
+        self.channels = channels
+        self.maxOpenTiles = maxOpenTiles
+        self.blending = blending
+        self.openTiles = OrderedDict() #(tileX, tileY) -> memory-mapped tile, least recently used first
+        self.tiles = set() #(tileX, tileY) of every tile that exists on disk
+        self.bounds = None #[xMin, yMin, xMax, yMax] of the painted area in canvas coordinates
+
+    def tilePath(self, tileX, tileY):
+        return os.path.join(self.directory, "tile_%d_%d.npy" % (tileX, tileY))
+
+    def tile(self, tileX, tileY, create=False):
+        '''
+        :param tileX: Tile column. Tile (0,0) starts at canvas coordinate (0,0).
+        :param tileY: Tile row.
+        :param create: Allocate the tile if it does not exist yet.
+        :return: Memory-mapped tile ndArray, or None if it does not exist and create is False
+        '''
+        key = (tileX, tileY)
+        if key in self.openTiles:
+            self.openTiles.move_to_end(key)
+            return self.openTiles[key]
+        if key in self.tiles:
+            tile = np.load(self.tilePath(tileX, tileY), mmap_mode="r+")
+        elif create:
+            tile = np.lib.format.open_memmap(self.tilePath(tileX, tileY), mode="w+", dtype=np.uint8,
+                                             shape=(self.tileSize, self.tileSize, self.channels))
+            self.tiles.add(key)
+        else:
+            return None
+        self.openTiles[key] = tile
+        while len(self.openTiles) > self.maxOpenTiles:
+            oldKey, oldTile = self.openTiles.popitem(last=False)
+            oldTile.flush()
+        return tile
+
+    def tileRange(self, xMin, yMin, xMax, yMax):
+        '''
+        :return: (tileX, tileY, tile rectangle in canvas coordinates) for every tile overlapping the canvas rectangle
+        '''
+        size = self.tileSize
+        for tileY in range(yMin // size, (yMax - 1) // size + 1):
+            for tileX in range(xMin // size, (xMax - 1) // size + 1):
+                yield tileX, tileY, [tileX*size, tileY*size, (tileX+1)*size, (tileY+1)*size]
+
+    def reserve(self, bounds):
+        '''
+        Canvas.reserve() counterpart. Tiles are only allocated where images paint, so nothing is done up front.
+        :return:
+        '''
+        pass
+
+    def readRegion(self, xMin, yMin, xMax, yMax):
+        '''
+        :return: Copy of the given canvas rectangle. Missing tiles read as black and are not allocated.
+        '''
+        region = np.zeros((yMax-yMin, xMax-xMin, self.channels), dtype=np.uint8)
+        for tileX, tileY, tileBounds in self.tileRange(xMin, yMin, xMax, yMax):
+            tile = self.tile(tileX, tileY)
+            if tile is None:
+                continue
+            x0, y0 = max(xMin, tileBounds[0]), max(yMin, tileBounds[1])
+            x1, y1 = min(xMax, tileBounds[2]), min(yMax, tileBounds[3])
+            region[y0-yMin:y1-yMin, x0-xMin:x1-xMin] = tile[y0-tileBounds[1]:y1-tileBounds[1], x0-tileBounds[0]:x1-tileBounds[0]]
+        return region
+
+    def writeRegion(self, xMin, yMin, region, mask=None):
+        '''
+        Writes a region back into the tiles under it.
+        :param xMin: Canvas x coordinate of the region's left column
+        :param yMin: Canvas y coordinate of the region's top row
+        :param region: ndArray image
+        :param mask: Optional ndArray, nonzero where the region was changed. Tiles without changes are not touched.
+        :return:
+        '''
+        xMax = xMin + region.shape[1]
+        yMax = yMin + region.shape[0]
+        for tileX, tileY, tileBounds in self.tileRange(xMin, yMin, xMax, yMax):
+            x0, y0 = max(xMin, tileBounds[0]), max(yMin, tileBounds[1])
+            x1, y1 = min(xMax, tileBounds[2]), min(yMax, tileBounds[3])
+            if mask is not None and not mask[y0-yMin:y1-yMin, x0-xMin:x1-xMin].any():
+                continue
+            tile = self.tile(tileX, tileY, create=True)
+            tile[y0-tileBounds[1]:y1-tileBounds[1], x0-tileBounds[0]:x1-tileBounds[0]] = region[y0-yMin:y1-yMin, x0-xMin:x1-xMin]
+
+    def paste(self, image, transformation, seamThreshold=None, interpolation=cv2.INTER_LINEAR, profiler=None):
+        '''
+        Warps an image into the canvas and blends it into the tiles under its footprint only.
+        :param image: ndArray image
+        :param transformation: 3x3 ndArray representing perspective transformation from the image into canvas coordinates
+        :param seamThreshold: If given, black seams along the border of the image are repaired (see compositing.composite())
+        :param interpolation: OpenCV interpolation flag used to warp the image
+        :param profiler: Optional profiling.Profiler timing the warp and compositing stages
+        :return: [xMin, yMin, xMax, yMax] bounding box of the updated region in canvas coordinates
+        '''
+        xMin, yMin, xMax, yMax = gm.cornerBounds(gm.projectCorners(image.shape[1], image.shape[0], transformation))
+        with pf.stage(profiler, "warp"):
+            warpedImage = gm.warpIntoRegion(image, transformation, [xMin, yMin, xMax, yMax], interpolation)
+        with pf.stage(profiler, "composite"): #includes reading and writing the tiles
+            region = self.readRegion(xMin, yMin, xMax, yMax)
+            changed = cp.composite(region, warpedImage, self.blending, seamThreshold)
+            self.writeRegion(xMin, yMin, region, changed)
+        self.bounds = unionBounds(self.bounds, [xMin, yMin, xMax, yMax])
+        return [xMin, yMin, xMax, yMax]
+
+    def flush(self):
+        '''
+        Writes all mapped tiles to disk.
+        :return:
+        '''
+        for tile in self.openTiles.values():
+            tile.flush()
+
+    def saveState(self, directory=None):
+        '''
+        Flushes all tiles and describes the canvas so that an interrupted job can continue painting into it.
+        The tiles already are on disk, so this is cheap enough to call after every image.
+        :param directory: Optional job directory. The tile directory is stored relative to it, for information only.
+        :return: Dictionary describing the canvas, to be passed to restoreState()
+        '''
+        self.flush()
+        tileDirectory = self.directory if directory is None else os.path.relpath(self.directory, directory)
+        return {"type": "TiledCanvas", "directory": tileDirectory, "tileSize": self.tileSize, "channels": self.channels,
+                "tiles": sorted(self.tiles), "bounds": self.bounds}
+
+    def restoreState(self, state, directory=None):
+        '''
+        The canvas keeps the tile directory it was constructed with, which has to hold the tiles of the saved state.
+        :param state: Dictionary from saveState()
+        :param directory: Not used, see saveState()
+        :return:
+        '''
+        self.flush()
+        self.openTiles.clear()
+        self.tileSize = state["tileSize"]
+        self.channels = state["channels"]
+        self.tiles = set((int(tileX), int(tileY)) for tileX, tileY in state["tiles"])
+        self.bounds = state["bounds"]
+
+    def image(self):
+        '''
+        :return: The painted area of the canvas as one ndArray image. Only use this when the mosaic fits into memory.
+        '''
+        if self.bounds is None:
+            return np.zeros((0, 0, self.channels), dtype=np.uint8)
+        return self.readRegion(*self.bounds)
+
+    def save(self, fileName):
+        '''
+        :param fileName: Output image path in string form e.g. "results/intermediateResult.png"
+        :return:
+        '''
+        cv2.imwrite(fileName, self.image())
@@ -0,0 +1,133 @@
+import cv2
+import numpy as np
+import removeBlackline as rb
+
+
+BLENDING_METHODS = ("overwrite", "feather", "multiband")
+
+def validMask(image):
+    '''
+    :param image: BGR ndArray image
+    :return: uint8 mask, 255 where the image has content, 0 where it is black (empty canvas or outside a warped image)
+    '''
+    ret, mask = cv2.threshold(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), 1, 255, cv2.THRESH_BINARY)
+    return mask
+
+def edgeDistances(mask, padded):
+    '''
+    :param mask: uint8 mask, nonzero inside
+    :param padded: Treat everything outside of the mask array as empty. Without it, the mask is assumed to continue.
+    :return: float32 ndArray, distance of every pixel to the closest empty pixel. Distances are capped at the mask size.
+    '''
+    if padded:
+        mask = cv2.copyMakeBorder(mask, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+        distances = cv2.distanceTransform(mask, cv2.DIST_L2, 3)[1:-1, 1:-1]
+    else:
+        distances = cv2.distanceTransform(mask, cv2.DIST_L2, 3)
+    return np.minimum(distances, float(max(mask.shape)))
+
+def featherWeights(newMask, baseMask):
+    '''
+    Distance-transform feathering. Each image weighs in proportion to how far a pixel is from that image's border,
+    so the transition runs across the whole overlap and there is no hard seam.
+    :param newMask: uint8 mask of the new image. Its border is inside the region.
+    :param baseMask: uint8 mask of the existing canvas content. It may continue outside the region.
+    :return: float32 ndArray, weight of the new image from 0 to 1
+    '''
+    newDistances = edgeDistances(newMask, True)
+    baseDistances = edgeDistances(baseMask, False)
+    return newDistances/np.maximum(newDistances + baseDistances, 1e-6)
+
+def gaussianPyramid(image, levels):
+    pyramid = [image]
+    for i in range(0, levels):
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
+def laplacianPyramid(image, levels):
+    '''
+    :param image: float32 ndArray image
+    :param levels: Number of band-pass levels
+    :return: List of levels+1 ndArrays, band-pass images from fine to coarse followed by the low-pass residual
+    '''
+    gaussian = gaussianPyramid(image, levels)
+    pyramid = []
+    for i in range(0, levels):
+        size = (gaussian[i].shape[1], gaussian[i].shape[0])
+        pyramid.append(gaussian[i] - cv2.pyrUp(gaussian[i+1], dstsize=size))
+    pyramid.append(gaussian[-1])
+    return pyramid
+
+def multiBandBlend(baseImage, newImage, weights, levels=5):
+    '''
+    Laplacian-pyramid blending: low frequencies are mixed over a wide band and high frequencies over a narrow one, which
+    hides exposure differences without blurring detail.
+    :param baseImage: BGR ndArray image
+    :param newImage: BGR ndArray image with the same size
+    :param weights: float32 ndArray with the same size, weight of the new image from 0 to 1
+    :param levels: Number of pyramid levels. Reduced for small images.
+    :return: Blended uint8 BGR ndArray image
+    '''
+    levels = max(0, min(levels, int(np.log2(max(1, min(weights.shape)))) - 2))
+    basePyramid = laplacianPyramid(np.float32(baseImage), levels)
+    newPyramid = laplacianPyramid(np.float32(newImage), levels)
+    weightPyramid = gaussianPyramid(np.float32(weights), levels)
+    result = None
+    for base, new, weight in reversed(list(zip(basePyramid, newPyramid, weightPyramid))):
+        band = base + (new - base)*weight[:,:,np.newaxis]
+        result = band if result is None else cv2.pyrUp(result, dstsize=(band.shape[1], band.shape[0])) + band
+    return np.uint8(np.clip(result + 0.5, 0, 255))
+
+def blendOverlap(region, warpedImage, newMask, baseMask, method, levels=5):
+    '''
+    Blends the new image into the canvas region in place, inside the bounding box of the overlap only.
+    :return:
+    '''
+    overlap = cv2.bitwise_and(newMask, baseMask)
+    x, y, width, height = cv2.boundingRect(overlap)
+    if width == 0 or height == 0:
+        return
+    box = (slice(y, y+height), slice(x, x+width))
+    base = region[box]
+    new = warpedImage[box]
+    weights = featherWeights(newMask, baseMask)[box]
+    if method == "feather":
+        blended = np.uint8(np.clip(base + (np.float32(new) - base)*weights[:,:,np.newaxis] + 0.5, 0, 255))
+    else:
+        #empty pixels of each image are filled with the other one, so no black bleeds into the pyramids
+        filledBase = base.copy()
+        np.copyto(filledBase, new, where=(baseMask[box] == 0)[:,:,np.newaxis])
+        filledNew = new.copy()
+        np.copyto(filledNew, base, where=(newMask[box] == 0)[:,:,np.newaxis])
+        seam = np.float32(weights >= 0.5) #each pixel comes from the image it is deepest in, the pyramid smooths the seam
+        blended = multiBandBlend(filledBase, filledNew, seam, levels)
+    np.copyto(base, blended, where=(overlap[box] > 0)[:,:,np.newaxis])
+
+def composite(region, warpedImage, method="overwrite", seamThreshold=None):
+    '''
+    Blends a warped image into a canvas region in place. All work is done inside the region, i.e. the bounding box of
+    the new image, so the cost grows with the image and not with the canvas.
+    :param region: Writable ndArray view of the canvas
+    :param warpedImage: ndArray image with the same size as region
+    :param method: "overwrite": non-black pixels of the new image replace the canvas.
+        "feather": distance-transform feathering inside the overlap. "multiband": Laplacian-pyramid blending inside the overlap.
+    :param seamThreshold: If given, black seam pixels left by the border of the warped image are repaired afterwards
+        (see removeBlackline.repairSeams()). Pixels at or below this gray level count as black.
+    :return: uint8 mask, 1 where the region was changed
+    '''
+    if method not in BLENDING_METHODS:
+        raise ValueError("Unknown blending method "+str(method))
+    newMask = validMask(warpedImage)
+    changed = np.uint8(newMask > 0)
+    if seamThreshold is not None:
+        baseGray = cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
+    if method != "overwrite":
+        baseMask = validMask(region)
+        blendOverlap(region, warpedImage, newMask, baseMask, method)
+        newMask = cv2.bitwise_and(newMask, cv2.bitwise_not(baseMask)) #the overlap is done, the rest is copied
+    np.copyto(region, warpedImage, where=(newMask > 0)[:,:,np.newaxis])
+    if seamThreshold is not None:
+        seams = rb.seamMask(cv2.cvtColor(region, cv2.COLOR_BGR2GRAY), baseGray, changed, seamThreshold)
+        rb.repairSeams(region, seams, seamThreshold)
+        changed |= seams > 0
+    return changed
@@ -0,0 +1,150 @@
+import os
+from collections import OrderedDict
+import cv2
+from PIL import Image
+
+
+class LRUCache:
+    def __init__(self, maxSize):
+        '''
+        Small least-recently-used cache.
+        :param maxSize: Number of entries kept. 0 disables caching.
+        :return:
+        '''
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+
+    def get(self, key, compute):
+        '''
+        :param key: Hashable key
+        :param compute: Function without arguments that computes the value if it is not cached
+        :return: Cached or freshly computed value
+        '''
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        value = compute()
+        if self.maxSize > 0:
+            self.entries[key] = value
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+
+def scaledSize(width, height, scale):
+    '''
+    :return: (width, height) of an image downsampled by scale, at least one pixel
+    '''
+    return max(1, int(round(width*scale))), max(1, int(round(height*scale)))
+
+def reductionFlag(scale):
+    '''
+    :param scale: Resolution needed relative to the native image
+    :return: (imread flag, reduction factor) of the smallest JPEG decoding that still has at least that resolution
+    '''
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if scale*factor <= 1.0:
+            return flag, factor
+    return cv2.IMREAD_COLOR, 1
+
+
+class ImageList:
+    def __init__(self, images):
+        '''
+        Dataset interface over images that are already in memory. See ImageDataset.
+        :param images: List of ndArray images
+        :return:
+        '''
+        self.images = images
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return self.images[index]
+
+    def imageSize(self, index):
+        '''
+        :return: (width, height) of the image at native resolution
+        '''
+        return self.images[index].shape[1], self.images[index].shape[0]
+
+    def loadScaled(self, index, scale):
+        '''
+        :param index: Index of the image
+        :param scale: Resolution relative to the native image, at most 1
+        :return: ndArray image of size scaledSize(width, height, scale), area-downsampled
+        '''
+        image = self.images[index]
+        if scale == 1.0:
+            return image
+        return cv2.resize(image, scaledSize(image.shape[1], image.shape[0], scale), interpolation=cv2.INTER_AREA)
+
+
+class ImageDataset(ImageList):
+    def __init__(self, fileNames, imageDirectory, cacheSize=4):
+        '''
+        Lazy image dataset. Images are decoded on demand and only the cacheSize most recently used frames are kept,
+        so memory grows with the cache size and not with the number of images. Low resolution requests use reduced
+        JPEG decoding, which is much faster than decoding the full image and downsampling it.
+        :param fileNames: List of image file names in string form
+        :param imageDirectory: Name of the directory where images are stored in string form e.g. "datasets/images/"
+        :param cacheSize: Number of decoded frames kept in memory
+        :return:
+        '''
+        self.fileNames = list(fileNames)
+        self.imageDirectory = imageDirectory
+        self.cache = LRUCache(cacheSize)
+        self.sizes = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["cache"] = LRUCache(self.cache.maxSize) #decoded frames are not sent to worker processes
+        return state
+
+    def __len__(self):
+        return len(self.fileNames)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.loadScaled(index, 1.0)
+
+    def path(self, index):
+        return os.path.join(self.imageDirectory, self.fileNames[index])
+
+    def imageSize(self, index):
+        '''
+        Reads only the image header, the pixels are not decoded.
+        :return: (width, height) of the image at native resolution, as cv2.imread() returns it
+        '''
+        if index not in self.sizes:
+            with Image.open(self.path(index)) as image:
+                width, height = image.size
+                #cv2.imread() applies the EXIF orientation, orientations 5 to 8 swap width and height
+                if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                    width, height = height, width
+                self.sizes[index] = (width, height)
+        return self.sizes[index]
+
+    def loadScaled(self, index, scale):
+        '''
+        :param index: Index of the image
+        :param scale: Resolution relative to the native image, at most 1
+        :return: ndArray image of size scaledSize(width, height, scale), area-downsampled
+        '''
+        return self.cache.get((index, scale), lambda: self.decode(index, scale))
+
+    def decode(self, index, scale):
+        flag, factor = reductionFlag(scale)
+        image = cv2.imread(self.path(index), flag)
+        if image is None:
+            raise IOError("Could not read image "+self.path(index))
+        width, height = self.imageSize(index)
+        size = scaledSize(width, height, scale)
+        if (image.shape[1], image.shape[0]) != size:
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        return image
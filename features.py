@@ -0,0 +1,237 @@
+import os
+import hashlib
+import time
+import cv2
+import numpy as np
+import utilities as util
+
+
+DETECTORS = ("orb", "akaze", "sift")
+CONSTRUCTORS = {"orb": "ORB_create", "akaze": "AKAZE_create", "sift": "SIFT_create"}
+DESCRIPTOR_SHAPES = {"orb": (32, np.uint8), "akaze": (61, np.uint8), "sift": (128, np.float32)} #of empty results
+
+def availableDetectors():
+    '''
+    :return: Tuple of the DETECTORS the installed OpenCV provides, e.g. AKAZE is a contrib module in OpenCV 5
+    '''
+    return tuple(detector for detector in DETECTORS if hasattr(cv2, CONSTRUCTORS[detector]))
+
+def createDetector(detectorParams):
+    '''
+    :param detectorParams: Dictionary of keyword arguments passed to the OpenCV constructor e.g. {"nfeatures": 500}.
+        "detector" selects "orb" (default), "akaze" or "sift". "budget" and "grid" are used by detectFeatures() only.
+    :return: OpenCV feature detector/descriptor extractor
+    '''
+    params = dict((key, value) for key, value in detectorParams.items() if key not in ("detector", "budget", "grid"))
+    detector = detectorParams.get("detector", "orb")
+    if detector not in DETECTORS:
+        raise ValueError("Unknown detector "+str(detector))
+    return getattr(cv2, CONSTRUCTORS[detector])(**params)
+
+def detectorParameters(detector="orb", budget=None, grid=8):
+    '''
+    :param detector: "orb", "akaze" or "sift", one of availableDetectors()
+    :param budget: Number of keypoints kept per image, None keeps what the detector finds with its own defaults
+    :param grid: Number of bucketing cells along the long side of the image, see bucketKeypoints()
+    :return: detectorParams dictionary for detectFeatures() and FeatureStore
+    '''
+    if detector not in DETECTORS:
+        raise ValueError("Unknown detector "+str(detector))
+    if detector not in availableDetectors():
+        raise ValueError("Detector "+detector+" is not available in OpenCV "+cv2.__version__)
+    params = {"detector": detector} if detector != "orb" else {}
+    if budget is not None:
+        params["budget"] = int(budget)
+        params["grid"] = int(grid)
+        if detector == "orb":
+            params["nfeatures"] = 4*int(budget) #candidates for the bucketing, ORB stops at nfeatures
+            params["fastThreshold"] = 10 #weak corners are only kept where a cell has nothing better
+    return params
+
+def bucketKeypoints(keypoints, mask, budget, grid):
+    '''
+    Spreads a keypoint budget evenly over the image. The image is divided into square cells, and every cell with
+    content gets the same quota of its strongest keypoints. Quota left unused by weakly textured cells goes to the other
+    cells, so the budget is used up whenever there are enough keypoints. This bounds the matching cost of every pair and
+    keeps keypoints from clustering in a few textured areas, which gives RANSAC well spread inliers.
+    :param keypoints: List of cv2.KeyPoint
+    :param mask: uint8 mask of the image content, nonzero where keypoints may be
+    :param budget: Number of keypoints to keep
+    :param grid: Number of cells along the long side of the image
+    :return: List of the kept cv2.KeyPoint, strongest first within every cell
+    '''
+    if len(keypoints) <= budget:
+        return list(keypoints)
+    height, width = mask.shape[:2]
+    cellSize = max(1.0, float(max(width, height))/grid)
+    columns = int(np.ceil(width/cellSize))
+    points = np.float32([kp.pt for kp in keypoints]).reshape(-1, 2)
+    responses = np.float32([kp.response for kp in keypoints])
+    cells = np.int64(np.minimum(points[:, 1]//cellSize, np.ceil(height/cellSize) - 1))*columns + np.int64(np.minimum(points[:, 0]//cellSize, columns - 1))
+    #rank of every keypoint within its cell, strongest first
+    order = np.lexsort((-responses, cells))
+    sortedCells = cells[order]
+    starts = np.r_[0, np.nonzero(sortedCells[1:] != sortedCells[:-1])[0] + 1]
+    counts = np.diff(np.r_[starts, len(order)])
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - np.repeat(starts, counts)
+    #largest quota per cell that stays within the budget, the remainder goes to the strongest keypoints at that rank
+    quota = 0
+    while quota < counts.max() and np.minimum(counts, quota + 1).sum() <= budget:
+        quota += 1
+    kept = ranks < quota
+    remainder = budget - kept.sum()
+    if remainder > 0:
+        candidates = np.nonzero(ranks == quota)[0]
+        kept[candidates[np.argsort(-responses[candidates])[:remainder]]] = True
+    return [keypoints[i] for i in np.nonzero(kept)[0]]
+
+_detectors = {} #detectors are reused by each process, keyed by their parameters
+
+def detectFeatures(detectorParams, image, timed=False):
+    '''
+    Runs the detector on one image. Module level so that it can be sent to worker processes.
+    :param detectorParams: Dictionary of keyword arguments for the detector, see createDetector(). With a "budget",
+        keypoints are bucketed (see bucketKeypoints()) and descriptors are only computed for the kept ones.
+    :param image: BGR ndArray. Black (padding) pixels are masked out.
+    :param timed: Also return the time spent detecting, measured in the process that runs the detector
+    :return: keypoints: Nx7 float32 ndArray (see keypointsToArray()), descriptors: NxD ndArray,
+        with timed also timings: dictionary of "detect" wall and "detectCpu" CPU seconds
+    '''
+    start = time.perf_counter()
+    startCpu = time.process_time()
+    key = repr(sorted(detectorParams.items()))
+    if key not in _detectors:
+        _detectors[key] = createDetector(detectorParams)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    ret, mask = cv2.threshold(gray, 1, 255, cv2.THRESH_BINARY)
+    if detectorParams.get("budget") is None:
+        kp, descriptors = _detectors[key].detectAndCompute(gray, mask) #kp = keypoints
+    else:
+        kp = bucketKeypoints(_detectors[key].detect(gray, mask), mask, detectorParams["budget"], detectorParams.get("grid", 8))
+        kp, descriptors = _detectors[key].compute(gray, kp)
+    if descriptors is None or len(kp) == 0:
+        length, dtype = DESCRIPTOR_SHAPES[detectorParams.get("detector", "orb")]
+        descriptors = np.zeros((0, length), dtype=dtype)
+    if timed:
+        return keypointsToArray(kp), descriptors, {"detect": time.perf_counter() - start, "detectCpu": time.process_time() - startCpu}
+    return keypointsToArray(kp), descriptors
+
+def keypointsToArray(keypoints):
+    '''
+    Packs OpenCV keypoints into a compact float32 array so they can be stored with NumPy and moved by matrix operations.
+    :param keypoints: List of cv2.KeyPoint
+    :return: Nx7 float32 ndArray in [x,y,size,angle,response,octave,class_id] format
+    '''
+    return np.float32([kp.pt + (kp.size, kp.angle, kp.response, kp.octave, kp.class_id) for kp in keypoints]).reshape(-1, 7)
+
+def arrayToKeypoints(array):
+    '''
+    Inverse of keypointsToArray(). Only needed for OpenCV drawing functions.
+    :param array: Nx7 ndArray in [x,y,size,angle,response,octave,class_id] format
+    :return: List of cv2.KeyPoint
+    '''
+    return [cv2.KeyPoint(float(k[0]), float(k[1]), float(k[2]), float(k[3]), float(k[4]), int(k[5]), int(k[6])) for k in array]
+
+def transformPoints(points, transformation):
+    '''
+    :param points: Nx2 ndArray of pixel locations
+    :param transformation: 3x3 ndArray representing perspective transformation
+    :return: Nx2 float32 ndArray of transformed pixel locations
+    '''
+    if len(points) == 0:
+        return np.float32(points).reshape(-1, 2)
+    return cv2.perspectiveTransform(np.float32(points).reshape(-1, 1, 2), np.float64(transformation)).reshape(-1, 2)
+
+
+class FeatureStore:
+    def __init__(self, detectorParams=None, cacheDirectory=None, level=None):
+        '''
+        Computes keypoints and descriptors once per image and keeps them for every pair the image takes part in.
+        :param detectorParams: Dictionary of keyword arguments for the detector. Part of the on-disk cache key.
+        :param cacheDirectory: Directory in which .npz feature files are stored. None disables the disk cache.
+        :param level: Resolution the images are corrected at, e.g. their long side in pixels. Part of the on-disk cache key.
+        :return:
+        '''
+        self.detectorParams = dict(detectorParams or {})
+        self.cacheDirectory = cacheDirectory
+        self.level = level
+        self.features = {} #index -> (keypoint array, descriptors)
+        if self.cacheDirectory is not None and not os.path.isdir(self.cacheDirectory):
+            os.makedirs(self.cacheDirectory)
+
+    def cachePath(self, name, pose):
+        '''
+        :param name: Image file name in string form e.g. "DJI_0001.JPG"
+        :param pose: 1x6 pose row. The unrotated image depends on it, so it is part of the key.
+        :return: Path of the .npz file holding the features of this image
+        '''
+        key = repr((sorted(self.detectorParams.items()), self.level, np.float64(pose).round(6).tolist()))
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cacheDirectory, os.path.basename(name) + "." + digest + ".npz")
+
+    def load(self, index, name=None, pose=None):
+        '''
+        Looks the features of an image up in memory and in the disk cache.
+        :return: (keypoints, descriptors), or None if they still have to be computed
+        '''
+        if index in self.features:
+            return self.features[index]
+        if self.cacheDirectory is not None and name is not None:
+            path = self.cachePath(name, pose)
+            if os.path.isfile(path):
+                with np.load(path) as cached:
+                    self.features[index] = (cached["keypoints"], cached["descriptors"])
+                return self.features[index]
+        return None
+
+    def store(self, index, keypoints, descriptors, name=None, pose=None):
+        '''
+        Keeps freshly computed features in memory and, if enabled, in the disk cache.
+        :return:
+        '''
+        if self.cacheDirectory is not None and name is not None:
+            np.savez(self.cachePath(name, pose), keypoints=keypoints, descriptors=descriptors)
+        self.features[index] = (keypoints, descriptors)
+
+    def get(self, index, loadImage, name=None, pose=None):
+        '''
+        :param index: Index of the image in the dataset. Key of the in-memory store.
+        :param loadImage: Function returning the unrotated image for an index. Only called when the features are not stored yet.
+        :param name: Image file name. Key of the on-disk store. None disables the disk cache for this image.
+        :param pose: 1x6 pose row of the image.
+        :return: keypoints: Nx7 float32 ndArray, descriptors: NxD ndArray
+        '''
+        if self.load(index, name, pose) is None:
+            keypoints, descriptors = detectFeatures(self.detectorParams, loadImage(index))
+            self.store(index, keypoints, descriptors, name, pose)
+        return self.features[index]
+
+    def computeAll(self, loadImage, count, names=None, poses=None, workers=1, indices=None, timed=False):
+        '''
+        Makes sure the features of every image are available, detecting the missing ones in parallel.
+        Images are loaded one by one while the workers run, so only a few of them are in memory at a time.
+        :param loadImage: Function returning the unrotated image for an index
+        :param count: Number of images
+        :param names: Optional list of image file names
+        :param poses: Optional Nx6 pose matrix
+        :param workers: Number of worker processes
+        :param indices: Optional list of the images that are needed. All count images if None.
+        :param timed: Measure the detection of every image in the worker that runs it, see detectFeatures()
+        :return: Dictionary of index -> timings of the images detected here, empty unless timed
+        '''
+        missing = []
+        for i in (range(0, count) if indices is None else indices):
+            name = None if names is None else names[i]
+            pose = None if poses is None else poses[i]
+            if self.load(i, name, pose) is None:
+                missing.append(i)
+        results = util.parallelMap(detectFeatures, ((self.detectorParams, loadImage(i), timed) for i in missing), workers)
+        timings = {}
+        for i, result in zip(missing, results):
+            name = None if names is None else names[i]
+            pose = None if poses is None else poses[i]
+            self.store(i, result[0], result[1], name, pose)
+            if timed:
+                timings[i] = result[2]
+        return timings
@@ -1,6 +1,35 @@
+import heapq
+import itertools
 import numpy as np
 import cv2
-import math as m
+
+def unRotMatrices(poses):
+    '''
+    Vectorized computeUnRotMatrix() for a whole pose matrix.
+    :param poses: Nx6 NumPy ndArray of poses in [X,Y,Z,Y,P,R] format, e.g. the data matrix
+    :return: Nx3x3 ndArray, entry i removes the perspective distortion of image i
+    '''
+    angles = np.float64(poses).reshape(-1, 6)[:, 3:6]*np.pi/180
+    cosA, cosB, cosG = np.cos(angles).T #yaw alpha, pitch beta, roll gamma
+    sinA, sinB, sinG = np.sin(angles).T
+    #R = Rz*Rx*Ry, as in the reference. Its third column is replaced by [0,0,1], so only the upper left 2x2 block and
+    #the bottom row are left and the inverse of R transposed is found in closed form from that 2x2 block.
+    r00 = cosA*cosB - sinA*sinG*sinB
+    r01 = -1*sinA*cosG
+    r10 = sinA*cosB + cosA*sinG*sinB
+    r11 = cosA*cosG
+    r20 = -1*cosG*sinB
+    r21 = sinG
+    #R transposed is [[r00,r10,r20],[r01,r11,r21],[0,0,1]], an affine matrix [[A,c],[0,1]] with inverse [[A^-1,-A^-1 c],[0,1]]
+    determinant = r00*r11 - r10*r01
+    inverses = np.zeros((len(angles), 3, 3))
+    inverses[:, 0, 0] = r11/determinant
+    inverses[:, 0, 1] = -1*r10/determinant
+    inverses[:, 1, 0] = -1*r01/determinant
+    inverses[:, 1, 1] = r00/determinant
+    inverses[:, :2, 2] = -1*np.einsum("nij,nj->ni", inverses[:, :2, :2], np.column_stack((r20, r21)))
+    inverses[:, 2, 2] = 1
+    return inverses
 
 def computeUnRotMatrix(pose):
     '''
@@ -8,48 +37,203 @@ def computeUnRotMatrix(pose):
     :param pose: A 1x6 NumPy ndArray containing pose information in [X,Y,Z,Y,P,R] format
     :return: A 3x3 rotation matrix that removes perspective distortion from the image to which it is applied.
     '''
-    a = pose[3]*np.pi/180 #alpha
-    b = pose[4]*np.pi/180 #beta
-    g = pose[5]*np.pi/180 #gamma
-    #Compute R matrix according to source.
-    Rz = np.array(([m.cos(a), -1*m.sin(a),    0],
-                   [m.sin(a),    m.cos(a),    0],
-                   [       0,           0,     1]))
-
-    Ry = np.array(([ m.cos(b),           0,     m.sin(b)],
-                   [        0,           1,            0],
-                   [-1*m.sin(b),           0,     m.cos(b)]))
-
-    Rx = np.array(([        1,           0,            0],
-                   [        0,    m.cos(g),  -1*m.sin(g)],
-                   [        0,    m.sin(g),     m.cos(g)]))
-    Ryx = np.dot(Rx,Ry)
-    R = np.dot(Rz,Ryx) #Care to perform rotations in roll, pitch, yaw order.
-    R[0,2] = 0
-    R[1,2] = 0
-    R[2,2] = 1
-    Rtrans = R.transpose()
-    InvR = np.linalg.inv(Rtrans)
-    #Return inverse of R matrix so that when applied, the transformation undoes R.
-    return InvR
-
-def warpPerspectiveWithPadding(image,transformation):
+    return unRotMatrices(pose)[0]
+
+def composeTransforms(*transformations):
+    '''
+    :param transformations: 3x3 ndArrays in the order they are applied, e.g. unrotation, global transform, canvas offset
+    :return: 3x3 ndArray applying all of them at once, so an image only has to be resampled one time
+    '''
+    result = np.eye(3)
+    for transformation in transformations:
+        result = np.dot(transformation, result)
+    return result
+
+def projectCorners(width,height,transformations):
+    '''
+    :param width: Width of the image
+    :param height: Height of the image
+    :param transformations: 3x3 ndArray, or Nx3x3 ndArray of N perspective transformations
+    :return: 4x2 ndArray (Nx4x2 for N transformations) of the transformed [0,0],[0,height],[width,height],[width,0] corners
+    '''
+    corners = np.array([[0,0,1],[0,height,1],[width,height,1],[width,0,1]], dtype=np.float64)
+    projected = np.einsum("...ij,kj->...ki", np.float64(transformations), corners)
+    return projected[...,:2]/projected[...,2:]
+
+def projectFootprints(sizes,transformations):
+    '''
+    projectCorners() for N images of different sizes at once.
+    :param sizes: Nx2 ndArray of (width, height) of every image
+    :param transformations: Nx3x3 ndArray, entry i maps image i into a common frame
+    :return: Nx4x2 ndArray of the transformed [0,0],[0,height],[width,height],[width,0] corners of every image
+    '''
+    width, height = np.float64(sizes).reshape(-1, 2).T
+    ones = np.ones(len(width))
+    zeros = np.zeros(len(width))
+    corners = np.stack((np.column_stack((zeros, zeros, ones)), np.column_stack((zeros, height, ones)),
+                        np.column_stack((width, height, ones)), np.column_stack((width, zeros, ones))), axis=1)
+    projected = np.einsum("nij,nkj->nki", np.float64(transformations), corners)
+    return projected[...,:2]/projected[...,2:]
+
+def cornerBounds(corners):
+    '''
+    :param corners: ...x2 ndArray of points, e.g. from projectCorners()
+    :return: [xMin, yMin, xMax, yMax] integer bounding box enclosing all points
+    '''
+    points = np.float64(corners).reshape(-1,2)
+    [xMin, yMin] = np.floor(points.min(axis=0))
+    [xMax, yMax] = np.ceil(points.max(axis=0))
+    return [int(xMin), int(yMin), int(xMax), int(yMax)]
+
+def warpIntoRegion(image,transformation,bounds,interpolation=cv2.INTER_LINEAR,destination=None):
+    '''
+    Warps an image straight into a destination rectangle. The rectangle offset is folded into the transformation, so
+    only the rectangle is resampled. Pixels outside of the warped image keep the destination value (BORDER_TRANSPARENT),
+    so images can also be warped straight into an existing buffer.
+    :param image: ndArray image
+    :param transformation: 3x3 ndArray representing perspective transformation into destination coordinates
+    :param bounds: [xMin, yMin, xMax, yMax] destination rectangle
+    :param interpolation: OpenCV interpolation flag e.g. cv2.INTER_LINEAR, cv2.INTER_CUBIC
+    :param destination: Optional ndArray of the rectangle's size that is warped into, e.g. a view of a canvas. Black if None.
+    :return: destination
+    '''
+    xMin, yMin, xMax, yMax = bounds
+    if destination is None:
+        destination = np.zeros((yMax-yMin, xMax-xMin) + image.shape[2:], dtype=image.dtype)
+    translation = np.array(([1,0,-1*xMin],[0,1,-1*yMin],[0,0,1]))
+    cv2.warpPerspective(image, composeTransforms(transformation, translation), (xMax-xMin, yMax-yMin), dst=destination,
+                        flags=interpolation, borderMode=cv2.BORDER_TRANSPARENT)
+    return destination
+
+def paddedTransformation(width,height,transformation):
+    '''
+    :param width: Width of the image to warp
+    :param height: Height of the image to warp
+    :param transformation: 3x3 ndArray representing perspective trransformation
+    :return: fullTransformation: transformation followed by the translation that keeps the whole warped image visible,
+        size: (width, height) of the warped image
+    '''
+    warpedCorners = projectCorners(width, height, transformation) #warped corner locations
+    [xMin, yMin] = np.int32(warpedCorners.min(axis=0) - 0.5) #new dimensions
+    [xMax, yMax] = np.int32(warpedCorners.max(axis=0) + 0.5)
+    translation = np.array(([1,0,-1*xMin],[0,1,-1*yMin],[0,0,1])) #must translate image so that all of it is visible
+    fullTransformation = np.dot(translation,transformation) #compose warp and translation in correct order
+    return fullTransformation, (int(xMax-xMin), int(yMax-yMin))
+
+def warpPerspectiveWithPadding(image,transformation,interpolation=cv2.INTER_LINEAR):
     '''
     When we warp an image, its corners may be outside of the bounds of the original image. This function creates a new image that ensures this won't happen.
     :param image: ndArray image
     :param transformation: 3x3 ndArray representing perspective trransformation
-    :param kp: keypoints associated with image
+    :param interpolation: OpenCV interpolation flag
     :return: transformed image
     '''
+    fullTransformation, size = paddedTransformation(image.shape[1], image.shape[0], transformation)
+    return warpIntoRegion(image, fullTransformation, [0, 0, size[0], size[1]], interpolation)
 
-    height = image.shape[0]
-    width = image.shape[1]
-    corners = np.float32([[0,0],[0,height],[width,height],[width,0]]).reshape(-1,1,2) #original corner locations
+def scaleMatrix(scaleX, scaleY=None):
+    '''
+    :param scaleX: Horizontal scale factor
+    :param scaleY: Vertical scale factor. Same as scaleX if None.
+    :return: 3x3 ndArray scaling pixel coordinates
+    '''
+    if scaleY is None:
+        scaleY = scaleX
+    return np.array(([scaleX,0,0],[0,scaleY,0],[0,0,1]))
 
-    warpedCorners = cv2.perspectiveTransform(corners, transformation) #warped corner locations
-    [xMin, yMin] = np.int32(warpedCorners.min(axis=0).ravel() - 0.5) #new dimensions
-    [xMax, yMax] = np.int32(warpedCorners.max(axis=0).ravel() + 0.5)
-    translation = np.array(([1,0,-1*xMin],[0,1,-1*yMin],[0,0,1])) #must translate image so that all of it is visible
-    fullTransformation = np.dot(translation,transformation) #compose warp and translation in correct order
-    result = cv2.warpPerspective(image, fullTransformation, (xMax-xMin, yMax-yMin))
-    return result
\ No newline at end of file
+def correctionMatrices(sizes,transformations,scales):
+    '''
+    Vectorized correctionMatrix() for N images.
+    :param sizes: Nx2 ndArray of (width, height) of the native images
+    :param transformations: Nx3x3 ndArray in native pixel coordinates, e.g. from unRotMatrices()
+    :param scales: N ndArray, resolution of every corrected image relative to its native image
+    :return: nativeToCorrected: Nx3x3 ndArray, downsampling: Nx3x3 ndArray, sizes: Nx2 ndArray of (width, height) of the corrected images
+    '''
+    sizes = np.float64(sizes).reshape(-1, 2)
+    scaledSizes = np.maximum(1, np.round(sizes*np.float64(scales).reshape(-1, 1)))
+    S = np.zeros((len(sizes), 3, 3))
+    S[:, 0, 0], S[:, 1, 1] = (scaledSizes/sizes).T #exact scale after rounding the size
+    S[:, 2, 2] = 1
+    inverseS = np.zeros((len(sizes), 3, 3))
+    inverseS[:, 0, 0], inverseS[:, 1, 1] = (sizes/scaledSizes).T
+    inverseS[:, 2, 2] = 1
+    scaledTransformations = np.matmul(S, np.matmul(np.float64(transformations), inverseS))
+    #same padding as paddedTransformation(): the translation that keeps the whole corrected image visible
+    corners = projectFootprints(scaledSizes, scaledTransformations)
+    minimum = np.int32(corners.min(axis=1) - 0.5)
+    maximum = np.int32(corners.max(axis=1) + 0.5)
+    translations = np.tile(np.eye(3), (len(sizes), 1, 1))
+    translations[:, :2, 2] = -1*minimum
+    return np.matmul(translations, np.matmul(scaledTransformations, S)), S, np.int64(maximum - minimum)
+
+def correctionMatrix(width,height,transformation,scale=1.0):
+    '''
+    :param width: Width of the native image
+    :param height: Height of the native image
+    :param transformation: 3x3 ndArray in native pixel coordinates, e.g. from computeUnRotMatrix()
+    :param scale: Resolution of the corrected image relative to the native image
+    :return: nativeToCorrected: 3x3 ndArray mapping native pixels into the corrected image,
+        downsampling: 3x3 ndArray mapping native pixels into the downsampled image, size: (width, height) of the corrected image
+    '''
+    C, S, sizes = correctionMatrices([[width, height]], np.reshape(transformation, (1, 3, 3)), [scale])
+    return C[0], S[0], (int(sizes[0, 0]), int(sizes[0, 1]))
+
+def correctImage(image,transformation,scale=1.0):
+    '''
+    Downsamples an image with area interpolation (no aliasing) and removes its perspective distortion.
+    :param image: ndArray image at native resolution
+    :param transformation: 3x3 ndArray in native pixel coordinates, e.g. from computeUnRotMatrix()
+    :param scale: Resolution of the corrected image relative to the native image
+    :return: correctedImage: transformed image, nativeToCorrected: 3x3 ndArray mapping native pixels into correctedImage
+    '''
+    height, width = image.shape[:2]
+    C, S, size = correctionMatrix(width, height, transformation, scale)
+    if scale != 1.0:
+        image = cv2.resize(image, (max(1, int(round(width*scale))), max(1, int(round(height*scale)))), interpolation=cv2.INTER_AREA)
+    correctedImage = warpIntoRegion(image, np.dot(C, np.linalg.inv(S)), [0, 0, size[0], size[1]])
+    return correctedImage, C
+
+def spanningTransforms(transforms, pairTransforms, weights=None):
+    '''
+    Places images by walking a spanning tree over all registered pairs, starting from the images whose transform is
+    known. Unlike chainTransforms(), an image whose consecutive pair failed is still placed through any other pair,
+    e.g. with a GPS neighbour on the next leg. The tree grows along the strongest pair first (Prim), so weak pairs are
+    only used for images that cannot be reached otherwise.
+    :param transforms: List of 3x3 ndArrays mapping every image into the mosaic, None where unknown
+    :param pairTransforms: Dictionary (index1, index2) -> 3x3 ndArray mapping image index2 into image index1, None for
+        pairs that could not be registered
+    :param weights: Optional dictionary (index1, index2) -> strength of the pair, e.g. its inlier count. Equal if None.
+    :return: List of 3x3 ndArrays, None for the images that are not connected to a known one
+    '''
+    neighbours = {} #index -> list of (weight, other index, transform mapping the other image into this one)
+    for pair, H in sorted(pairTransforms.items()):
+        if H is not None:
+            weight = 1 if weights is None else weights.get(pair, 0)
+            neighbours.setdefault(pair[0], []).append((weight, pair[1], H))
+            neighbours.setdefault(pair[1], []).append((weight, pair[0], np.linalg.inv(H)))
+    placed = list(transforms)
+    heap = [] #(-weight, order, index, other index, transform), order breaks ties in the order edges were found
+    order = itertools.count()
+    def addEdges(index):
+        for weight, other, H in neighbours.get(index, []):
+            if placed[other] is None:
+                heapq.heappush(heap, (-weight, next(order), index, other, H))
+    for i in range(0, len(placed)):
+        if placed[i] is not None:
+            addEdges(i)
+    while heap:
+        weight, position, index, other, H = heapq.heappop(heap)
+        if placed[other] is None:
+            placed[other] = np.dot(placed[index], H)
+            addEdges(other)
+    return placed
+
+def chainTransforms(relativeTransforms):
+    '''
+    :param relativeTransforms: List of 3x3 ndArrays. Entry i maps image i into image i-1. Entry 0 is ignored.
+    :return: List of 3x3 ndArrays. Entry i maps image i into the frame of image 0.
+    '''
+    globalTransforms = [np.eye(3)]
+    for i in range(1, len(relativeTransforms)):
+        globalTransforms.append(np.dot(globalTransforms[i-1], relativeTransforms[i]))
+    return globalTransforms
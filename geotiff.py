@@ -0,0 +1,237 @@
+import struct
+import zlib
+import cv2
+import numpy as np
+
+
+#TIFF field types
+SHORT = 3
+LONG = 4
+DOUBLE = 12
+LONG8 = 16
+FIELD_SIZES = {SHORT: 2, LONG: 4, DOUBLE: 8, LONG8: 8}
+FIELD_FORMATS = {SHORT: "H", LONG: "I", DOUBLE: "d", LONG8: "Q"}
+
+def levelSizes(width, height, tileSize):
+    '''
+    :return: List of (width, height) of the full resolution image and of every overview, each half the size of the
+        previous one, until the image fits into a single tile
+    '''
+    sizes = [(width, height)]
+    while max(sizes[-1]) > tileSize:
+        sizes.append(((sizes[-1][0] + 1)//2, (sizes[-1][1] + 1)//2))
+    return sizes
+
+def geoKeys(origin):
+    '''
+    GeoTIFF keys of the local East-North-Up frame the poses are given in (see getImagedata.to_poses()). It is written
+    as a transverse Mercator projection on WGS 84 centered at the ENU origin, which matches ENU to well below a pixel
+    over the extent of a survey.
+    :param origin: (latitude, longitude) of the ENU origin in degrees, or None if it is unknown
+    :return: GeoKeyDirectoryTag SHORT values, GeoDoubleParamsTag DOUBLE values
+    '''
+    keys = [(1024, 0, 1, 1), #GTModelTypeGeoKey: projected
+            (1025, 0, 1, 1)] #GTRasterTypeGeoKey: pixel is area
+    doubles = []
+    if origin is not None:
+        def double(key, value):
+            keys.append((key, 34736, 1, len(doubles)))
+            doubles.append(float(value))
+        keys += [(2048, 0, 1, 4326), #GeographicTypeGeoKey: WGS 84
+                 (3072, 0, 1, 32767), #ProjectedCSTypeGeoKey: user defined
+                 (3074, 0, 1, 32767), #ProjectionGeoKey: user defined
+                 (3075, 0, 1, 1)] #ProjCoordTransGeoKey: transverse Mercator
+        double(3080, origin[1]) #ProjNatOriginLongGeoKey
+        double(3081, origin[0]) #ProjNatOriginLatGeoKey
+        double(3082, 0.0) #ProjFalseEastingGeoKey
+        double(3083, 0.0) #ProjFalseNorthingGeoKey
+        double(3092, 1.0) #ProjScaleAtNatOriginGeoKey
+    keys.append((3076, 0, 1, 9001)) #ProjLinearUnitsGeoKey: meters
+    keys.sort()
+    directory = [1, 1, 0, len(keys)] #version 1.1.0
+    for key in keys:
+        directory += list(key)
+    return directory, doubles
+
+
+class GeoTiffWriter:
+    def __init__(self, path, width, height, tileSize=256, bounds=None, gsd=None, origin=None, level=6):
+        '''
+        Streams a tiled, deflate compressed RGBA (Geo)TIFF with internal overviews. Rows of tiles are passed in from top
+        to bottom with writeRows(), and each one is compressed and written straight away. Overviews are reduced from
+        the rows as they arrive, so only about one row of tiles per level is held in memory and the full image never is.
+        Alpha is 255 where the mosaic has content, so viewers show the empty canvas as transparent.
+        :param path: Output .tif path
+        :param width: Width of the image in pixels
+        :param height: Height of the image in pixels
+        :param tileSize: Width and height of a tile, a multiple of 16
+        :param bounds: Optional [xMin, yMin, xMax, yMax] world grid cells covered by the image, see gsd
+        :param gsd: Ground sample distance in meters per pixel. With bounds, the image is georeferenced: grid cell
+            (x, y) covers east x*gsd to (x+1)*gsd and north -y*gsd to -(y+1)*gsd in the ENU frame.
+        :param origin: (latitude, longitude) of the ENU origin, see geoKeys()
+        :param level: zlib compression level
+        :return:
+        '''
+        self.path = path
+        self.tileSize = tileSize
+        self.bounds = bounds
+        self.gsd = gsd
+        self.origin = origin
+        self.level = level
+        self.sizes = levelSizes(width, height, tileSize)
+        #BigTIFF is only needed if the file might not fit below 4 GB
+        self.big = 4*width*height*4//3 > 2**32 - 2**26
+        self.offsets = [[] for size in self.sizes] #file offset of every tile, per level
+        self.byteCounts = [[] for size in self.sizes]
+        self.pending = [None for size in self.sizes] #rows of every level that do not fill a row of tiles yet
+        self.rowsWritten = [0 for size in self.sizes]
+        self.file = open(path, "wb")
+        self.file.write(b"II" + (struct.pack("<HHHQ", 43, 8, 0, 0) if self.big else struct.pack("<HI", 42, 0)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        if exceptionType is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def encodeTile(self, tile):
+        '''
+        :param tile: tileSize x tileSize x 4 uint8 ndArray
+        :return: Deflate compressed bytes with the horizontal differencing predictor applied
+        '''
+        differences = tile.copy()
+        differences[:, 1:] -= tile[:, :-1] #wraps around modulo 256 as the predictor requires
+        return zlib.compress(differences.tobytes(), self.level)
+
+    def writeTiles(self, level, rows):
+        '''
+        Writes one row of tiles of a level.
+        :param rows: tileSize x width x 4 ndArray, fewer rows for the last row of tiles
+        :return:
+        '''
+        size = self.tileSize
+        width = self.sizes[level][0]
+        padded = np.zeros((size, -(-width//size)*size, 4), dtype=np.uint8)
+        padded[:rows.shape[0], :width] = rows
+        for x in range(0, padded.shape[1], size):
+            data = self.encodeTile(np.ascontiguousarray(padded[:, x:x+size]))
+            self.offsets[level].append(self.file.tell())
+            self.byteCounts[level].append(len(data))
+            self.file.write(data)
+
+    def addRows(self, level, rows):
+        '''
+        Appends rows to a level. Full rows of tiles are written, and the rows are reduced by two into the next level.
+        :param rows: Nx width x 4 uint8 ndArray, an even number of rows except at the bottom of the level
+        :return:
+        '''
+        if self.pending[level] is not None:
+            rows = np.concatenate((self.pending[level], rows))
+        self.pending[level] = None
+        last = self.rowsWritten[level] + rows.shape[0] == self.sizes[level][1]
+        count = rows.shape[0] if last else rows.shape[0] - rows.shape[0] % self.tileSize
+        for y in range(0, count, self.tileSize):
+            self.writeTiles(level, rows[y:y+self.tileSize])
+        self.pending[level] = rows[count:] if count < rows.shape[0] else None
+        if level + 1 < len(self.sizes) and count > 0:
+            reducedSize = (self.sizes[level + 1][0], (count + 1)//2)
+            self.addRows(level + 1, cv2.resize(rows[:count], reducedSize, interpolation=cv2.INTER_AREA).reshape(reducedSize[1], reducedSize[0], 4))
+        self.rowsWritten[level] += count
+
+    def writeRows(self, rows):
+        '''
+        :param rows: Next rows of the full resolution image from the top, BGR (black is empty) or BGRA uint8 ndArray.
+            Any number of rows can be passed, but the count must be even except for the last call.
+        :return:
+        '''
+        if rows.shape[2] == 3:
+            alpha = np.where(rows.max(axis=2) > 0, 255, 0).astype(np.uint8)
+            rows = np.dstack((rows, alpha))
+        self.addRows(0, cv2.cvtColor(rows, cv2.COLOR_BGRA2RGBA))
+
+    def imageDirectory(self, level, nextOffset):
+        '''
+        :param level: 0 for the full resolution image, overviews follow
+        :param nextOffset: File offset of the next image file directory, 0 for the last one
+        :return: Bytes of the image file directory, to be written at the current end of the file
+        '''
+        width, height = self.sizes[level]
+        offsetType = LONG8 if self.big else LONG
+        tags = [(254, LONG, [1 if level > 0 else 0]), #NewSubfileType: reduced resolution image
+                (256, LONG, [width]), (257, LONG, [height]),
+                (258, SHORT, [8, 8, 8, 8]), #BitsPerSample
+                (259, SHORT, [8]), #Compression: deflate
+                (262, SHORT, [2]), #PhotometricInterpretation: RGB
+                (277, SHORT, [4]), #SamplesPerPixel
+                (284, SHORT, [1]), #PlanarConfiguration: contiguous
+                (317, SHORT, [2]), #Predictor: horizontal differencing
+                (322, LONG, [self.tileSize]), (323, LONG, [self.tileSize]),
+                (324, offsetType, self.offsets[level]), (325, offsetType, self.byteCounts[level]),
+                (338, SHORT, [2]), #ExtraSamples: unassociated alpha
+                (339, SHORT, [1, 1, 1, 1])] #SampleFormat: unsigned
+        if level == 0 and self.gsd is not None and self.bounds is not None:
+            keys, doubles = geoKeys(self.origin)
+            tags += [(33550, DOUBLE, [self.gsd, self.gsd, 0.0]), #ModelPixelScaleTag
+                     (33922, DOUBLE, [0.0, 0.0, 0.0, self.bounds[0]*self.gsd, -1*self.bounds[1]*self.gsd, 0.0]), #ModelTiepointTag
+                     (34735, SHORT, keys)] #GeoKeyDirectoryTag
+            if doubles:
+                tags.append((34736, DOUBLE, doubles)) #GeoDoubleParamsTag
+        pointer = "Q" if self.big else "I"
+        entrySize = 20 if self.big else 12
+        start = self.file.tell()
+        values = b"" #values that do not fit into their entry follow the directory
+        valuesStart = start + (8 if self.big else 2) + entrySize*len(tags) + (8 if self.big else 4)
+        entries = b""
+        for tag, fieldType, value in tags:
+            data = struct.pack("<%d%s" % (len(value), FIELD_FORMATS[fieldType]), *value)
+            if len(data) <= (8 if self.big else 4):
+                field = data.ljust(8 if self.big else 4, b"\0")
+            else:
+                field = struct.pack("<" + pointer, valuesStart + len(values))
+                values += data + b"\0"*(len(data) % 2) #values start on a word boundary
+            entries += struct.pack("<HH" + pointer, tag, fieldType, len(value)) + field
+        count = struct.pack("<Q", len(tags)) if self.big else struct.pack("<H", len(tags))
+        return count + entries + struct.pack("<" + pointer, nextOffset) + values
+
+    def close(self):
+        '''
+        Writes the remaining rows and the image file directories, then closes the file.
+        :return:
+        '''
+        for level, size in enumerate(self.sizes):
+            if self.rowsWritten[level] != size[1]:
+                raise ValueError("Level %d has %d of %d rows" % (level, self.rowsWritten[level], size[1]))
+        directoryOffsets = []
+        for level in range(0, len(self.sizes)):
+            if self.file.tell() % 2:
+                self.file.write(b"\0")
+            directoryOffsets.append(self.file.tell())
+            #the offset of the next directory is only known once this one is written, so it is patched afterwards
+            self.file.write(self.imageDirectory(level, 0))
+        for level in range(0, len(self.sizes) - 1):
+            self.file.seek(directoryOffsets[level])
+            self.file.write(self.imageDirectory(level, directoryOffsets[level + 1]))
+        self.file.seek(8 if self.big else 4)
+        self.file.write(struct.pack("<Q", directoryOffsets[0]) if self.big else struct.pack("<I", directoryOffsets[0]))
+        self.file.close()
+
+
+def writeGeoTiff(path, readRegion, bounds, gsd=None, origin=None, tileSize=256):
+    '''
+    Writes the area of a canvas to a tiled GeoTIFF with internal overviews, one row of tiles at a time.
+    :param path: Output .tif path
+    :param readRegion: Function (xMin, yMin, xMax, yMax) -> BGR ndArray, e.g. canvas.TiledCanvas.readRegion
+    :param bounds: [xMin, yMin, xMax, yMax] area of the canvas to write
+    :param gsd: Ground sample distance in meters per pixel if canvas coordinates are world grid cells, see
+        Combiner.georeferencedFrame(). The image is not georeferenced if None.
+    :param origin: (latitude, longitude) of the ENU origin, see geoKeys()
+    :param tileSize: Width and height of a tile
+    :return:
+    '''
+    xMin, yMin, xMax, yMax = bounds
+    with GeoTiffWriter(path, xMax - xMin, yMax - yMin, tileSize, bounds, gsd, origin) as writer:
+        for y in range(yMin, yMax, tileSize):
+            writer.writeRows(readRegion(xMin, y, xMax, min(y + tileSize, yMax)))
@@ -1,9 +1,11 @@
 import os
+import argparse
 # from bs4 import BeautifulSoup
 from PIL import Image, ExifTags
 from pymap3d import ecef2enu, geodetic2ecef
 import numpy as np
 import pyexiv2 
+import utilities as util
 
 
 def dms_to_decimal(d, m, s):
@@ -44,73 +46,144 @@ def convert_string_to_float(string):
     str_split = string.split('/')
     return int(str_split[0]) / int(str_split[1])    # unit: mm
 
-def get_data(path):
-    lat0 = None
-    lon0 = None
-    h0 = 0
+def read_metadata(filepath):
+    """
+    Reads position and orientation of one image from its EXIF/XMP data. Module level so it can run in worker processes.
+    :param filepath: Path of a JPEG image
+    :return: latitude, longitude, altitude, yaw, pitch, roll as floats (angles in degrees)
+    """
+    with pyexiv2.Image(filepath) as img:
+        exif = img.read_exif()
+        xmp = img.read_xmp()
+        longitude = convert_dms_to_deg(exif["Exif.GPSInfo.GPSLongitude"])
+        latitude = convert_dms_to_deg(exif["Exif.GPSInfo.GPSLatitude"])
+
+        if exif["Exif.Image.Make"] == "DJI":
+            altitude = float(xmp['Xmp.drone-dji.RelativeAltitude'])
+            roll = float(xmp['Xmp.drone-dji.GimbalRollDegree'])
+            pitch = float(xmp['Xmp.drone-dji.GimbalPitchDegree'])
+            yaw = float(xmp['Xmp.drone-dji.GimbalYawDegree'])
+        elif exif["Exif.Image.Make"] == "samsung":
+            altitude = convert_string_to_float(exif['Exif.GPSInfo.GPSAltitude'])
+            roll = float(xmp['Xmp.DLS.Roll']) * 180 / np.pi
+            pitch = float(xmp['Xmp.DLS.Pitch']) * 180 / np.pi
+            yaw = float(xmp['Xmp.DLS.Yaw']) * 180 / np.pi
+        else:
+            altitude = 0
+            roll = 0
+            pitch = 0
+            yaw = 0
+
+    # with Image.open(filepath) as im:
+    #     for segment, content in im.applist:
+    #         marker, body = content.split(b'\x00', 1)
+    #         # if segment == 'APP1' and marker == 'http://ns.adobe.com/xap/1.0/':
+    #         if segment == 'APP1' :
+    #             soup = BeautifulSoup(body, features='html.parser')
+    #             description = soup.find('x:xmpmeta').find('rdf:rdf').find('rdf:description')
+    #             pitch = float(description['drone-dji:gimbalpitchdegree']) + 90
+    #             yaw = float(description['drone-dji:gimbalyawdegree'])
+    #             roll = float(description['drone-dji:gimbalrolldegree'])
+    #             alt = float(description['drone-dji:relativealtitude'])
+    #             lat, lon = get_gps_coords(im)
+    #             if lat0 is None:
+    #                 lat0 = lat
+    #                 lon0 = lon
+    #             x, y, z = geodetic2ecef(lat, lon, alt)
+    #             x, y, z = ecef2enu(x, y, z, lat0, lon0, h0)
+    #             yield filename, '{:f}'.format(x), '{:f}'.format(y), '{:f}'.format(z), yaw, pitch, roll
+    return latitude, longitude, altitude, yaw, pitch, roll
+
+
+def find_images(path):
+    """
+    :param path: Directory searched recursively for .jpg files
+    :return: List of image paths, sorted by file name
+    """
+    paths = []
     for root, dirs, files in os.walk(path):
-        for filename in sorted(filter(lambda x: os.path.splitext(x)[1].lower() == '.jpg', files)):
-            filepath = os.path.join(root, filename)
-            with pyexiv2.Image(filepath) as img:
-                exif = img.read_exif()
-                xmp = img.read_xmp()
-                longitude = convert_dms_to_deg(exif["Exif.GPSInfo.GPSLongitude"])
-                latitude = convert_dms_to_deg(exif["Exif.GPSInfo.GPSLatitude"])
-
-                if exif["Exif.Image.Make"] == "DJI":
-                    altitude = float(xmp['Xmp.drone-dji.RelativeAltitude'])
-                    roll = float(xmp['Xmp.drone-dji.GimbalRollDegree'])
-                    pitch = float(xmp['Xmp.drone-dji.GimbalPitchDegree'])
-                    yaw = float(xmp['Xmp.drone-dji.GimbalYawDegree'])
-                elif exif["Exif.Image.Make"] == "samsung":
-                    altitude = convert_string_to_float(exif['Exif.GPSInfo.GPSAltitude'])
-                    roll = float(xmp['Xmp.DLS.Roll']) * 180 / np.pi
-                    pitch = float(xmp['Xmp.DLS.Pitch']) * 180 / np.pi
-                    yaw = float(xmp['Xmp.DLS.Yaw']) * 180 / np.pi
-                else:
-                    altitude = 0
-                    roll = 0
-                    pitch = 0
-                    yaw = 0
-                
-                if lat0 is None:
-                    lat0 = latitude
-                    lon0 = longitude
-                x, y, z = geodetic2ecef(latitude, longitude, altitude)
-                x, y, z = ecef2enu(x, y, z, lat0, lon0, h0)
-                # yield filename, '{:f}'.format(x), '{:f}'.format(y), '{:f}'.format(z), yaw, pitch+90.0, roll
-                yield filename, '{:f}'.format(x), '{:f}'.format(y), '{:f}'.format(z), 0.0, pitch+90.0, roll
-
-
-            # with Image.open(filepath) as im:
-            #     for segment, content in im.applist:
-            #         marker, body = content.split(b'\x00', 1)
-            #         # if segment == 'APP1' and marker == 'http://ns.adobe.com/xap/1.0/':
-            #         if segment == 'APP1' :
-            #             soup = BeautifulSoup(body, features='html.parser')
-            #             description = soup.find('x:xmpmeta').find('rdf:rdf').find('rdf:description')
-            #             pitch = float(description['drone-dji:gimbalpitchdegree']) + 90
-            #             yaw = float(description['drone-dji:gimbalyawdegree'])
-            #             roll = float(description['drone-dji:gimbalrolldegree'])
-            #             alt = float(description['drone-dji:relativealtitude'])
-            #             lat, lon = get_gps_coords(im)
-            #             if lat0 is None:
-            #                 lat0 = lat
-            #                 lon0 = lon
-            #             x, y, z = geodetic2ecef(lat, lon, alt)
-            #             x, y, z = ecef2enu(x, y, z, lat0, lon0, h0)
-            #             yield filename, '{:f}'.format(x), '{:f}'.format(y), '{:f}'.format(z), yaw, pitch, roll
-
-
-def main():
-    data = [d for d in get_data('datasets/images')]
-    data = sorted(data, key=lambda x: x[0])
-    x = np.array(map(lambda d: d[1], data))
-    y = np.array(map(lambda d: d[2], data))
-    with open('datasets/imageData.txt', 'w+') as f:
-        for datum in data:
-            f.write(','.join([str(d) for d in datum]) + '\n')
+        for filename in filter(lambda x: os.path.splitext(x)[1].lower() == '.jpg', files):
+            paths.append(os.path.join(root, filename))
+    return sorted(paths, key=lambda x: (os.path.basename(x), x))
+
+
+def read_all_metadata(paths, workers=1, cache_file=None):
+    """
+    Reads the metadata of many images in parallel. Results are cached in an .npz file keyed by file path and
+    modification time, so only new or changed images are read again.
+    :param paths: List of image paths
+    :param workers: Number of worker processes
+    :param cache_file: Optional .npz pose index written by main(). None disables the cache.
+    :return: Nx6 ndArray of [latitude, longitude, altitude, yaw, pitch, roll] rows in the order of paths
+    """
+    mtimes = np.array([os.path.getmtime(p) for p in paths], dtype=float)
+    cached = {}
+    if cache_file is not None and os.path.isfile(cache_file):
+        with np.load(cache_file) as index:
+            for p, mtime, row in zip(index['paths'], index['mtimes'], index['metadata']):
+                cached[str(p)] = (mtime, row)
+    metadata = np.zeros((len(paths), 6))
+    missing = []
+    for i, p in enumerate(paths):
+        if p in cached and cached[p][0] == mtimes[i]:
+            metadata[i] = cached[p][1]
+        else:
+            missing.append(i)
+    for i, row in zip(missing, util.parallelMap(read_metadata, [(paths[i],) for i in missing], workers)):
+        metadata[i] = row
+    return metadata
+
+
+def to_poses(metadata):
+    """
+    Converts GPS positions into a local East-North-Up frame with its origin at the first image.
+    :param metadata: Nx6 ndArray of [latitude, longitude, altitude, yaw, pitch, roll] rows
+    :return: Nx6 pose matrix in [X,Y,Z,Y,P,R] format, as used by utilities.importData()
+    """
+    if len(metadata) == 0:
+        return np.zeros((0, 6))
+    lat0, lon0, h0 = metadata[0, 0], metadata[0, 1], 0
+    x, y, z = geodetic2ecef(metadata[:, 0], metadata[:, 1], metadata[:, 2])
+    x, y, z = ecef2enu(x, y, z, lat0, lon0, h0)
+    # return np.column_stack((x, y, z, metadata[:, 3], metadata[:, 4] + 90.0, metadata[:, 5]))
+    return np.column_stack((x, y, z, np.zeros(len(metadata)), metadata[:, 4] + 90.0, metadata[:, 5]))
+
+
+def get_data(path, workers=1, cache_file=None):
+    paths = find_images(path)
+    poses = to_poses(read_all_metadata(paths, workers, cache_file))
+    for filepath, pose in zip(paths, poses):
+        x, y, z, yaw, pitch, roll = pose
+        yield os.path.basename(filepath), '{:f}'.format(x), '{:f}'.format(y), '{:f}'.format(z), float(yaw), float(pitch), float(roll)
+
+
+def main(path='datasets/images', output='datasets/imageData.txt', workers=None):
+    """
+    Metadata ingestion. Writes the pose data file read by utilities.importData(), and next to it a binary pose index
+    (same name, .npz) that importData() can load directly and that caches the metadata of every image.
+    :param path: Directory with the images
+    :param output: Pose data file in string form e.g. "datasets/imageData.txt"
+    :param workers: Number of worker processes. All cores if None.
+    :return:
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    index_file = os.path.splitext(output)[0] + '.npz'
+    paths = find_images(path)
+    metadata = read_all_metadata(paths, workers, index_file)
+    poses = to_poses(metadata)
+    file_names = np.array([os.path.basename(p) for p in paths])
+    with open(output, 'w+') as f:
+        for name, pose in zip(file_names, poses):
+            f.write(','.join([name] + ['{:f}'.format(d) for d in pose[:3]] + [str(d) for d in pose[3:]]) + '\n')
+    np.savez(index_file, fileNames=file_names, dataMatrix=poses, paths=np.array(paths), mtimes=np.array([os.path.getmtime(p) for p in paths], dtype=float),
+             metadata=metadata, origin=metadata[0, :3] if len(metadata) else np.zeros(3))
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Read image positions and orientations into a pose data file.')
+    parser.add_argument('images', nargs='?', default='datasets/images', help='directory with the images')
+    parser.add_argument('--output', default='datasets/imageData.txt', help='pose data file, a .npz pose index is written next to it')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, all cores by default')
+    args = parser.parse_args()
+    main(args.images, args.output, args.workers)
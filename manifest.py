@@ -0,0 +1,124 @@
+import os
+import json
+import numpy as np
+
+
+PENDING = "pending"
+REGISTERED = "registered"
+COMPOSITED = "composited"
+
+def replaceAtomically(path, write):
+    '''
+    :param path: Destination file path
+    :param write: Function writing the file content to the path it is given
+    :return:
+    '''
+    temporary = path + ".tmp"
+    write(temporary)
+    os.replace(temporary, path)
+
+
+class JobManifest:
+    def __init__(self, directory):
+        '''
+        Persisted state of a mosaic job, so an interrupted run resumes where it stopped and images appended to a flight
+        are registered and composited without redoing the finished ones. Images are identified by file name.
+        Small state (per-image status, transforms, canvas state and frame) is kept in manifest.json, registration results of
+        image pairs in pairs.npz.
+        :param directory: Job directory, e.g. "results/job/"
+        :return:
+        '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.settings = {} #parameters that must not change between runs of the same job
+        self.images = {} #name -> {"status": ..., "transform": 3x3 list or None}
+        self.canvas = None #canvas state, see canvas.Canvas.saveState()
+        self.frame = None #3x3 list mapping the mosaic frame into the canvas, see Combiner.outputFrame()
+        self.pairs = {} #(name1, name2) -> (H or None, matches, inliers, points1, points2)
+
+    @property
+    def manifestPath(self):
+        return os.path.join(self.directory, "manifest.json")
+
+    @property
+    def pairsPath(self):
+        return os.path.join(self.directory, "pairs.npz")
+
+    def load(self):
+        '''
+        :return: True if a previous state of the job was found
+        '''
+        if not os.path.isfile(self.manifestPath):
+            return False
+        with open(self.manifestPath) as file:
+            state = json.load(file)
+        self.settings = state["settings"]
+        self.images = state["images"]
+        self.canvas = state["canvas"]
+        self.frame = state.get("frame") #missing in manifests of older jobs
+        self.pairs = {}
+        if os.path.isfile(self.pairsPath):
+            with np.load(self.pairsPath) as pairs:
+                matchEnds = np.cumsum(pairs["matchCounts"])
+                pointEnds = np.cumsum(pairs["pointCounts"])
+                for k, (name1, name2) in enumerate(pairs["names"]):
+                    matches = slice(matchEnds[k] - pairs["matchCounts"][k], matchEnds[k])
+                    points = slice(pointEnds[k] - pairs["pointCounts"][k], pointEnds[k])
+                    H = None if np.isnan(pairs["transforms"][k]).any() else pairs["transforms"][k]
+                    self.pairs[(str(name1), str(name2))] = (H, pairs["matches"][matches], pairs["inliers"][matches],
+                                                            pairs["points"][points, :2], pairs["points"][points, 2:])
+        return True
+
+    def save(self):
+        '''
+        Writes manifest.json. Files are replaced atomically, so a crash never leaves a half written manifest.
+        :return:
+        '''
+        state = {"settings": self.settings, "images": self.images, "canvas": self.canvas, "frame": self.frame}
+        def write(path):
+            with open(path, "w") as file:
+                json.dump(state, file)
+        replaceAtomically(self.manifestPath, write)
+
+    def savePairs(self):
+        '''
+        Writes pairs.npz. Only needed after the registration stage found new pairs.
+        :return:
+        '''
+        keys = sorted(self.pairs)
+        entries = [self.pairs[key] for key in keys]
+        arrays = {"names": np.array(keys, dtype=str).reshape(-1, 2),
+                  "transforms": np.array([np.full((3, 3), np.nan) if H is None else H for H, m, i, p1, p2 in entries]).reshape(-1, 3, 3),
+                  "matchCounts": np.int64([len(m) for H, m, i, p1, p2 in entries]),
+                  "matches": np.vstack([np.int32(m).reshape(-1, 2) for H, m, i, p1, p2 in entries] or [np.zeros((0, 2), np.int32)]),
+                  "inliers": np.concatenate([np.bool_(i).ravel() for H, m, i, p1, p2 in entries] or [np.zeros(0, bool)]),
+                  "pointCounts": np.int64([len(p1) for H, m, i, p1, p2 in entries]),
+                  "points": np.vstack([np.hstack((np.float32(p1).reshape(-1, 2), np.float32(p2).reshape(-1, 2))) for H, m, i, p1, p2 in entries] or [np.zeros((0, 4), np.float32)])}
+        def write(path):
+            with open(path, "wb") as file:
+                np.savez(file, **arrays)
+        replaceAtomically(self.pairsPath, write)
+
+    def checkSettings(self, settings):
+        '''
+        Stores the settings of a new job, or makes sure a resumed job runs with the settings it was started with.
+        :param settings: Dictionary of JSON serializable values
+        :return:
+        '''
+        if self.settings and self.settings != settings:
+            raise ValueError("Job in "+self.directory+" was started with different settings: "+str(self.settings))
+        self.settings = dict(settings)
+
+    def status(self, name):
+        return self.images.get(name, {}).get("status", PENDING)
+
+    def transform(self, name):
+        '''
+        :return: 3x3 ndArray of the image, or None if it is not known yet
+        '''
+        transform = self.images.get(name, {}).get("transform")
+        return None if transform is None else np.array(transform)
+
+    def setImage(self, name, status, transform=None):
+        self.images[name] = {"status": status, "transform": None if transform is None else np.asarray(transform).tolist()}
@@ -0,0 +1,198 @@
+import cv2
+import numpy as np
+
+
+#number of set bits of every byte value, for Hamming distances of binary descriptors
+POPCOUNT = np.uint8([bin(i).count("1") for i in range(256)])
+
+def isBinary(descriptors):
+    '''
+    :return: True for binary descriptors (ORB, AKAZE) compared with the Hamming norm, False for float descriptors (SIFT)
+    '''
+    return descriptors.dtype == np.uint8
+
+def ratioTest(knnMatches, ratio):
+    '''
+    Vectorized Lowe ratio test on the output of an OpenCV knnMatch() call with k=2.
+    :param knnMatches: List of lists of cv2.DMatch
+    :param ratio: Ratio test threshold
+    :return: Kx2 int32 ndArray of [query index, train index] for every good match
+    '''
+    table = np.float64([(p[0].queryIdx, p[0].trainIdx, p[0].distance, p[1].distance) for p in knnMatches if len(p) == 2]).reshape(-1, 4)
+    good = table[:, 2] < ratio*table[:, 3]
+    return np.int32(table[good, :2]).reshape(-1, 2)
+
+def descriptorDistances(descriptors2, descriptors1):
+    '''
+    :param descriptors2: KxD descriptors
+    :param descriptors1: KxD descriptors, compared row by row with descriptors2
+    :return: K ndArray of Hamming (binary descriptors) or L2 (float descriptors) distances
+    '''
+    if isBinary(descriptors2):
+        return POPCOUNT[np.bitwise_xor(descriptors2, descriptors1)].sum(axis=1, dtype=np.int32).astype(np.float32)
+    return np.linalg.norm(np.float32(descriptors2) - np.float32(descriptors1), axis=1)
+
+
+class BruteForceMatcher:
+    def __init__(self, ratio=0.55):
+        '''
+        Exhaustive matching with the norm that fits the descriptors: Hamming for binary, L2 for float descriptors.
+        :param ratio: Lowe ratio test threshold
+        :return:
+        '''
+        self.ratio = ratio
+
+    def match(self, keypoints2, descriptors2, keypoints1, descriptors1, initial=None):
+        '''
+        :param keypoints2: Nx7 keypoint array of the image to register (query), see features.keypointsToArray()
+        :param descriptors2: Descriptors of the image to register
+        :param keypoints1: Mx7 keypoint array of the reference image (train)
+        :param descriptors1: Descriptors of the reference image
+        :param initial: Approximate 3x3 transformation from image 2 into image 1. Not used by this backend.
+        :return: Kx2 int32 ndArray of [index in image 2, index in image 1] for every good match
+        '''
+        if len(descriptors1) < 2 or len(descriptors2) < 2:
+            return np.zeros((0, 2), dtype=np.int32)
+        matcher = cv2.BFMatcher(cv2.NORM_HAMMING if isBinary(descriptors2) else cv2.NORM_L2)
+        return ratioTest(matcher.knnMatch(descriptors2, descriptors1, k=2), self.ratio)
+
+
+class FlannMatcher(BruteForceMatcher):
+    def __init__(self, ratio=0.55, tableNumber=6, keySize=12, multiProbeLevel=1, checks=50):
+        '''
+        Approximate nearest neighbour matching with FLANN. Binary descriptors use an LSH index, float descriptors KD-trees.
+        :param ratio: Lowe ratio test threshold
+        :param tableNumber: Number of LSH hash tables
+        :param keySize: LSH hash key length in bits
+        :param multiProbeLevel: Number of neighbouring LSH buckets searched
+        :param checks: Number of leaves visited per query
+        :return:
+        '''
+        self.ratio = ratio
+        self.tableNumber = tableNumber
+        self.keySize = keySize
+        self.multiProbeLevel = multiProbeLevel
+        self.checks = checks
+
+    def match(self, keypoints2, descriptors2, keypoints1, descriptors1, initial=None):
+        if len(descriptors1) < 2 or len(descriptors2) < 2:
+            return np.zeros((0, 2), dtype=np.int32)
+        if isBinary(descriptors2):
+            indexParams = dict(algorithm=6, table_number=self.tableNumber, key_size=self.keySize, multi_probe_level=self.multiProbeLevel) #FLANN_INDEX_LSH
+        else:
+            indexParams = dict(algorithm=1, trees=5) #FLANN_INDEX_KDTREE
+            descriptors2, descriptors1 = np.float32(descriptors2), np.float32(descriptors1)
+        matcher = cv2.FlannBasedMatcher(indexParams, dict(checks=self.checks))
+        return ratioTest(matcher.knnMatch(descriptors2, descriptors1, k=2), self.ratio)
+
+
+class PriorMatcher(BruteForceMatcher):
+    def __init__(self, window, ratio=0.55, fallbackShare=0.01, chunkSize=16384):
+        '''
+        Matching restricted by a position prior, e.g. from GPS positions or a coarser registration. A keypoint of image 2
+        is only compared with the keypoints of image 1 within window pixels of its predicted position, so the cost
+        grows with the number of keypoints in the window rather than in the whole image.
+        :param window: Search radius around the predicted position, in pixels of image 1
+        :param ratio: Lowe ratio test threshold, applied among the keypoints in the window
+        :param fallbackShare: If the window covers more than this share of the area of the keypoints of image 1, the
+            vectorized window search costs more than exhaustive matching with OpenCV. On ORB features that happens at about
+            1%, a window of 30 to 50 pixels on 1000 pixel images.
+        :param chunkSize: Number of candidate pairs whose descriptor distances are computed at once, which bounds the
+            temporary memory
+        :return:
+        '''
+        self.window = window
+        self.ratio = ratio
+        self.fallbackShare = fallbackShare
+        self.chunkSize = chunkSize
+
+    def match(self, keypoints2, descriptors2, keypoints1, descriptors1, initial=None):
+        '''
+        See BruteForceMatcher.match(). Without initial, this falls back to exhaustive matching.
+        '''
+        if initial is None:
+            return BruteForceMatcher.match(self, keypoints2, descriptors2, keypoints1, descriptors1)
+        if len(descriptors1) == 0 or len(descriptors2) == 0:
+            return np.zeros((0, 2), dtype=np.int32)
+        predicted = cv2.perspectiveTransform(np.float32(keypoints2[:, :2]).reshape(-1, 1, 2), np.float64(initial)).reshape(-1, 2)
+        extent = np.ptp(keypoints1[:, :2], axis=0)
+        if np.pi*self.window**2 > self.fallbackShare*extent[0]*extent[1]:
+            matches = BruteForceMatcher.match(self, keypoints2, descriptors2, keypoints1, descriptors1)
+            near = np.linalg.norm(predicted[matches[:, 0]] - keypoints1[matches[:, 1], :2], axis=1) <= self.window
+            return matches[near]
+        #candidate pairs through a grid over image 1 with cells as large as the window
+        cells1 = np.int64(np.floor(keypoints1[:, :2]/self.window))
+        cells2 = np.int64(np.floor(predicted/self.window))
+        allCells = np.vstack((cells1, cells2))
+        offset = allCells.min(axis=0) - 1 #margin of one cell, so neighbouring cell keys never wrap into another row
+        width = allCells[:, 0].max() - offset[0] + 2
+        keys1 = (cells1[:, 1] - offset[1])*width + (cells1[:, 0] - offset[0])
+        order1 = np.argsort(keys1)
+        sortedKeys1 = keys1[order1]
+        queries, candidates = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                keys2 = (cells2[:, 1] + dy - offset[1])*width + (cells2[:, 0] + dx - offset[0])
+                starts = np.searchsorted(sortedKeys1, keys2, side="left")
+                ends = np.searchsorted(sortedKeys1, keys2, side="right")
+                counts = ends - starts
+                query = np.repeat(np.arange(len(keys2)), counts)
+                position = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+                queries.append(query)
+                candidates.append(order1[position])
+        query = np.concatenate(queries)
+        train = np.concatenate(candidates)
+        near = np.linalg.norm(predicted[query] - keypoints1[train, :2], axis=1) <= self.window
+        query, train = query[near], train[near]
+        if len(query) == 0:
+            return np.zeros((0, 2), dtype=np.int32)
+        distances = np.empty(len(query), dtype=np.float32)
+        for start in range(0, len(query), self.chunkSize):
+            distances[start:start+self.chunkSize] = descriptorDistances(descriptors2[query[start:start+self.chunkSize]],
+                                                                        descriptors1[train[start:start+self.chunkSize]])
+        #best and second best candidate of every query keypoint
+        order = np.lexsort((distances, query))
+        query, train, distances = query[order], train[order], distances[order]
+        first = np.r_[True, query[1:] != query[:-1]]
+        firstIndex = np.nonzero(first)[0]
+        hasSecond = np.r_[firstIndex[1:] - firstIndex[:-1] > 1, len(query) - firstIndex[-1] > 1]
+        secondDistance = np.full(len(firstIndex), np.inf)
+        secondDistance[hasSecond] = distances[firstIndex[hasSecond] + 1]
+        good = distances[firstIndex] < self.ratio*secondDistance
+        query, train, distances = query[firstIndex][good], train[firstIndex][good], distances[firstIndex][good]
+        #a reference keypoint keeps only its closest query, windows are small enough for one keypoint to win many of them
+        order = np.lexsort((distances, train))
+        query, train = query[order], train[order]
+        unique = np.ones(len(train), dtype=bool)
+        unique[1:] = train[1:] != train[:-1]
+        return np.int32(np.column_stack((query[unique], train[unique]))).reshape(-1, 2)
+
+
+def gpsWindow(gpsAccuracy, metersPerPixel, longSide, offset=0.0, scaleError=0.5):
+    '''
+    Search window of a PriorMatcher whose prior comes from GPS positions. Both positions can be off by the GPS
+    accuracy, and errors of the heading add an error that grows towards the border of the image. The pixels per meter
+    follow from the altitude and an assumed field of view, so the predicted offset can be off by a share of its length.
+    :param gpsAccuracy: Horizontal accuracy of the GPS positions in meters
+    :param metersPerPixel: Ground sample distance of the matched images
+    :param longSide: Long side of the matched images in pixels
+    :param offset: Typical distance of the camera positions of a pair in pixels
+    :param scaleError: Relative error of metersPerPixel
+    :return: Window in pixels
+    '''
+    return 2*gpsAccuracy/metersPerPixel + 0.05*longSide + scaleError*offset
+
+def createMatcher(name, window=None, ratio=0.55):
+    '''
+    :param name: "bruteforce", "flann" or "prior"
+    :param window: Search window of the "prior" backend in pixels
+    :param ratio: Lowe ratio test threshold
+    :return: Matcher object with a match() method, see BruteForceMatcher.match()
+    '''
+    if name == "bruteforce":
+        return BruteForceMatcher(ratio)
+    if name == "flann":
+        return FlannMatcher(ratio)
+    if name == "prior":
+        return PriorMatcher(window, ratio)
+    raise ValueError("Unknown matcher "+str(name))
@@ -0,0 +1,113 @@
+import math as m
+import numpy as np
+
+
+def consecutivePairs(count):
+    '''
+    :param count: Number of images
+    :return: List of (index1, index2) pairs of images that follow each other in the dataset
+    '''
+    return [(i-1, i) for i in range(1, count)]
+
+def footprintSizes(dataMatrix, fieldOfView=73.7):
+    '''
+    Estimates the ground footprint of every image from its altitude, assuming a nadir camera over flat ground.
+    :param dataMatrix: Nx6 pose matrix in [X,Y,Z,Y,P,R] format. Z is the height above ground.
+    :param fieldOfView: Horizontal field of view of the camera in degrees (73.7 for the DJI Phantom 4).
+    :return: N ndArray of footprint widths, in pose units
+    '''
+    return 2*np.abs(np.float64(dataMatrix)[:, 2])*m.tan(fieldOfView*np.pi/360)
+
+
+class GridIndex:
+    def __init__(self, points, cellSize):
+        '''
+        Uniform grid over 2D points. Neighbour queries only look at nearby cells, so building the index and finding
+        the neighbours of every point grows linearly with the number of points.
+        :param points: Nx2 ndArray of positions e.g. the ENU X/Y of every image
+        :param cellSize: Grid cell width, in the units of points. Best set to the typical query radius.
+        :return:
+        '''
+        self.points = np.float64(points).reshape(-1, 2)
+        self.cellSize = float(cellSize)
+        self.cells = {} #(cellX, cellY) -> ndArray of point indices
+        cellIndices = np.int64(np.floor(self.points/self.cellSize))
+        order = np.lexsort((cellIndices[:, 1], cellIndices[:, 0]))
+        keys, starts = np.unique(cellIndices[order], axis=0, return_index=True)
+        for key, indices in zip(keys, np.split(order, starts[1:])):
+            self.cells[(int(key[0]), int(key[1]))] = indices
+
+    def candidates(self, point, rings):
+        '''
+        :return: Indices of all points in the cells at most rings cells away from the cell of point
+        '''
+        cellX, cellY = np.int64(np.floor(np.float64(point)/self.cellSize))
+        found = [self.cells[(x, y)] for x in range(cellX-rings, cellX+rings+1) for y in range(cellY-rings, cellY+rings+1) if (x, y) in self.cells]
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+    def queryRadius(self, point, radius):
+        '''
+        :param point: 2 element position
+        :param radius: Search radius
+        :return: Indices of all points within radius of point
+        '''
+        indices = self.candidates(point, int(m.ceil(radius/self.cellSize)))
+        distances = np.linalg.norm(self.points[indices] - np.float64(point), axis=1)
+        return indices[distances <= radius]
+
+    def queryNearest(self, point, k):
+        '''
+        :param point: 2 element position
+        :param k: Number of neighbours
+        :return: Indices of the k points closest to point, closest first. Includes point itself if it is indexed.
+        '''
+        k = min(k, len(self.points))
+        rings = 1
+        while True:
+            indices = self.candidates(point, rings)
+            distances = np.linalg.norm(self.points[indices] - np.float64(point), axis=1)
+            #everything within rings cell widths has been seen, so the k closest found so far are final if inside that distance
+            if len(indices) >= k and np.sort(distances)[k-1] <= rings*self.cellSize:
+                return indices[np.argsort(distances)[:k]]
+            if len(indices) == len(self.points):
+                return indices[np.argsort(distances)[:k]]
+            rings += 1
+
+
+def candidatePairs(dataMatrix, radius=None, k=None, fieldOfView=73.7, minOverlap=0.3):
+    '''
+    Finds image pairs that are likely to overlap from the camera positions, so only those pairs have to be matched.
+    Non-consecutive overlaps (e.g. neighbouring legs of a lawnmower pattern) are found as well.
+    :param dataMatrix: Nx6 pose matrix in [X,Y,Z,Y,P,R] format
+    :param radius: Maximum distance between camera positions, in pose units. If None, it is derived per pair from
+        the footprints estimated from altitude, or from the spacing of consecutive images if altitudes are missing.
+    :param k: If given, pair every image with its k nearest neighbours instead of using a radius.
+    :param fieldOfView: Horizontal field of view of the camera in degrees, used for the footprint estimate.
+    :param minOverlap: Minimum expected overlap as a fraction of the footprint, used for the footprint estimate.
+    :return: Sorted list of (index1, index2) pairs with index1 < index2
+    '''
+    positions = np.float64(dataMatrix)[:, :2]
+    if len(positions) < 2:
+        return []
+    pairs = set()
+    if k is not None:
+        index = GridIndex(positions, np.median(np.linalg.norm(np.diff(positions, axis=0), axis=1)) or 1.0)
+        for i in range(0, len(positions)):
+            for j in index.queryNearest(positions[i], k+1):
+                if j != i:
+                    pairs.add((min(i, int(j)), max(i, int(j))))
+        return sorted(pairs)
+    if radius is None:
+        maxDistances = footprintSizes(dataMatrix, fieldOfView)*(1 - minOverlap)
+        if not np.all(maxDistances > 0): #no altitude, fall back to the spacing of consecutive images
+            maxDistances = np.full(len(positions), 2*np.median(np.linalg.norm(np.diff(positions, axis=0), axis=1)))
+    else:
+        maxDistances = np.full(len(positions), float(radius))
+    index = GridIndex(positions, maxDistances.max() or 1.0)
+    for i in range(0, len(positions)):
+        neighbours = index.queryRadius(positions[i], maxDistances.max())
+        neighbours = neighbours[neighbours > i]
+        distances = np.linalg.norm(positions[neighbours] - positions[i], axis=1)
+        for j in neighbours[distances <= (maxDistances[i] + maxDistances[neighbours])/2]:
+            pairs.add((i, int(j)))
+    return sorted(pairs)
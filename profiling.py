@@ -0,0 +1,136 @@
+import os
+import csv
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError: #not available on Windows, peak RSS is then not reported
+    resource = None
+
+
+def peakRss():
+    '''
+    :return: Peak resident set size in bytes of this process and of its finished worker processes, None if unknown
+    '''
+    if resource is None:
+        return None
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return 1024*max(own, children) #kilobytes on Linux
+
+
+class Profiler:
+    def __init__(self, profilePath=None):
+        '''
+        Collects wall time, CPU time and peak RSS of the pipeline stages, plus values such as match counts or the canvas
+        size. Stages are timed with stage(), values without timing are added with record(). CPU time is that of this
+        process only, work done in worker processes is not part of it. Code running in workers measures itself and is
+        added with record(), e.g. the "detect" and "pair" records of Combiner.register().
+        :param profilePath: Optional path of a cProfile dump of everything between start() and stop()
+        :return:
+        '''
+        self.records = []
+        self.openStages = [] #records of the stages currently running, innermost last
+        self.profilePath = profilePath
+        self.profile = None
+        self.started = None
+
+    @contextmanager
+    def stage(self, name, **values):
+        '''
+        Times the code inside a with block.
+        :param name: Stage name e.g. "decode", "detect", "match"
+        :param values: Extra columns of the record e.g. index=3
+        :return: The record dictionary, more values can be added to it inside the block
+        '''
+        record = dict(stage=name, **values)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        self.openStages.append(record)
+        try:
+            yield record
+        finally:
+            record["wall"] = time.perf_counter() - wall
+            record["cpu"] = time.process_time() - cpu
+            record["peakRss"] = peakRss()
+            self.openStages.pop()
+            if self.openStages: #the enclosing stage reports its time without this one in summary()
+                parent = self.openStages[-1]
+                parent["nestedWall"] = parent.get("nestedWall", 0.0) + record["wall"]
+                parent["nestedCpu"] = parent.get("nestedCpu", 0.0) + record["cpu"]
+            self.records.append(record)
+
+    def record(self, name, **values):
+        '''
+        Adds a record without timing.
+        :return:
+        '''
+        self.records.append(dict(stage=name, peakRss=peakRss(), **values))
+
+    def start(self):
+        self.started = (time.perf_counter(), time.process_time())
+        if self.profilePath is not None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.profilePath)
+            self.profile = None
+        if self.started is not None:
+            self.records.append(dict(stage="total", wall=time.perf_counter() - self.started[0],
+                                     cpu=time.process_time() - self.started[1], peakRss=peakRss()))
+            self.started = None
+
+    def summary(self):
+        '''
+        :return: Dictionary of stage name -> {"count", "wall", "cpu", ...} totals. Only keys present in the records of a
+            stage are summed, e.g. "wall"/"cpu" for timed stages, "matches"/"inliers"/"match"/"ransac"/"registerCpu" for
+            pairs and "keypoints"/"detect"/"detectCpu" for the detection of an image in a worker. The wall and CPU time
+            of a stage leave out the stages nested inside it (e.g. "decode" inside "combine"), so no time is counted twice.
+        '''
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record["stage"], {"count": 0})
+            total["count"] += 1
+            for key in ("wall", "cpu", "match", "ransac", "registerCpu", "matches", "inliers", "keypoints", "detect", "detectCpu"):
+                if key in record:
+                    total[key] = total.get(key, 0.0) + record[key]
+            for key, nested in (("wall", "nestedWall"), ("cpu", "nestedCpu")):
+                if nested in record:
+                    total[key] -= record[nested]
+        return totals
+
+    def write(self, prefix):
+        '''
+        Writes prefix.json (summary and all records) and prefix.csv (one row per record).
+        :param prefix: Output path without extension e.g. "results/profile"
+        :return:
+        '''
+        directory = os.path.dirname(prefix)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(prefix + ".json", "w") as file:
+            json.dump({"summary": self.summary(), "records": self.records}, file, indent=1)
+        columns = []
+        for record in self.records:
+            columns += [key for key in record if key not in columns]
+        with open(prefix + ".csv", "w") as file:
+            writer = csv.DictWriter(file, columns)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+
+@contextmanager
+def stage(profiler, name, **values):
+    '''
+    Profiler.stage() that does nothing if profiler is None, so instrumented code does not need to check for it.
+    '''
+    if profiler is None:
+        yield {}
+    else:
+        with profiler.stage(name, **values) as record:
+            yield record
@@ -0,0 +1,168 @@
+import time
+import cv2
+import numpy as np
+import utilities as util
+import matching
+
+
+def matchFeatures(descriptors2, descriptors1, ratio=0.55):
+    '''
+    :param descriptors2: Descriptors of the image to register (query)
+    :param descriptors1: Descriptors of the reference image (train)
+    :param ratio: Lowe ratio test threshold
+    :return: Kx2 int32 ndArray of [index in image 2, index in image 1] for every good match
+    '''
+    return matching.BruteForceMatcher(ratio).match(None, descriptors2, None, descriptors1)
+
+def estimateTransform(src_pts, dst_pts):
+    '''
+    :param src_pts: Nx2 ndArray of locations in image 2
+    :param dst_pts: Nx2 ndArray of the matching locations in image 1
+    :return: H: 3x3 ndArray mapping image 2 into image 1 (None if no transformation was found), inliers: N boolean ndArray
+    '''
+    src_pts = np.float32(src_pts).reshape(-1,1,2)
+    dst_pts = np.float32(dst_pts).reshape(-1,1,2)
+    if len(src_pts) < 3: #not enough matches for any estimate
+        return None, np.zeros(len(src_pts), dtype=bool)
+    '''
+    Compute Affine Transform
+    Idea: Because we corrected for camera orientation, an affine transformation *should* be enough to align the images
+    '''
+    A, inliers = cv2.estimateAffinePartial2D(src_pts,dst_pts) #only 4 DOF. we removed 3 DOF when we unrotated
+    if A is not None and abs(np.linalg.det(A[:,:2])) > 1e-2: #a collapsed estimate means the matches are degenerate
+        return np.vstack((A,[0,0,1])), inliers.ravel() > 0
+    #RANSAC sometimes fails in estimateAffinePartial2D(). If so, try full homography. OpenCV RANSAC implementation for homography is more robust.
+    if len(src_pts) < 4:
+        return None, np.zeros(len(src_pts), dtype=bool)
+    H, inliers = cv2.findHomography(src_pts,dst_pts,method=cv2.RANSAC)
+    if H is None:
+        return None, np.zeros(len(src_pts), dtype=bool)
+    return H, inliers.ravel() > 0
+
+def estimateTransformEarly(src_pts, dst_pts, distances, minInliers, threshold=3.0):
+    '''
+    Progressive RANSAC. The transform is first estimated from the matches with the best descriptor distances only,
+    which have a high inlier ratio, so RANSAC needs few iterations on few points. It stops as soon as the estimate has
+    minInliers inliers among all matches, and only falls back to estimateTransform() on all matches if it never does.
+    :param src_pts: Nx2 ndArray of locations in image 2
+    :param dst_pts: Nx2 ndArray of the matching locations in image 1
+    :param distances: N ndArray of the descriptor distances of the matches
+    :param minInliers: Number of inliers that is enough to accept a transform
+    :param threshold: Reprojection error in pixels up to which a match is an inlier, as in OpenCV's RANSAC
+    :return: See estimateTransform()
+    '''
+    src_pts = np.float32(src_pts).reshape(-1,2)
+    dst_pts = np.float32(dst_pts).reshape(-1,2)
+    order = np.argsort(distances, kind="stable")
+    count = 2*minInliers
+    while count < len(order):
+        subset = order[:count]
+        H, subsetInliers = estimateTransform(src_pts[subset], dst_pts[subset])
+        if H is not None:
+            projected = cv2.perspectiveTransform(src_pts.reshape(-1,1,2), H).reshape(-1,2)
+            inliers = np.linalg.norm(projected - dst_pts, axis=1) <= threshold
+            if inliers.sum() >= minInliers:
+                #final estimate from all inliers, nearly outlier free, so RANSAC ends after a few iterations
+                refined, refinedInliers = estimateTransform(src_pts[inliers], dst_pts[inliers])
+                if refined is not None and refinedInliers.sum() >= minInliers:
+                    projected = cv2.perspectiveTransform(src_pts.reshape(-1,1,2), refined).reshape(-1,2)
+                    return refined, np.linalg.norm(projected - dst_pts, axis=1) <= threshold
+                return H, inliers
+        count *= 2
+    return estimateTransform(src_pts, dst_pts)
+
+def radiusTest(points1, points2, radius, window):
+    '''
+    Rotation free position prior. If only the distance d of the image centers is known, a point at distance r from the
+    center of image 2 lies between |r - d| and r + d from the center of image 1, whatever the rotation between the images.
+    :param points1: Nx2 ndArray of points in image 1
+    :param points2: Nx2 ndArray of the corresponding points in image 2
+    :param radius: (center of image 1, center of image 2, distance of the centers) in pixels of image 1
+    :param window: Tolerance in pixels
+    :return: N boolean ndArray marking the pairs of points that fit the prior
+    '''
+    center1, center2, distance = radius
+    radius1 = np.linalg.norm(np.float64(points1).reshape(-1,2) - center1, axis=1)
+    radius2 = np.linalg.norm(np.float64(points2).reshape(-1,2) - center2, axis=1)
+    return (radius1 >= np.abs(radius2 - distance) - window) & (radius1 <= radius2 + distance + window)
+
+def registerPair(keypoints1, descriptors1, keypoints2, descriptors2, initial=None, window=None, matcher=None, timed=False, minInliers=None, radius=None):
+    '''
+    Registers image 2 against image 1 using only their features. Module level so that it can be sent to worker processes.
+    :param keypoints1: Nx7 keypoint array of image 1 (see features.keypointsToArray())
+    :param descriptors1: Descriptors of image 1
+    :param keypoints2: Mx7 keypoint array of image 2
+    :param descriptors2: Descriptors of image 2
+    :param initial: Optional 3x3 ndArray, a known approximate transformation from image 2 into image 1
+    :param window: With initial, only matches that land within this many pixels of their prediction are kept
+    :param matcher: Matcher backend from the matching module. None uses brute force matching.
+    :param timed: Also return the time spent matching and estimating the transform, measured in the process that runs it
+    :param minInliers: Optional number of inliers after which the transform is accepted without looking at the
+        remaining matches, see estimateTransformEarly(). None runs RANSAC on all matches.
+    :param radius: Optional prior used instead of initial if only the distance of the image centers is known, see
+        radiusTest(). Matches and the transform are then checked against it with window as tolerance.
+    :return: H: 3x3 ndArray mapping image 2 into image 1 (None if registration failed),
+        matches: Kx2 ndArray of [keypoint index in image 2, keypoint index in image 1],
+        inliers: K boolean ndArray marking the matches consistent with H,
+        with timed also timings: dictionary of "match" and "ransac" wall seconds and "cpu" seconds of both
+    '''
+    start = time.perf_counter()
+    startCpu = time.process_time()
+    if matcher is None:
+        matcher = matching.BruteForceMatcher()
+    matches = matcher.match(keypoints2, descriptors2, keypoints1, descriptors1, initial)
+    src_pts = keypoints2[matches[:,0], :2]
+    dst_pts = keypoints1[matches[:,1], :2]
+    if initial is not None and window is not None and len(matches) > 0: #guided matching, drop matches far from where they are predicted
+        predicted = cv2.perspectiveTransform(np.float32(src_pts).reshape(-1,1,2), np.float64(initial)).reshape(-1,2)
+        near = np.linalg.norm(predicted - dst_pts, axis=1) <= window
+        matches, src_pts, dst_pts = matches[near], src_pts[near], dst_pts[near]
+    elif radius is not None and window is not None and len(matches) > 0:
+        near = radiusTest(dst_pts, src_pts, radius, window)
+        matches, src_pts, dst_pts = matches[near], src_pts[near], dst_pts[near]
+    matched = time.perf_counter()
+    if minInliers is None:
+        H, inliers = estimateTransform(src_pts, dst_pts)
+    else:
+        distances = matching.descriptorDistances(descriptors2[matches[:,0]], descriptors1[matches[:,1]])
+        H, inliers = estimateTransformEarly(src_pts, dst_pts, distances, minInliers)
+    if H is not None and initial is not None and window is not None: #reject transforms that contradict the prior
+        center = np.float32(src_pts).mean(axis=0).reshape(-1,1,2)
+        if np.linalg.norm(cv2.perspectiveTransform(center, H) - cv2.perspectiveTransform(center, np.float64(initial))) > window:
+            H, inliers = None, np.zeros(len(matches), dtype=bool)
+    elif H is not None and radius is not None and window is not None:
+        center = cv2.perspectiveTransform(np.float64(radius[1]).reshape(-1,1,2), H).reshape(2)
+        if abs(np.linalg.norm(center - radius[0]) - radius[2]) > window:
+            H, inliers = None, np.zeros(len(matches), dtype=bool)
+    if timed:
+        return H, matches, inliers, {"match": matched - start, "ransac": time.perf_counter() - matched, "cpu": time.process_time() - startCpu}
+    return H, matches, inliers
+
+def registerPairs(featureList, pairs, workers=1, initialTransforms=None, window=None, matcher=None, timed=False, minInliers=None, radii=None):
+    '''
+    Registration stage. Every pair only needs the features of its two images, so all pairs are registered in parallel.
+    :param featureList: List of (keypoints, descriptors) for every image
+    :param pairs: List of (index1, index2) image pairs
+    :param workers: Number of worker processes
+    :param initialTransforms: Optional list of approximate 3x3 transformations, one per pair, for guided matching
+    :param window: Search window of guided matching in pixels
+    :param matcher: Matcher backend from the matching module, sent to every worker. None uses brute force matching.
+    :param timed: Also return the matching and RANSAC time of every pair, see registerPair()
+    :param minInliers: Optional early exit of the transform estimation, see registerPair()
+    :param radii: Optional list of rotation free priors, one per pair (None where initialTransforms has one), see radiusTest()
+    :return: List of registerPair() results in the order of pairs
+    '''
+    if initialTransforms is None:
+        initialTransforms = [None]*len(pairs)
+    if radii is None:
+        radii = [None]*len(pairs)
+    argumentList = [featureList[i1] + featureList[i2] + (initial, window, matcher, timed, minInliers, radius)
+                    for (i1, i2), initial, radius in zip(pairs, initialTransforms, radii)]
+    return util.parallelMap(registerPair, argumentList, workers)
+
+def inlierPoints(keypoints1, keypoints2, matches, inliers):
+    '''
+    :return: points1, points2: Kx2 ndArrays of the inlier match locations in image 1 and image 2
+    '''
+    good = matches[inliers]
+    return keypoints1[good[:,1], :2], keypoints2[good[:,0], :2]
@@ -1,33 +1,72 @@
+'''
+Seam repair. Warped images have dark, anti-aliased borders. Where such a border is pasted over existing mosaic
+content it leaves a thin black line. These functions find those pixels and fill them from their neighbours.
+Run this file directly to repair results/intermediateResult1.png using results/warpedResImg.png as the canvas before the blend.
+'''
+
 import cv2
 import utilities as util
 import numpy as np
 
-baseImg = cv2.imread("results/warpedResImg.png")
-originImg = cv2.imread("results/intermediateResult1.png")
-# util.display("Origin img", originImg)
-
-originImgGray = cv2.cvtColor(originImg, cv2.COLOR_BGR2GRAY)
-baseImgGray = cv2.cvtColor(baseImg, cv2.COLOR_BGR2GRAY)
-# util.display("Origin img gray", originImgGray)
-ret, mask1 = cv2.threshold(originImgGray, 18, 255, cv2.THRESH_BINARY_INV)
-util.display("mask1", mask1)
-mask2 = np.float32(mask1)/255
+#4-neighbourhood, the centre pixel itself is not used
+CROSS = np.float32(([0,1,0],[1,0,1],[0,1,0]))
 
-for row in range(mask2.shape[0]):
-	for col in range(mask2.shape[1]):
-		if mask2[row, col] == 1.0 and baseImgGray[row, col] != 0.0:
-			# print("lal")
-			#blue
-			tmpBlue = (baseImg[row, col-1][0] + baseImg[row, col+1][0] + baseImg[row-1, col][0] + baseImg[row+1, col][0])/4.0
-			#green
-			tmpGreen = (baseImg[row, col-1][1] + baseImg[row, col+1][1] + baseImg[row-1, col][1] + baseImg[row+1, col][1])/4.0
-			#red
-			tmpRed = (baseImg[row, col-1][2] + baseImg[row, col+1][2] + baseImg[row-1, col][2] + baseImg[row+1, col][2])/4.0
-			originImg[row,col][0]=255
-			originImg[row,col][1]=255
-			originImg[row,col][2]=255
+def seamMask(resultGray, baseGray, newMask, threshold=18, width=2):
+	'''
+	:param resultGray: Grayscale canvas region after the blend
+	:param baseGray: Grayscale canvas region before the blend
+	:param newMask: uint8 mask, nonzero where the new image has content
+	:param threshold: Pixels at or below this gray level count as black
+	:param width: Only pixels this close to the border of the new image can be seam pixels
+	:return: uint8 mask, 255 at seam pixels: black after the blend although the canvas had content before, next to the new image's border
+	'''
+	newMask = np.uint8(newMask > 0)
+	kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2*width+1, 2*width+1))
+	border = cv2.dilate(newMask, kernel) - cv2.erode(newMask, kernel, borderType=cv2.BORDER_CONSTANT, borderValue=0) #band around the border of the new image
+	seams = (resultGray <= threshold) & (baseGray > 0) & (border > 0)
+	return np.uint8(seams)*255
 
-util.display("After fix", originImg)
+def repairSeams(image, mask, threshold=18, method="average", iterations=2):
+	'''
+	Fills seam pixels in place.
+	:param image: BGR ndArray, e.g. the canvas region of the newly blended image
+	:param mask: uint8 mask, nonzero at seam pixels
+	:param threshold: Neighbours at or below this gray level are not used, they are seam or background themselves
+	:param method: "average" replaces each seam pixel by the mean of its valid 4-neighbours, "inpaint" uses cv2.inpaint()
+	:param iterations: Number of averaging passes. Seams wider than one pixel are filled from the outside in.
+	:return: image
+	'''
+	if not mask.any():
+		return image
+	if method == "inpaint":
+		image[...] = cv2.inpaint(image, mask, 3, cv2.INPAINT_TELEA)
+		return image
+	remaining = mask > 0
+	gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+	valid = np.float32((gray > threshold) & ~remaining)
+	for iteration in range(0, iterations):
+		#out-of-image neighbours are zero in both sums and counts, so border pixels average only the neighbours they have
+		counts = cv2.filter2D(valid, -1, CROSS, borderType=cv2.BORDER_CONSTANT)
+		sums = cv2.filter2D(np.float32(image)*valid[:,:,np.newaxis], -1, CROSS, borderType=cv2.BORDER_CONSTANT)
+		fill = remaining & (counts > 0)
+		if not fill.any():
+			break
+		image[fill] = np.uint8(sums[fill]/counts[fill][:,np.newaxis] + 0.5)
+		valid[fill] = 1
+		remaining &= ~fill
+	return image
 
+if __name__ == "__main__":
+	baseImg = cv2.imread("results/warpedResImg.png")
+	originImg = cv2.imread("results/intermediateResult1.png")
+	# util.display("Origin img", originImg)
 
+	originImgGray = cv2.cvtColor(originImg, cv2.COLOR_BGR2GRAY)
+	baseImgGray = cv2.cvtColor(baseImg, cv2.COLOR_BGR2GRAY)
+	# util.display("Origin img gray", originImgGray)
+	ret, mask1 = cv2.threshold(originImgGray, 18, 255, cv2.THRESH_BINARY_INV)
+	mask1[baseImgGray == 0] = 0 #only pixels that had content before the blend
+	util.display("mask1", mask1)
 
+	repairSeams(originImg, mask1)
+	util.display("After fix", originImg)
@@ -0,0 +1,37 @@
+import cv2
+import numpy as np
+import features as fs
+
+
+def makeKeypoints(points, responses):
+    return [cv2.KeyPoint(float(x), float(y), 7.0, -1, float(response)) for (x, y), response in zip(points, responses)]
+
+def test_bucketKeypointsSpendsBudgetEvenly():
+    rng = np.random.default_rng(0)
+    mask = np.full((600, 800), 255, dtype=np.uint8) #grid 8 gives 100 pixel cells, 8 columns and 6 rows
+    #2000 keypoints in the first cell, 3 in the last one and 20 in each of the 46 others
+    counts = dict(((x, y), 20) for x in range(0, 8) for y in range(0, 6))
+    counts[(0, 0)] = 2000
+    counts[(7, 5)] = 3
+    points = np.vstack([rng.uniform(0, 100, (count, 2)) + [100*x, 100*y] for (x, y), count in counts.items()])
+    keypoints = makeKeypoints(points, rng.uniform(0, 1, len(points)))
+    kept = fs.bucketKeypoints(keypoints, mask, 500, 8)
+    assert len(kept) == 500
+    #a quota of 10 per cell keeps 10 + 46*10 + 3 = 473 keypoints, the other 27 are the strongest 11th ones
+    keptCounts = {}
+    for kp in kept:
+        cell = (int(kp.pt[0]//100), int(kp.pt[1]//100))
+        keptCounts[cell] = keptCounts.get(cell, 0) + 1
+    assert keptCounts.pop((7, 5)) == 3
+    assert sorted(keptCounts.values()).count(11) == 27
+    assert set(keptCounts.values()) == {10, 11}
+    #within every cell the strongest keypoints are kept
+    keptIds = set(id(kp) for kp in kept)
+    for cell in counts:
+        inCell = sorted((kp for kp in keypoints if (int(kp.pt[0]//100), int(kp.pt[1]//100)) == cell), key=lambda kp: -kp.response)
+        assert [id(kp) in keptIds for kp in inCell] == sorted([id(kp) in keptIds for kp in inCell], reverse=True)
+
+def test_bucketKeypointsKeepsAllWithinBudget():
+    rng = np.random.default_rng(1)
+    keypoints = makeKeypoints(rng.uniform(0, 300, (40, 2)), rng.uniform(0, 1, 40))
+    assert fs.bucketKeypoints(keypoints, np.full((300, 300), 255, dtype=np.uint8), 40, 8) == keypoints
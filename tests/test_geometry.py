@@ -0,0 +1,39 @@
+import math as m
+import numpy as np
+import geometry as gm
+
+
+def loopUnRotMatrix(pose):
+    '''
+    computeUnRotMatrix() as it was before it was vectorized, the reference for unRotMatrices().
+    '''
+    a = pose[3]*np.pi/180 #alpha
+    b = pose[4]*np.pi/180 #beta
+    g = pose[5]*np.pi/180 #gamma
+    Rz = np.array(([m.cos(a), -1*m.sin(a), 0],
+                   [m.sin(a), m.cos(a), 0],
+                   [0, 0, 1]))
+    Ry = np.array(([m.cos(b), 0, m.sin(b)],
+                   [0, 1, 0],
+                   [-1*m.sin(b), 0, m.cos(b)]))
+    Rx = np.array(([1, 0, 0],
+                   [0, m.cos(g), -1*m.sin(g)],
+                   [0, m.sin(g), m.cos(g)]))
+    R = np.dot(Rz, np.dot(Rx, Ry))
+    R[0, 2] = 0
+    R[1, 2] = 0
+    R[2, 2] = 1
+    return np.linalg.inv(R.transpose())
+
+def test_unRotMatricesMatchLoop():
+    rng = np.random.default_rng(0)
+    poses = np.zeros((2000, 6))
+    poses[:, :3] = rng.uniform(-100, 100, (2000, 3))
+    poses[:, 3] = rng.uniform(-180, 180, 2000)
+    poses[:, 4:6] = rng.uniform(-85, 85, (2000, 2))
+    poses[:10, 3:6] = 0 #nadir poses give the identity
+    expected = np.array([loopUnRotMatrix(pose) for pose in poses])
+    #both invert the same matrix, they only differ by rounding, which grows with the entries at steep tilts
+    np.testing.assert_allclose(gm.unRotMatrices(poses), expected, rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(gm.unRotMatrices(poses[:10]), np.tile(np.eye(3), (10, 1, 1)), rtol=0, atol=1e-12)
+    np.testing.assert_allclose(gm.computeUnRotMatrix(poses[42]), expected[42], rtol=1e-9, atol=1e-9)
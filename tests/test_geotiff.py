@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+import geotiff
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def test_geoTiffReadsBack(tmp_path):
+    rng = np.random.default_rng(0)
+    mosaic = rng.integers(1, 256, (500, 600, 3), dtype=np.uint8)
+    mosaic[:40, :70] = 0 #empty canvas
+    bounds = [100, -50, 700, 450] #world grid cells
+    path = str(tmp_path / "mosaic.tif")
+    geotiff.writeGeoTiff(path, lambda xMin, yMin, xMax, yMax: mosaic[yMin-bounds[1]:yMax-bounds[1], xMin-bounds[0]:xMax-bounds[0]],
+                         bounds, gsd=0.1, origin=(47.0, 8.0), tileSize=256)
+    with Image.open(path) as image:
+        assert image.size == (600, 500)
+        assert image.n_frames == len(geotiff.levelSizes(600, 500, 256)) == 3
+        pixels = np.asarray(image.convert("RGBA"))
+        np.testing.assert_array_equal(pixels[:, :, :3], mosaic[:, :, ::-1])
+        np.testing.assert_array_equal(pixels[:, :, 3], np.where(mosaic.max(axis=2) > 0, 255, 0))
+        assert image.tag_v2[33550] == (0.1, 0.1, 0.0) #ModelPixelScaleTag
+        assert image.tag_v2[33922] == (0.0, 0.0, 0.0, 10.0, 5.0, 0.0) #ModelTiepointTag
+        assert image.tag_v2[34736][:2] == (8.0, 47.0) #GeoDoubleParamsTag, longitude and latitude of the ENU origin
+        image.seek(2)
+        assert image.size == (150, 125)
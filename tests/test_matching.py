@@ -0,0 +1,62 @@
+import numpy as np
+import matching
+
+
+def matchingScene(seed=0, count=3000, shift=(35.0, -20.0)):
+    '''
+    :return: keypoints2, descriptors2, keypoints1, descriptors1 and the transformation from image 2 into image 1. Most
+        keypoints of image 2 are keypoints of image 1 moved by shift with slightly noisy descriptors, the rest are clutter.
+    '''
+    rng = np.random.default_rng(seed)
+    keypoints1 = np.zeros((count, 7), dtype=np.float32)
+    keypoints1[:, :2] = rng.uniform(0, [1000, 800], (count, 2))
+    descriptors1 = rng.normal(size=(count, 32)).astype(np.float32)
+    shared = rng.permutation(count)[:count*2//3]
+    keypoints2 = np.zeros((count, 7), dtype=np.float32)
+    keypoints2[:len(shared), :2] = keypoints1[shared, :2] - shift + rng.normal(scale=3.0, size=(len(shared), 2))
+    keypoints2[len(shared):, :2] = rng.uniform(0, [1000, 800], (count - len(shared), 2))
+    descriptors2 = rng.normal(size=(count, 32)).astype(np.float32)
+    descriptors2[:len(shared)] = descriptors1[shared] + rng.normal(scale=0.3, size=(len(shared), 32))
+    initial = np.array([[1, 0, shift[0]], [0, 1, shift[1]], [0, 0, 1]])
+    return keypoints2, descriptors2, keypoints1, descriptors1, initial
+
+def windowedMatches(keypoints2, descriptors2, keypoints1, descriptors1, initial, window, ratio):
+    '''
+    Reference for PriorMatcher: ratio test among the keypoints of image 1 within window of the predicted position of
+    every keypoint of image 2, then every keypoint of image 1 keeps its closest query.
+    :return: Set of (index in image 2, index in image 1)
+    '''
+    predicted = keypoints2[:, :2] + initial[:2, 2]
+    best = {}
+    for query in range(0, len(keypoints2)):
+        candidates = np.nonzero(np.linalg.norm(keypoints1[:, :2] - predicted[query], axis=1) <= window)[0]
+        if len(candidates) == 0:
+            continue
+        distances = np.linalg.norm(descriptors1[candidates] - descriptors2[query], axis=1)
+        order = np.argsort(distances)
+        second = distances[order[1]] if len(order) > 1 else np.inf
+        train = candidates[order[0]]
+        if distances[order[0]] < ratio*second and (train not in best or distances[order[0]] < best[train][1]):
+            best[train] = (query, distances[order[0]])
+    return set((query, int(train)) for train, (query, distance) in best.items())
+
+def test_priorMatcherMatchesWindowedReference():
+    scene = matchingScene()
+    matcher = matching.PriorMatcher(20.0, chunkSize=1000) #small chunks so several are needed
+    assert np.pi*matcher.window**2 < matcher.fallbackShare*1000*800 #the grid search is used, not the fallback
+    matches = matcher.match(*scene)
+    assert len(matches) > 1000
+    assert set(map(tuple, matches.tolist())) == windowedMatches(*scene, window=20.0, ratio=matcher.ratio)
+
+def test_priorMatcherFallbackStaysInWindow():
+    keypoints2, descriptors2, keypoints1, descriptors1, initial = matchingScene(seed=1)
+    matches = matching.PriorMatcher(150.0).match(keypoints2, descriptors2, keypoints1, descriptors1, initial)
+    exhaustive = matching.BruteForceMatcher().match(keypoints2, descriptors2, keypoints1, descriptors1)
+    predicted = keypoints2[matches[:, 0], :2] + initial[:2, 2]
+    assert len(matches) > 1000
+    assert np.all(np.linalg.norm(predicted - keypoints1[matches[:, 1], :2], axis=1) <= 150.0)
+    assert set(map(tuple, matches.tolist())) <= set(map(tuple, exhaustive.tolist()))
+
+def test_priorMatcherWithoutKeypoints():
+    keypoints2, descriptors2, keypoints1, descriptors1, initial = matchingScene(count=10)
+    assert matching.PriorMatcher(20.0).match(keypoints2[:0], descriptors2[:0], keypoints1, descriptors1, initial).shape == (0, 2)
@@ -0,0 +1,35 @@
+import numpy as np
+import pairs
+
+
+def randomPoses(count, seed=0):
+    '''
+    :return: Nx6 pose matrix of count cameras scattered over a 2 km square at 20 to 80 m altitude
+    '''
+    rng = np.random.default_rng(seed)
+    poses = np.zeros((count, 6))
+    poses[:, :2] = rng.uniform(0, 2000, (count, 2))
+    poses[:, 2] = rng.uniform(20, 80, count)
+    return poses
+
+def test_candidatePairsMatchesBruteForce():
+    poses = randomPoses(3000)
+    maxDistances = pairs.footprintSizes(poses)*(1 - 0.3)
+    distances = np.linalg.norm(poses[:, None, :2] - poses[None, :, :2], axis=2)
+    i, j = np.nonzero(np.triu(distances <= (maxDistances[:, None] + maxDistances[None, :])/2, k=1))
+    assert pairs.candidatePairs(poses) == list(zip(i.tolist(), j.tolist()))
+
+def test_candidatePairsRadiusMatchesBruteForce():
+    poses = randomPoses(3000, seed=1)
+    distances = np.linalg.norm(poses[:, None, :2] - poses[None, :, :2], axis=2)
+    i, j = np.nonzero(np.triu(distances <= 40.0, k=1))
+    assert pairs.candidatePairs(poses, radius=40.0) == list(zip(i.tolist(), j.tolist()))
+
+def test_candidatePairsNearestMatchesBruteForce():
+    poses = randomPoses(3000, seed=2)
+    distances = np.linalg.norm(poses[:, None, :2] - poses[None, :, :2], axis=2)
+    np.fill_diagonal(distances, np.inf)
+    expected = set()
+    for i, neighbours in enumerate(np.argsort(distances, axis=1)[:, :4]):
+        expected.update((min(i, int(j)), max(i, int(j))) for j in neighbours)
+    assert pairs.candidatePairs(poses, k=4) == sorted(expected)
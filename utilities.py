@@ -1,22 +1,97 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import cv2
 import numpy as np
+import dataset
 
 
-def importData(fileName, imageDirectory):
+def importData(fileName, imageDirectory, cacheSize=4):
     '''
-    :param fileName: Name of the pose data file in string form e.g. "datasets/imageData.txt"
+    :param fileName: Name of the pose data file in string form e.g. "datasets/imageData.txt", or of the binary pose index written by getImagedata.main() e.g. "datasets/imageData.npz"
     :param imageDirectory: Name of the directory where images arer stored in string form e.g. "datasets/images/"
+    :param cacheSize: Number of decoded images kept in memory
     :return: dataMatrix: A NumPy ndArray contaning all of the pose data. Each row stores 6 floats containing pose information in XYZYPR form
-        allImages: A Python List of NumPy ndArrays containing images.
+        allImages: A dataset.ImageDataset. It is indexed like a list of NumPy ndArrays, but images are only decoded when accessed.
     '''
 
-    allImages = [] #list of cv::Mat aimghes
-    dataMatrix = np.genfromtxt(fileName,delimiter=",",usecols=range(1,7),dtype=float) #read numerical data
-    fileNameMatrix = np.genfromtxt(fileName,delimiter=",",usecols=[0],dtype=str) #read filen name strings
-    for i in range(0,fileNameMatrix.shape[0]): #read images
-        allImages.append(cv2.imread(imageDirectory+fileNameMatrix[i]))
+    fileNameMatrix, dataMatrix = importPoses(fileName)
+    allImages = dataset.ImageDataset(fileNameMatrix, imageDirectory, cacheSize) #images are read lazily
     return allImages, dataMatrix
 
+def importFileNames(fileName):
+    '''
+    :param fileName: Name of the pose data file in string form e.g. "datasets/imageData.txt"
+    :return: A NumPy ndArray containing the image file name of each row of the pose data file.
+    '''
+    return importPoses(fileName)[0]
+
+def importPoses(fileName):
+    '''
+    Reads the pose data file in a single pass. Binary .npz pose indices are loaded directly without parsing text.
+    :param fileName: Name of the pose data file in string form e.g. "datasets/imageData.txt" or "datasets/imageData.npz"
+    :return: fileNameMatrix: ndArray of image file names, dataMatrix: Nx6 ndArray of pose data in XYZYPR form
+    '''
+    if fileName.endswith(".npz"):
+        with np.load(fileName) as index:
+            return index["fileNames"].astype(str), index["dataMatrix"]
+    table = np.atleast_2d(np.genfromtxt(fileName,delimiter=",",usecols=range(0,7),dtype=str)) #read file names and numerical data at once
+    return table[:,0], table[:,1:7].astype(float)
+
+def importOrigin(fileName):
+    '''
+    :param fileName: Name of the pose data file, e.g. "datasets/imageData.txt". The origin is read from the binary pose
+        index written next to it by getImagedata.main(), or from the index itself.
+    :return: (latitude, longitude) of the origin of the ENU pose coordinates, None if it is not known
+    '''
+    indexName = fileName if fileName.endswith(".npz") else os.path.splitext(fileName)[0] + ".npz"
+    if not os.path.isfile(indexName):
+        return None
+    with np.load(indexName) as index:
+        if "origin" not in index.files:
+            return None
+        return float(index["origin"][0]), float(index["origin"][1])
+
+def importHeadings(fileName, fileNames):
+    '''
+    getImagedata.to_poses() writes a yaw of 0 into the pose data, so the camera headings are read from the raw
+    metadata in the binary pose index instead.
+    :param fileName: Name of the pose data file, e.g. "datasets/imageData.txt", or of the pose index itself
+    :param fileNames: Image file names to look up, e.g. the ones returned by importData()
+    :return: ndArray of the heading of every image in degrees, NaN where it is not known. None if the index has no
+        metadata or none of its yaw angles is set.
+    '''
+    indexName = fileName if fileName.endswith(".npz") else os.path.splitext(fileName)[0] + ".npz"
+    if not os.path.isfile(indexName):
+        return None
+    with np.load(indexName) as index:
+        if "metadata" not in index.files or not np.any(index["metadata"][:, 3] != 0):
+            return None
+        yaws = dict(zip(index["fileNames"].astype(str), index["metadata"][:, 3]))
+    return np.array([yaws.get(name, np.nan) for name in fileNames], dtype=np.float64)
+
+def parallelMap(function, argumentList, workers=1):
+    '''
+    Calls function(*arguments) for every entry of argumentList on a process pool.
+    :param function: Module level function, so that it can be sent to worker processes.
+    :param argumentList: Iterable of argument tuples. It is consumed lazily, so a generator keeps only a few
+        arguments (e.g. decoded images) alive at a time.
+    :param workers: Number of worker processes. With 1 everything runs in the calling process.
+    :return: List of results in the order of argumentList
+    '''
+    if workers <= 1:
+        return [function(*arguments) for arguments in argumentList]
+    results = []
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for arguments in argumentList:
+            pending.append(executor.submit(function, *arguments))
+            if len(pending) >= 2*workers: #bound the number of arguments waiting in the queue
+                results.append(pending.popleft().result())
+        while pending:
+            results.append(pending.popleft().result())
+    return results
+
 def display(title, image):
     '''
     OpenCV machinery for showing an image until the user presses a key.